@@ -0,0 +1,180 @@
+import argparse
+import contextlib
+import logging
+import math
+import os
+
+from blob_detector_core import BlobDetectorCore, count_cores
+from detection_cache import DETECTION_CACHE
+from image_cache import IMAGE_CACHE
+from image_loader import IMAGE_PREFETCHER
+from instrumentation import PROFILER, report_profile
+from keypoint_archive import save_keypoint_archive
+from keypoint_export import CountedImageWriter, save_keypoints_as_xml, EXPORT_IMAGE_FORMATS, \
+    get_imwrite_params
+from utils import DEFAULT_OUTPUT_FOLDER, DEFAULT_INFERENCE_BATCH_SIZE, DEFAULT_MODEL_PATH, \
+    DEFAULT_IMAGE_CACHE_BUDGET_MB, DEFAULT_TARGET_IMAGE_SIZE, DEFAULT_TILE_SIZE, DEFAULT_TILE_OVERLAP, \
+    DEFAULT_EXPORT_IMAGE_FORMAT, DEFAULT_DETECTION_BACKEND, DETECTION_BACKENDS, BACKEND_YOLO_TILED, \
+    BACKEND_SIMPLE_BLOB, BACKEND_CASCADE, DEFAULT_CASCADE_SMALL_MODEL_PATH, ESCALATE_PLATE, ESCALATE_REGION, \
+    DEFAULT_CASCADE_ESCALATION, DEFAULT_CASCADE_UNCERTAIN_CONFIDENCE, DEFAULT_CASCADE_MAX_UNCERTAIN_FRACTION, \
+    DEFAULT_CASCADE_MAX_DENSITY
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def list_image_paths(folder_path):
+    return sorted(os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def log_write_error(future, image_path):
+    if future.exception() is not None:
+        logging.error(f"Unable to save the counted image of \"{image_path}\": {future.exception()}")
+
+
+def count_folder(folder_path, blob_counter, output_root=DEFAULT_OUTPUT_FOLDER, batch_size=DEFAULT_INFERENCE_BATCH_SIZE,
+                 save_images=True, target_size=DEFAULT_TARGET_IMAGE_SIZE, image_format=DEFAULT_EXPORT_IMAGE_FORMAT,
+                 image_quality=None):
+    """
+    Stream a folder through the counting core batch by batch. Decoded images are dropped as soon as their batch has
+    been counted and written and only the next batch is prefetched, so memory stays bounded by the batch size rather
+    than the folder size. Counted images are encoded on a writer pool while the next batch is counted.
+    :return: List of BlobDetectorCore objects (without pixel data) holding the keypoints and metadata of each plate.
+    """
+    image_paths = list_image_paths(folder_path)
+    records = [BlobDetectorCore(image_path, blob_counter=blob_counter, load_image=False) for image_path in image_paths]
+    for core in records:
+        core.target_size = target_size
+    cores = []
+    needed_pixels = True  # Nothing is known about the cache before the first batch, so its successor is prefetched
+    with CountedImageWriter(output_root, image_format, image_quality) if save_images else contextlib.nullcontext() \
+            as image_writer:
+        for start in range(0, len(records), batch_size):
+            batch = records[start:start + batch_size]
+            if needed_pixels:
+                # Decode the next batch while this one is counted, unless the last batch came from the detection cache.
+                # count_cores decodes the misses of the current batch itself.
+                IMAGE_PREFETCHER().prefetch(records[start + batch_size:start + 2 * batch_size])
+            with PROFILER().stage("count_batch", batch=len(batch)):
+                keypoints_per_image = count_cores(
+                    batch, blob_counter, batch_size=batch_size,
+                    on_error=lambda core, e: logging.error(f"Skipping \"{core.image_path}\": {e}"))
+            needed_pixels = any(core.is_image_loaded() for core in batch)
+            for core, keypoints in zip(batch, keypoints_per_image):
+                if keypoints is None:
+                    continue
+                core.set_keypoints(keypoints)
+                if image_writer is not None:
+                    future = image_writer.submit_image(core.get_display_image(), core.get_timepoint())
+                    future.add_done_callback(lambda f, path=core.image_path: log_write_error(f, path))
+                core.unload_image()
+                cores.append(core)
+            logging.info(f"Counted {min(start + batch_size, len(image_paths))} of {len(image_paths)} images.")
+    cores.sort(key=lambda core: (core.day_num, core.sample_number if core.sample_number != -1 else math.inf))
+    return cores
+
+
+def write_excel(excel_path, cores):
+    from excel_output import ExcelOutput
+    excel_output = ExcelOutput(excel_path)
+    excel_output.write_all_blob_counts(core.get_timepoint() for core in cores)
+    excel_output.save()
+    logging.info(f"SUCCESS: Blob counts exported to Excel and saved to disk in file: \"{excel_path}\".")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="main.py batch", description="Count blobs in a folder of plate images.")
+    parser.add_argument("folder", help="Folder containing the plate images.")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_FOLDER,
+                        help="Folder to write counted images and keypoints.xml to.")
+    parser.add_argument("--excel", default=None, help="Existing Excel workbook to fill in with the blob counts.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_INFERENCE_BATCH_SIZE,
+                        help="Number of images counted per forward pass.")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="YOLO model weights to count with.")
+    parser.add_argument("--backend", choices=DETECTION_BACKENDS, default=DEFAULT_DETECTION_BACKEND,
+                        help="Detection backend: YOLO on the 1024 px center crop, YOLO on full-resolution tiles, "
+                             "YOLO run by ONNX Runtime (FP32 or INT8), a small-then-large YOLO cascade or the "
+                             "classical SimpleBlobDetector.")
+    parser.add_argument("--tiled", action="store_true", help=f"Shorthand for --backend {BACKEND_YOLO_TILED}.")
+    parser.add_argument("--tile-size", type=int, default=DEFAULT_TILE_SIZE, help="Tile edge length in pixels.")
+    parser.add_argument("--tile-overlap", type=int, default=DEFAULT_TILE_OVERLAP,
+                        help="Overlap between neighbouring tiles in pixels.")
+    parser.add_argument("--small-model", default=DEFAULT_CASCADE_SMALL_MODEL_PATH,
+                        help=f"Small YOLO model counting every plate first with --backend {BACKEND_CASCADE}; --model "
+                             f"is only run where it is unsure.")
+    parser.add_argument("--escalation", choices=(ESCALATE_PLATE, ESCALATE_REGION), default=DEFAULT_CASCADE_ESCALATION,
+                        help="Count uncertain plates again as a whole, or only their uncertain regions.")
+    parser.add_argument("--uncertain-confidence", type=float, default=DEFAULT_CASCADE_UNCERTAIN_CONFIDENCE,
+                        help="Small-model detections below this confidence count as uncertain.")
+    parser.add_argument("--max-uncertain-fraction", type=float, default=DEFAULT_CASCADE_MAX_UNCERTAIN_FRACTION,
+                        help="Escalate plates or regions where a larger fraction of the detections is uncertain.")
+    parser.add_argument("--max-density", type=float, default=DEFAULT_CASCADE_MAX_DENSITY,
+                        help="Escalate plates or regions with more small-model detections per megapixel.")
+    parser.add_argument("--image-cache-mb", type=int, default=DEFAULT_IMAGE_CACHE_BUDGET_MB,
+                        help="Memory budget for decoded images, in megabytes.")
+    parser.add_argument("--no-detection-cache", action="store_true",
+                        help="Always run the model instead of reusing results cached on disk.")
+    parser.add_argument("--clear-detection-cache", action="store_true",
+                        help="Delete all cached detection results before counting.")
+    parser.add_argument("--no-images", action="store_true", help="Do not write counted images.")
+    parser.add_argument("--image-format", choices=list(EXPORT_IMAGE_FORMATS), default=DEFAULT_EXPORT_IMAGE_FORMAT,
+                        help="Format of the counted images.")
+    parser.add_argument("--image-quality", type=int, default=None,
+                        help="PNG compression level (0-9) or JPEG/WebP quality (0-100) of the counted images.")
+    parser.add_argument("--archive", default=None,
+                        help="Also write the keypoints as a memory-mappable .npy archive to this folder.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Time every pipeline stage and log a summary with the peak memory at the end.")
+    parser.add_argument("--trace", default=None,
+                        help="Write a Chrome trace of the pipeline stages to this JSON file (implies --profile).")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', force=True)
+
+    if not os.path.isdir(args.folder):
+        parser.error(f"\"{args.folder}\" is not a folder.")
+    try:
+        get_imwrite_params(args.image_format, args.image_quality)
+    except ValueError as e:
+        parser.error(str(e))
+    IMAGE_CACHE().set_max_bytes(args.image_cache_mb * 1024 * 1024)
+    if args.profile or args.trace:
+        PROFILER().enable()
+    backend = BACKEND_YOLO_TILED if args.tiled else args.backend
+    from blob_counter import create_blob_counter
+    if backend == BACKEND_YOLO_TILED:
+        blob_counter = create_blob_counter(backend, model_path=args.model, tile_size=args.tile_size,
+                                           tile_overlap=args.tile_overlap, batch_size=max(args.batch_size, 1),
+                                           use_detection_cache=not args.no_detection_cache)
+    elif backend == BACKEND_CASCADE:
+        blob_counter = create_blob_counter(backend, model_path=args.model, small_model_path=args.small_model,
+                                           escalation=args.escalation, uncertain_confidence=args.uncertain_confidence,
+                                           max_uncertain_fraction=args.max_uncertain_fraction,
+                                           max_density=args.max_density, batch_size=max(args.batch_size, 1),
+                                           use_detection_cache=not args.no_detection_cache)
+    elif backend == BACKEND_SIMPLE_BLOB:
+        blob_counter = create_blob_counter(backend)
+    else:
+        blob_counter = create_blob_counter(backend, model_path=args.model,
+                                           use_detection_cache=not args.no_detection_cache)
+    if args.clear_detection_cache:
+        DETECTION_CACHE().clear()
+    cores = count_folder(args.folder, blob_counter, output_root=args.output, batch_size=max(args.batch_size, 1),
+                         save_images=not args.no_images,
+                         target_size=None if backend == BACKEND_YOLO_TILED else DEFAULT_TARGET_IMAGE_SIZE,
+                         image_format=args.image_format, image_quality=args.image_quality)
+    if not cores:
+        logging.warning("No images found in the selected folder.")
+        return 1
+    logging.info(IMAGE_CACHE().report())
+    if blob_counter.detection_cache is not None:
+        logging.info(blob_counter.detection_cache.report())
+    if blob_counter.report() is not None:
+        logging.info(blob_counter.report())
+    save_keypoints_as_xml(((core.get_timepoint(), core.keypoints) for core in cores), args.output)
+    if args.archive:
+        save_keypoint_archive(((core.get_timepoint(), core.keypoints) for core in cores), args.archive,
+                              preprocessing=cores[0].preprocessing_settings())
+        logging.info(f"SUCCESS: Keypoint archive saved to disk in folder: \"{args.archive}\".")
+    if args.excel:
+        write_excel(args.excel, cores)
+    report_profile(args.trace)
+    return 0
@@ -0,0 +1,301 @@
+"""
+Benchmarks for the counting, rendering and export hot paths.
+
+Runs offline on a CPU-only machine: plates are synthetic and counting uses a small YOLO model built from the
+ultralytics yolo11n.yaml config with random weights, so timings are representative of the pipeline and not of the
+detection quality. Results are written as JSON so runs can be compared with --compare.
+
+    python benchmarks.py [--scale small|medium|large] [--output benchmark_results.json] [--compare old.json]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from blob_detector_core import BlobDetectorCore
+from excel_output import ExcelOutput
+from image_loader import resize_and_crop
+from keypoint_export import save_keypoints_as_xml
+from keypoint_index import KeypointIndex
+from keypoint_store import KeypointStore
+from utils import DEFAULT_TARGET_IMAGE_SIZE, Timepoint
+
+BENCHMARK_LOGGER = logging.getLogger("benchmarks")
+STAND_IN_MODEL_CONFIG = "yolo11n.yaml"
+DEFAULT_RESULTS_PATH = "benchmark_results.json"
+
+# Parameters per scale. Image sizes are (height, width) of the raw plate photos.
+SCALES = {
+    "small": {"image_sizes": [(1224, 918), (2448, 1836)], "keypoint_counts": [100, 1000], "batch_sizes": [1, 4],
+              "samples": [10, 50], "repeat": 3},
+    "medium": {"image_sizes": [(1224, 918), (2448, 1836), (4896, 3672)], "keypoint_counts": [100, 1000, 10000],
+               "batch_sizes": [1, 4, 8], "samples": [50, 300], "repeat": 5},
+    "large": {"image_sizes": [(2448, 1836), (4896, 3672), (6000, 4500)], "keypoint_counts": [1000, 10000, 50000],
+              "batch_sizes": [1, 8, 16], "samples": [300, 1000], "repeat": 5},
+}
+
+
+def make_synthetic_plate(height, width, colonies, seed=0):
+    """
+    A plate-like BGR image: a bright dish on a dark background with colonies drawn as small filled discs.
+    :return: (image, (N, 4) float32 array of the drawn colonies as (x, y, size, 1.0) rows).
+    """
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 30, dtype=np.uint8)
+    center, dish_radius = (width // 2, height // 2), min(height, width) // 2 - 10
+    cv2.circle(image, center, dish_radius, (150, 170, 180), -1)
+    angles = rng.uniform(0, 2 * np.pi, colonies)
+    distances = dish_radius * 0.95 * np.sqrt(rng.uniform(0, 1, colonies))
+    sizes = rng.uniform(6, 30, colonies) * min(height, width) / DEFAULT_TARGET_IMAGE_SIZE
+    x = center[0] + distances * np.cos(angles)
+    y = center[1] + distances * np.sin(angles)
+    for colony_x, colony_y, size in zip(x.astype(int).tolist(), y.astype(int).tolist(), sizes.tolist()):
+        cv2.circle(image, (colony_x, colony_y), max(int(size / 2), 1), (235, 235, 225), -1)
+    image = cv2.add(image, rng.integers(0, 12, image.shape, dtype=np.uint8))  # Sensor noise
+    return image, np.column_stack((x, y, sizes, np.ones(colonies))).astype(np.float32)
+
+
+def make_stand_in_model(path):
+    """Build a randomly initialised yolo11n from its config and save it to path, without any download."""
+    from ultralytics import YOLO
+    YOLO(STAND_IN_MODEL_CONFIG).save(path)
+    return path
+
+
+def random_keypoints(count, extent=DEFAULT_TARGET_IMAGE_SIZE, seed=0):
+    rng = np.random.default_rng(seed)
+    return KeypointStore.from_detections(np.column_stack((rng.uniform(0, extent, count), rng.uniform(0, extent, count),
+                                                          rng.uniform(10, 40, count), np.ones(count))))
+
+
+def time_call(function, repeat, setup=None):
+    """Run function repeat times after one warm-up call and return the timing statistics in seconds."""
+    if setup is not None:
+        setup()
+    function()
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {"min_s": min(timings), "median_s": statistics.median(timings), "mean_s": statistics.fmean(timings),
+            "repeat": repeat}
+
+
+class BenchmarkRunner:
+    def __init__(self, scale, work_dir, model_path=None):
+        self.config = SCALES[scale]
+        self.scale = scale
+        self.work_dir = work_dir
+        self.model_path = model_path
+        self.results = []
+
+    def record(self, benchmark, params, timing):
+        result = {"benchmark": benchmark, "params": params, **timing}
+        self.results.append(result)
+        BENCHMARK_LOGGER.info(f"{benchmark} {params}: median {timing['median_s'] * 1000:.2f} ms")
+
+    def bench_resize_and_crop(self):
+        for height, width in self.config["image_sizes"]:
+            image, _ = make_synthetic_plate(height, width, 200)
+            self.record("resize_and_crop", {"height": height, "width": width},
+                        time_call(lambda: resize_and_crop(image, DEFAULT_TARGET_IMAGE_SIZE), self.config["repeat"]))
+
+    def bench_count_blobs(self):
+        from blob_counter import YOLOBlobCounter
+        if self.model_path is None:
+            self.model_path = make_stand_in_model(os.path.join(self.work_dir, "stand_in.pt"))
+        blob_counter = YOLOBlobCounter(model_path=self.model_path, use_detection_cache=False)
+        size = DEFAULT_TARGET_IMAGE_SIZE
+        images = [make_synthetic_plate(size, size, 200, seed=i)[0] for i in range(max(self.config["batch_sizes"]))]
+        try:
+            self.record("count_blobs", {"size": size},
+                        time_call(lambda: blob_counter.count_blobs(images[0]), self.config["repeat"]))
+            for batch_size in self.config["batch_sizes"]:
+                batch = images[:batch_size]
+                timing = time_call(lambda: blob_counter.count_blobs_batch(batch, batch_size=batch_size),
+                                   self.config["repeat"])
+                timing["images_per_s"] = batch_size / timing["median_s"]
+                self.record("count_blobs_batch", {"size": size, "batch_size": batch_size}, timing)
+        finally:
+            blob_counter.close()
+
+    def bench_simple_blob(self):
+        from blob_counter import SimpleBlobCounter, DEFAULT_SIMPLE_BLOB_SETTINGS
+        # Synthetic colonies are brighter than the dish, so threshold above it
+        settings = {**DEFAULT_SIMPLE_BLOB_SETTINGS, "min_threshold": 170, "max_threshold": 230, "min_area": 20}
+        for height, width in self.config["image_sizes"]:
+            image, _ = make_synthetic_plate(height, width, 200)
+            params = {"height": height, "width": width}
+
+            def count_uncached():
+                SimpleBlobCounter(settings).count_blobs(image)
+
+            self.record("simple_blob_count", params, time_call(count_uncached, self.config["repeat"]))
+            blob_counter = SimpleBlobCounter(settings)
+            blob_counter.count_blobs(image, image_hash="plate")
+            min_areas = iter(np.tile([20, 60, 120, 240], self.config["repeat"] + 1).tolist())
+
+            def refilter():
+                blob_counter.set_settings(min_area=next(min_areas))
+                blob_counter.count_blobs(image, image_hash="plate")  # Plates are keyed by their file hash in the GUI
+
+            self.record("simple_blob_refilter", params, time_call(refilter, self.config["repeat"]))
+
+    def bench_get_display_image(self):
+        size = DEFAULT_TARGET_IMAGE_SIZE
+        core = BlobDetectorCore(load_image=False)
+        core.image = make_synthetic_plate(size, size, 200)[0]
+        for count in self.config["keypoint_counts"]:
+            core.set_keypoints(random_keypoints(count))
+            self.record("get_display_image", {"size": size, "keypoints": count},
+                        time_call(core.get_display_image, self.config["repeat"]))
+
+    def bench_update_display_image(self):
+        try:
+            os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+            from PySide6.QtWidgets import QApplication
+            from blob_detector_logic import BlobDetectorLogic
+            from blob_detector_ui import BlobDetectorUI
+        except ImportError as e:
+            BENCHMARK_LOGGER.warning(f"Skipping update_display_image, Qt is not available: {e}")
+            return
+        app = QApplication.instance() or QApplication([])
+        size = DEFAULT_TARGET_IMAGE_SIZE
+        image_path = os.path.join(self.work_dir, "Day 3", "1_3rd.png")  # Named like a real plate photo
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+        cv2.imwrite(image_path, make_synthetic_plate(size, size, 200)[0])
+        ui = BlobDetectorUI()
+        core = BlobDetectorCore(image_path, load_image=False)
+        logic = BlobDetectorLogic(ui, core=core)
+        ui.set_blob_detector_logic(logic)
+
+        def reset_pixmap():
+            ui.base_pixmap_key = None  # Force the plate to be converted again, as when switching plates
+
+        for count in self.config["keypoint_counts"]:
+            logic.set_keypoints(random_keypoints(count))
+            self.record("update_display_image", {"size": size, "keypoints": count},
+                        time_call(ui.update_display_image, self.config["repeat"], setup=reset_pixmap))
+            app.processEvents()
+        ui.set_blob_detector_logic(None)
+
+    def bench_hit_testing(self):
+        queries = np.random.default_rng(1).uniform(0, DEFAULT_TARGET_IMAGE_SIZE, (1000, 2)).tolist()
+        for count in self.config["keypoint_counts"]:
+            store = random_keypoints(count)
+            self.record("keypoint_index_build", {"keypoints": count},
+                        time_call(lambda: KeypointIndex.from_store(store), self.config["repeat"]))
+            index = KeypointIndex.from_store(store)
+
+            def find_all():
+                for x, y in queries:
+                    index.find_containing(x, y)
+
+            timing = time_call(find_all, self.config["repeat"])
+            timing["queries"] = len(queries)
+            self.record("keypoint_hit_test", {"keypoints": count, "queries": len(queries)}, timing)
+
+    def make_samples(self, sample_count, keypoints_per_sample):
+        store = random_keypoints(keypoints_per_sample)
+        return [(Timepoint(day=3, sample_number=i + 1, dilution="3rd", num_keypoints=keypoints_per_sample,
+                           filename=f"{i + 1}_3rd.jpg"), store) for i in range(sample_count)]
+
+    def bench_xml_export(self):
+        output_root = os.path.join(self.work_dir, "xml")
+        for sample_count in self.config["samples"]:
+            samples = self.make_samples(sample_count, 200)
+            self.record("save_keypoints_as_xml", {"samples": sample_count, "keypoints_per_sample": 200},
+                        time_call(lambda: save_keypoints_as_xml(samples, output_root), self.config["repeat"]))
+
+    def make_workbook(self, path, sample_count):
+        import openpyxl
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        for column, day in enumerate(range(3, 31, 3), start=2):
+            sheet.cell(row=1, column=column, value=f"Day {day}")
+            sheet.cell(row=2, column=column, value="colonies")
+        for sample_number in range(1, sample_count + 1):
+            sheet.cell(row=2 + sample_number, column=1, value=f"Sample {sample_number}")
+        workbook.save(path)
+
+    def bench_excel_output(self):
+        for sample_count in self.config["samples"]:
+            path = os.path.join(self.work_dir, f"counts_{sample_count}.xlsx")
+            self.make_workbook(path, sample_count)
+            timepoints = [timepoint for timepoint, _ in self.make_samples(sample_count, 0)]
+
+            def write_counts():
+                excel_output = ExcelOutput(path)
+                excel_output.write_all_blob_counts(timepoints)
+                excel_output.save()
+
+            self.record("excel_write_all_blob_counts", {"samples": sample_count},
+                        time_call(write_counts, self.config["repeat"]))
+
+    def run(self, benchmarks):
+        for name in benchmarks:
+            getattr(self, f"bench_{name}")()
+        return {"scale": self.scale, "environment": environment(), "results": self.results}
+
+
+BENCHMARKS = ["resize_and_crop", "count_blobs", "simple_blob", "get_display_image", "update_display_image",
+              "hit_testing", "xml_export", "excel_output"]
+
+
+def environment():
+    return {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+            "numpy": np.__version__, "opencv": cv2.__version__}
+
+
+def result_key(result):
+    return result["benchmark"], json.dumps(result["params"], sort_keys=True)
+
+
+def compare_results(results, baseline):
+    """Print the median time of every benchmark relative to a previous run, > 1.0 means slower."""
+    baseline_by_key = {result_key(result): result for result in baseline["results"]}
+    for result in results["results"]:
+        previous = baseline_by_key.get(result_key(result))
+        if previous is None:
+            continue
+        ratio = result["median_s"] / previous["median_s"] if previous["median_s"] else float("inf")
+        print(f"{result['benchmark']:<30} {result_key(result)[1]:<50} {ratio:6.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the counting, rendering and export hot paths.")
+    parser.add_argument("--scale", choices=list(SCALES), default="small", help="Size of the generated workloads.")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS, help="Benchmarks to run.")
+    parser.add_argument("--model", default=None,
+                        help="YOLO weights to count with, a random yolo11n stand-in is generated by default.")
+    parser.add_argument("--output", default=DEFAULT_RESULTS_PATH, help="JSON file to write the results to.")
+    parser.add_argument("--compare", default=None, help="Results of an earlier run to compare against.")
+    args = parser.parse_args(argv)
+    # Only the benchmark results are logged, not every inference and export
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', force=True)
+    BENCHMARK_LOGGER.setLevel(logging.INFO)
+
+    with tempfile.TemporaryDirectory(prefix="blob_counter_benchmarks_") as work_dir:
+        results = BenchmarkRunner(args.scale, work_dir, model_path=args.model).run(args.only)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=1)
+    BENCHMARK_LOGGER.info(f"SUCCESS: Benchmark results saved to \"{args.output}\".")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare_results(results, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,166 @@
+import heapq
 import logging
-from PySide6.QtCore import QObject, Signal
+import threading
 
-class BlobCounterWorker(QObject):
-    finished = Signal()
-    error = Signal(str)
-    progress = Signal(int)
+from PySide6.QtCore import QObject, Signal, QRunnable, QThreadPool
 
-    def __init__(self, logic):
+from blob_detector_core import count_cores
+from utils import DEFAULT_INFERENCE_BATCH_SIZE, DEFAULT_MAX_COUNTING_THREADS
+
+
+class BlobCounterTaskSignals(QObject):
+    image_counted = Signal(object, object)  # logic, keypoints
+    image_failed = Signal(object, str)  # logic, error message
+    finished = Signal(object)  # task
+
+
+class BlobCounterTask(QRunnable):
+    """Counts one batch of images on a thread pool thread. Results are handed back through signals."""
+
+    def __init__(self, logics, blob_counter, batch_size, cancel_event: threading.Event):
         super().__init__()
-        self.logic = logic
+        self.setAutoDelete(False)  # The scheduler keeps tasks alive until their finished signal is handled
+        self.logics = logics
+        self.blob_counter = blob_counter
+        self.batch_size = batch_size
+        self.cancel_event = cancel_event
+        self.signals = BlobCounterTaskSignals()
 
     def run(self):
         try:
-            self.logic.update_blob_count()
-            self.progress.emit(1)  # Emit progress signal
-        except Exception as e:
-            logging.error(f"Error in BlobCounterWorker: {e}")
-            self.error.emit(str(e))
+            if self.cancel_event.is_set():
+                return
+            # count_cores and the prefetcher work on the Qt-free cores, open plates are counted through their core
+            cores = [getattr(logic, "core", logic) for logic in self.logics]
+            logics_by_core = {id(core): logic for core, logic in zip(cores, self.logics)}
+            failed = set()  # Plates already reported through on_error
+
+            def on_error(core, error):
+                failed.add(id(core))
+                self.handle_error(logics_by_core[id(core)], error)
+
+            try:
+                keypoints_per_image = count_cores(cores, self.blob_counter, batch_size=self.batch_size,
+                                                  on_error=on_error)
+            except Exception as e:
+                # Report the rest of the batch too, so progress reaches the total and the error dialog lists them
+                for core, logic in zip(cores, self.logics):
+                    if id(core) not in failed:
+                        self.handle_error(logic, e)
+                return
+            for logic, keypoints in zip(self.logics, keypoints_per_image):
+                if self.cancel_event.is_set():
+                    return
+                if keypoints is not None:
+                    self.signals.image_counted.emit(logic, keypoints)
         finally:
-            self.finished.emit()
\ No newline at end of file
+            self.signals.finished.emit(self)
+
+    def handle_error(self, logic, error):
+        logging.error(f"Error counting blobs in \"{logic.image_path}\": {error}")
+        self.signals.image_failed.emit(logic, str(error))
+
+
+class BlobCountScheduler(QObject):
+    """
+    Counts a list of BlobDetectorLogic objects on a bounded thread pool.
+
+    Pending images wait in a priority queue keyed by their distance from the focused image (the plate on screen), so
+    the focused plate and its neighbours are counted first; set_focus() reorders the queue when the selection
+    changes. Batches are formed from the front of the queue when a worker becomes free and the focused plate is
+    always sent on its own, so its count does not wait for a whole batch. At most max_concurrency batches are in
+    flight at once, so cancel() takes effect as soon as the running batches return.
+    Keypoints are applied to the logic objects on the thread that owns the scheduler (the GUI thread), through
+    apply_keypoints(logic, keypoints) if given, and image_counted is emitted for every image as soon as its batch
+    returns.
+    """
+    image_counted = Signal(object, int)  # logic, number of keypoints
+    image_failed = Signal(object, str)  # logic, error message
+    progress = Signal(int, int)  # completed, total
+    finished = Signal(bool)  # True if the run was cancelled
+
+    def __init__(self, blob_counter, max_concurrency=DEFAULT_MAX_COUNTING_THREADS,
+                 batch_size=DEFAULT_INFERENCE_BATCH_SIZE, apply_keypoints=None, parent=None):
+        super().__init__(parent)
+        self.apply_keypoints = apply_keypoints or (lambda logic, keypoints: logic.set_keypoints(keypoints))
+        self.blob_counter = blob_counter
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.batch_size = max(int(batch_size), 1)
+        self.thread_pool = QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(self.max_concurrency)
+        self.cancel_event = threading.Event()
+        self.logics = []
+        self.pending = []  # Heap of (distance from the focused image, position in self.logics)
+        self.running_tasks = set()
+        self.errors = []
+        self.total = 0
+        self.completed = 0
+
+    def start(self, logics, focus_index=0):
+        self.cancel_event.clear()
+        self.errors = []
+        self.logics = list(logics)
+        self.total = len(self.logics)
+        self.completed = 0
+        self.pending = [(0, position) for position in range(self.total)]
+        self.set_focus(focus_index)
+        if not self.pending:
+            self.finished.emit(False)
+            return
+        self._dispatch()
+
+    def set_focus(self, focus_index):
+        """Count the image at focus_index (a position in the started list) and its neighbours next."""
+        self.pending = [(abs(position - focus_index), position) for _, position in self.pending]
+        heapq.heapify(self.pending)
+
+    def cancel(self):
+        if self.cancel_event.is_set() or not self.is_running():
+            return
+        logging.info("Cancelling blob counting, waiting for running batches to finish...")
+        self.cancel_event.set()
+        self.pending.clear()
+        if not self.running_tasks:
+            self.finished.emit(True)
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def is_running(self):
+        return bool(self.running_tasks or self.pending)
+
+    def _next_batch(self):
+        distance, position = heapq.heappop(self.pending)
+        batch = [self.logics[position]]
+        if distance == 0:
+            return batch  # The plate on screen goes alone
+        while self.pending and len(batch) < self.batch_size:
+            batch.append(self.logics[heapq.heappop(self.pending)[1]])
+        return batch
+
+    def _dispatch(self):
+        while self.pending and len(self.running_tasks) < self.max_concurrency and not self.cancel_event.is_set():
+            task = BlobCounterTask(self._next_batch(), self.blob_counter, self.batch_size, self.cancel_event)
+            task.signals.image_counted.connect(self._handle_image_counted)
+            task.signals.image_failed.connect(self._handle_image_failed)
+            task.signals.finished.connect(self._handle_task_finished)
+            self.running_tasks.add(task)
+            self.thread_pool.start(task)
+
+    def _handle_image_counted(self, logic, keypoints):
+        self.apply_keypoints(logic, keypoints)
+        self.completed += 1
+        self.image_counted.emit(logic, len(logic.keypoints))  # The count on the plate, which may have kept its edits
+        self.progress.emit(self.completed, self.total)
+
+    def _handle_image_failed(self, logic, message):
+        self.errors.append((logic.image_path, message))
+        self.completed += 1
+        self.image_failed.emit(logic, message)
+        self.progress.emit(self.completed, self.total)
+
+    def _handle_task_finished(self, task):
+        self.running_tasks.discard(task)
+        self._dispatch()
+        if not self.running_tasks and not self.pending:
+            self.finished.emit(self.cancel_event.is_set())
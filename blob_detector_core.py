@@ -0,0 +1,304 @@
+import json
+import logging
+import os
+import re
+
+import cv2
+import numpy as np
+
+import logger
+from detection_cache import hash_file, hash_image
+from image_cache import IMAGE_CACHE
+from image_loader import IMAGE_PREFETCHER, decode_image, resize_and_crop
+from instrumentation import PROFILER
+from keypoint_store import KeypointStore
+from utils import CIRCLE_COLOR, CIRCLE_THICKNESS, DEFAULT_DILUTION, USE_DAY, Timepoint, USE_DILUTION, \
+    DEFAULT_TARGET_IMAGE_SIZE, DEFAULT_INFERENCE_BATCH_SIZE
+
+
+def draw_keypoints(image, keypoints: KeypointStore):
+    image_with_keypoints = image.copy()
+    columns = keypoints.columns()
+    centers = np.stack((columns["x"], columns["y"]), axis=1).astype(np.int32).tolist()
+    radii = (columns["size"] / 2).astype(np.int32).tolist()
+    for center, radius in zip(centers, radii):
+        cv2.circle(image_with_keypoints, center, radius, CIRCLE_COLOR, CIRCLE_THICKNESS)
+    return image_with_keypoints
+
+
+def count_cores(cores, blob_counter, batch_size=DEFAULT_INFERENCE_BATCH_SIZE, on_error=None):
+    """
+    Count several plates with one counter. Plates whose results are in the detection cache are served from it
+    without decoding their image; the rest are decoded and counted in batches.
+    :param on_error: Called as on_error(core, exception) for plates that fail. Errors are raised if it is None.
+    :return: One KeypointStore per plate, or None for plates that failed.
+    """
+    def handle_error(core, error):
+        if on_error is None:
+            raise error
+        on_error(core, error)
+
+    keypoints_per_core = [None] * len(cores)
+    misses = []  # (index, image hash, preprocessing settings)
+    for i, core in enumerate(cores):
+        try:
+            with PROFILER().stage("hash_file", image=core.image_path):
+                image_hash = core.content_hash()
+            preprocessing = core.preprocessing_settings()
+            with PROFILER().stage("detection_cache_lookup", image=core.image_path):
+                keypoints_per_core[i] = blob_counter.lookup_cached_keypoints(image_hash, preprocessing)
+            if keypoints_per_core[i] is None:
+                misses.append((i, image_hash, preprocessing))
+        except Exception as e:
+            handle_error(core, e)
+
+    # Decode all misses in parallel, the loop below then picks the images up from the cache as they finish
+    IMAGE_PREFETCHER().prefetch([cores[i] for i, _, _ in misses])
+    pending = {}  # Preprocessing settings -> list of (index, image, image hash)
+    for i, image_hash, preprocessing in misses:
+        try:
+            pending.setdefault(json.dumps(preprocessing, sort_keys=True), []).append((i, cores[i].image, image_hash))
+        except Exception as e:
+            handle_error(cores[i], e)
+
+    for preprocessing, items in pending.items():
+        preprocessing = json.loads(preprocessing)
+        try:
+            results = blob_counter.count_blobs_batch([image for _, image, _ in items], batch_size=batch_size,
+                                                     preprocessing=preprocessing,
+                                                     image_hashes=[image_hash for _, _, image_hash in items],
+                                                     lookup_cache=False)
+        except Exception as e:
+            if len(items) == 1:
+                handle_error(cores[items[0][0]], e)
+                continue
+            # Retry one image at a time so a single bad plate does not fail the whole batch
+            logging.warning(f"Batched counting failed ({e}), counting images individually...")
+            results = []
+            for i, image, image_hash in items:
+                try:
+                    results.append(blob_counter.count_blobs(image, preprocessing=preprocessing, image_hash=image_hash))
+                except Exception as e:
+                    handle_error(cores[i], e)
+                    results.append(None)
+        for (i, _, _), keypoints in zip(items, results):
+            keypoints_per_core[i] = keypoints
+    return keypoints_per_core
+
+
+class BlobDetectorCore:
+    """
+    Qt-free state and processing for a single plate image: loading, preprocessing, blob detection and parsing of
+    the day/sample/dilution metadata encoded in the file and folder names. BlobDetectorLogic wraps this for the GUI,
+    and the batch mode uses it directly so counting never needs PySide6.
+    """
+
+    def __init__(self, image_path: str = None, blob_counter=None, load_image=True):
+        self.image_path = image_path
+        self.target_size = DEFAULT_TARGET_IMAGE_SIZE
+        self._image = None  # Only used for images without a path, pixels of files live in the shared image cache
+        self.keypoints = KeypointStore()
+        self.timepoint = None
+        self.custom_name = None
+        self.day_num = -1
+        self.sample_number = -1
+        self.dilution = None
+        self._blob_counter = blob_counter
+        self._owns_blob_counter = False  # True for the default counter created on first use, closed by close()
+        if image_path is not None:
+            if load_image:
+                self.load_image()
+            self.custom_name = self.get_custom_name()
+            self.update_timepoint()
+
+    @property
+    def blob_counter(self):
+        if self._blob_counter is None:
+            # Imported here so metadata parsing does not pull in torch
+            from blob_counter import YOLOBlobCounter
+            self._blob_counter = YOLOBlobCounter()
+            self._owns_blob_counter = True
+        return self._blob_counter
+
+    @blob_counter.setter
+    def blob_counter(self, blob_counter):
+        self.close()
+        self._blob_counter = blob_counter
+
+    def close(self):
+        """Release the default counter if this core created one, counters passed in belong to the caller."""
+        if self._owns_blob_counter:
+            self._blob_counter.close()
+            self._blob_counter = None
+            self._owns_blob_counter = False
+
+    @property
+    def image(self):
+        # Pixels are fetched from the shared image cache and decoded on a miss, so a record can exist without them
+        if self.image_path is None:
+            return self._image
+        return IMAGE_CACHE().get(self.image_cache_key(), self.decode_image)
+
+    @image.setter
+    def image(self, image):
+        if self.image_path is None:
+            self._image = image
+        elif image is None:
+            self.unload_image()
+        else:
+            IMAGE_CACHE().invalidate(self.image_cache_key())
+            IMAGE_CACHE().put(self.image_cache_key(), image)
+
+    def image_cache_key(self):
+        return self.image_path, self.target_size
+
+    def is_image_loaded(self):
+        if self.image_path is None:
+            return self._image is not None
+        return IMAGE_CACHE().contains(self.image_cache_key())
+
+    def resize_and_crop(self, image):
+        return resize_and_crop(image, self.target_size)
+
+    def decode_image(self):
+        return decode_image(self.image_path, self.target_size)
+
+    def load_image(self):
+        return self.image
+
+    def unload_image(self):
+        if self.image_path is None:
+            self._image = None
+        else:
+            IMAGE_CACHE().invalidate(self.image_cache_key())
+
+    def update_timepoint(self):
+        self.timepoint = Timepoint(day=self.day_num, sample_number=self.sample_number, dilution=self.dilution,
+                                   num_keypoints=len(self.keypoints), filename=self.image_path)
+
+    def get_timepoint(self) -> Timepoint:
+        return self.timepoint
+
+    def content_hash(self):
+        return hash_file(self.image_path) if self.image_path is not None else hash_image(self.image)
+
+    def preprocessing_settings(self):
+        return {"target_size": self.target_size}
+
+    def detect_blobs(self):
+        self.set_keypoints(count_cores([self], self.blob_counter, batch_size=1)[0])
+
+    def set_keypoints(self, keypoints):
+        if not isinstance(keypoints, KeypointStore):
+            keypoints = KeypointStore.from_keypoints(keypoints)
+        self.keypoints = keypoints
+        self.update_timepoint()
+
+    def get_dilution_string(self, dilution_str: str, default_dilution: str):
+        if dilution_str.find("1st") != -1:
+            self.dilution = "x10"
+            return "x10 dilution"
+        elif dilution_str.find("2nd") != -1:
+            self.dilution = "x100"
+            return "x100 dilution"
+        elif dilution_str.find("3rd") != -1:
+            self.dilution = "x1000"
+            return "x1000 dilution"
+        else:
+            return 0, self.get_dilution_string(default_dilution, default_dilution)
+
+    def handle_dilution_string(self, dilution_str: str, default_dilution: str) -> str:
+        if USE_DILUTION:
+            dilution_string = self.get_dilution_string(dilution_str, default_dilution)
+            if isinstance(dilution_string, tuple):
+                # failed to find dilution
+                logging.warning(f"{dilution_str} is not a valid dilution string")
+                return f" - {dilution_string[1]}"
+            else:
+                return f" - {dilution_string}"
+        else:
+            return ""
+
+    def parse_day_number(self, day_num_str: str):
+        index = 0
+        while day_num_str[:index + 1].isdigit():
+            index += 1
+        self.day_num = int(day_num_str[:index])
+        return self.day_num
+
+    def check_if_int(self, string):
+        try:
+            int(string)
+            return True
+        except ValueError:
+            return False
+
+    def handle_sample_number(self, sample_number_str: str):
+        if sample_number_str.isdigit():
+            self.sample_number = int(sample_number_str)
+            return f"Sample {self.sample_number}"
+
+    def handle_day_src(self, day_source) -> str:
+        day_string = ""
+        if USE_DAY:
+            if isinstance(day_source, list):
+                day_string = day_source[0]
+            elif isinstance(day_source, str):
+                m = re.search(r'(?<=Day )[0-9]{1,3}', day_source)
+                if m:
+                    day_string = m.group(0)
+                    self.day_num = int(day_string)
+            else:
+                logger.LOGGER().warning(
+                    "Day source is incorrect type - expected list or string - not including day in timepoint display name...")
+                logger.LOGGER().warning("Day source type: %s", type(day_source))
+                return day_string
+            if self.check_if_int(day_string):
+                self.day_num = int(day_string)
+                return f"Day {day_string} - "
+            else:
+                logger.LOGGER().warning(
+                    "Unable to parse day string - NOT AN INTEGER - not including day in timepoint display name...")
+                return ""
+        return day_string
+
+    def get_custom_name(self, default_dilution=DEFAULT_DILUTION):
+        if self.custom_name is None:
+            if self.image_path is None:
+                return ""
+            basename = os.path.basename(self.image_path)
+            if basename.upper().endswith("LABEL.JPG"):
+                logger.LOGGER().info("Skipping label image...")
+                return basename
+            parts = basename.split('_')
+            folder_name = os.path.basename(os.path.dirname(self.image_path))
+            str_val = ""
+            if len(parts) == 2 or (len(parts) == 3 and parts[2].find("dilution") != -1):
+                str_val += self.handle_day_src(folder_name)
+                str_val += self.handle_sample_number(parts[0])
+                str_val += self.handle_dilution_string(parts[1], default_dilution)
+
+            elif len(parts) == 3 or (len(parts) == 4 and parts[3].find("dilution") != -1):
+                day_string = self.handle_day_src(parts)
+                if day_string == "":
+                    day_string = self.handle_day_src(folder_name)
+                str_val += day_string
+                str_val += self.handle_sample_number(parts[1])
+                str_val += self.handle_dilution_string(parts[2], default_dilution)
+            else:
+                logger.LOGGER().warning("Unable to parse image name - using file name...")
+                day_string = self.handle_day_src(folder_name)
+                str_val += day_string
+                str_val = os.path.basename(self.image_path)
+            self.custom_name = str_val
+            return str_val
+        else:
+            return self.custom_name
+
+    def get_display_image(self):
+        image = self.image
+        with PROFILER().stage("draw_keypoints", image=self.image_path):
+            return draw_keypoints(image, self.keypoints)
+
+    def get_keypoint_count(self):
+        return len(self.keypoints)
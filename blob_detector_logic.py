@@ -1,250 +1,241 @@
+import itertools
 import logging
-import os
-import re
 
-import cv2
-import numpy as np
 from PySide6 import QtCore
 from PySide6.QtCore import QObject
 
-import logger
+from blob_detector_core import BlobDetectorCore, count_cores
 from blob_detector_ui import BlobDetectorUI
-from undo_redo_tracker import ActionType, UndoRedoTracker, Action
-from utils import DEFAULT_MIN_AREA, DEFAULT_MIN_CIRCULARITY, DEFAULT_MAX_AREA, DEFAULT_MIN_CONVEXITY, \
-    DEFAULT_MIN_INERTIA_RATIO, DEFAULT_BLOB_COLOR, MIN_DISTANCE_BETWEEN_BLOBS, DEFAULT_MIN_THRESHOLD, \
-    DEFAULT_MAX_THRESHOLD, CIRCLE_COLOR, CIRCLE_THICKNESS, DEFAULT_DILUTION, USE_DAY, Timepoint, USE_DILUTION, \
-    NEW_KEYPOINT_SIZE
-from blob_counter import YOLOBlobCounter
+from instrumentation import PROFILER
+from keypoint_index import KeypointIndex
+from keypoint_store import SOURCE_MANUAL, SOURCE_DETECTED
+from undo_redo_tracker import ActionType, UndoRedoTracker, Action, CompoundAction, ReplaceAction
+from utils import DEFAULT_DILUTION, NEW_KEYPOINT_SIZE
+from blob_counter import SimpleBlobCounter, create_blob_detector_params
+
+
+def _core_attribute(name):
+    return property(lambda self: getattr(self.core, name), lambda self, value: setattr(self.core, name, value))
+
 
 class BlobDetectorLogic(QObject):
 
-    keypoints_changed = QtCore.Signal(int)
+    keypoints_changed = QtCore.Signal(int)  # The whole keypoint list was replaced
+    keypoint_added = QtCore.Signal(int)  # Store id of a single added keypoint, the viewer only draws that one
+    keypoint_removed = QtCore.Signal(int)  # Store id of a single removed keypoint
+    keypoints_added = QtCore.Signal(object)  # Store ids of the keypoints added by one region edit or undo step
+    keypoints_removed = QtCore.Signal(object)  # Store ids of the keypoints removed by one region edit or undo step
 
-    def __init__(self, blob_detector_ui: BlobDetectorUI, image_path: str=None, image_set_reader=None):
+    # Image state and metadata live in the Qt-free BlobDetectorCore
+    image_path = _core_attribute("image_path")
+    image = _core_attribute("image")
+    keypoints = _core_attribute("keypoints")
+    timepoint = _core_attribute("timepoint")
+    custom_name = _core_attribute("custom_name")
+    day_num = _core_attribute("day_num")
+    sample_number = _core_attribute("sample_number")
+    dilution = _core_attribute("dilution")
+    yolo_blob_counter = _core_attribute("blob_counter")
+
+    def __init__(self, blob_detector_ui: BlobDetectorUI, image_path: str=None, image_set_reader=None,
+                 core: BlobDetectorCore=None):
         super().__init__()
         self.image_set_reader = image_set_reader # Not touchable from multi-thread-called functions
         self.blob_detector_ui = blob_detector_ui # Not touchable from multi-thread-called functions
         self.undo_redo_tracker = UndoRedoTracker()
-        self.timepoint = None
-        self.image_path = image_path
-        self.image = None
-        self.gray_image = None
-        self.keypoints = []
         self.contours = []
-        self.params = self.create_blob_detector_params()
-        self.yolo_blob_counter = YOLOBlobCounter(model_path="yolo11x.pt")  # Path to YOLO model weights
-        self.custom_name = None
-        self.day_num = -1
-        self.sample_number = -1
-        self.dilution = None
-        if image_path is not None:
-            self.load_image()
-            self.convert_to_grayscale()
-            self.custom_name = self.get_custom_name()
-            self.update_timepoint()
+        # Plates of an image set share its counter, a standalone plate gets a default counter on its first count
+        self.core = core if core is not None else BlobDetectorCore(
+            image_path, blob_counter=image_set_reader.blob_counter if image_set_reader is not None else None)
         self.new_keypoint_size = NEW_KEYPOINT_SIZE  # Default size for new keypoints
+        self._keypoint_index = KeypointIndex()
+        self._indexed_keypoints = None  # The keypoint store the index was built from
+
+    @property
+    def keypoint_index(self):
+        # Rebuilt whenever the core's keypoint store was replaced, e.g. by counting, edits keep it in sync otherwise
+        if self._indexed_keypoints is not self.keypoints:
+            self._keypoint_index.rebuild(self.keypoints)
+            self._indexed_keypoints = self.keypoints
+        return self._keypoint_index
 
     def resize_and_crop(self, image):
-        # Resize so height is 1024
-        h, w = image.shape[:2]
-        scale = 1024 / h
-        new_w = int(w * scale)
-        resized = cv2.resize(image, (new_w, 1024), interpolation=cv2.INTER_AREA)
-        # Crop width to 1024, centered
-        start_x = max((new_w - 1024) // 2, 0)
-        cropped = resized[:, start_x:start_x + 1024]
-        return cropped
+        return self.core.resize_and_crop(image)
 
     def load_image(self):
-        self.image = cv2.imread(self.image_path, 1)
-        if self.image is None:
-            raise FileNotFoundError(f"Image not found at path: {self.image_path}")
-        self.image = self.resize_and_crop(self.image)
+        self.core.load_image()
 
     def update_timepoint(self):
-        self.timepoint = Timepoint(day=self.day_num, sample_number=self.sample_number, dilution=self.dilution,
-                                   num_keypoints=len(self.keypoints), filename=self.image_path)
-    def get_timepoint(self) -> Timepoint:
-        # self.update_timepoint() # This is not necessary
-        return self.timepoint
+        self.core.update_timepoint()
 
-    def convert_to_grayscale(self):
-        self.gray_image = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+    def get_timepoint(self):
+        # self.update_timepoint() # This is not necessary
+        return self.core.get_timepoint()
 
     def create_blob_detector_params(self):
-        params = cv2.SimpleBlobDetector_Params()
-        params.filterByArea = True
-        params.minArea = DEFAULT_MIN_AREA
-        params.maxArea = DEFAULT_MAX_AREA
-        params.filterByCircularity = True
-        params.minCircularity = DEFAULT_MIN_CIRCULARITY
-        params.filterByConvexity = True
-        params.minConvexity = DEFAULT_MIN_CONVEXITY
-        params.filterByInertia = True
-        params.minInertiaRatio = DEFAULT_MIN_INERTIA_RATIO
-        params.filterByColor = False
-        params.blobColor = DEFAULT_BLOB_COLOR
-        params.minDistBetweenBlobs = MIN_DISTANCE_BETWEEN_BLOBS
-        params.minThreshold = DEFAULT_MIN_THRESHOLD
-        params.maxThreshold = DEFAULT_MAX_THRESHOLD
-        return params
+        return create_blob_detector_params(self.get_detection_settings())
+
+    def uses_detection_settings(self):
+        """True if the plate is counted by a backend driven by the parameter sliders."""
+        return isinstance(self.yolo_blob_counter, SimpleBlobCounter)
+
+    def get_detection_settings(self):
+        return dict(self.yolo_blob_counter.settings) if self.uses_detection_settings() else {}
+
+    def set_detection_setting(self, name, value):
+        """Change one detector setting for the whole image set and recount this plate with it."""
+        if not self.uses_detection_settings():
+            return
+        self.yolo_blob_counter.set_settings(**{name: value})
+        self.detect_blobs()
+
+    def content_hash(self):
+        return self.core.content_hash()
+
+    def preprocessing_settings(self):
+        return self.core.preprocessing_settings()
 
     def detect_blobs(self):
         # logging.debug(self.detector)
         # Use YOLOBlobCounter for blob detection
-        self.keypoints = self.yolo_blob_counter.count_blobs(self.image)
-        self.update_timepoint()
+        with PROFILER().stage("detect_blobs", image=self.image_path):
+            keypoints = count_cores([self.core], self.yolo_blob_counter, batch_size=1)[0]
+        self.set_keypoints(keypoints)
+
+    def set_keypoints(self, keypoints):
+        """Replace all keypoints, e.g. with a recount, as one undo step that brings back the edited keypoints."""
+        previous = self.keypoints
+        self.core.set_keypoints(keypoints)
+        # Recorded ids keep referring to the store they were made in, which undoing the replacement brings back
+        if len(previous) or self.undo_redo_tracker.undo_stack:
+            self.undo_redo_tracker.perform_action(ReplaceAction(previous, self.keypoints))
         self.keypoints_changed.emit(len(self.keypoints))  # Ensure this signal is emitted
 
+    def close(self):
+        self.core.close()
 
     def update_blob_count(self):
-        self.yolo_blob_counter = YOLOBlobCounter(model_path="yolo11x.pt")
-        self.update_timepoint()
-        self.keypoints_changed.emit(len(self.keypoints))
-
-    def get_dilution_string(self, dilution_str: str, default_dilution: str):
-        if dilution_str.find("1st") != -1:
-            self.dilution = "x10"
-            return "x10 dilution"
-        elif dilution_str.find("2nd") != -1:
-            self.dilution = "x100"
-            return "x100 dilution"
-        elif dilution_str.find("3rd") != -1:
-            self.dilution = "x1000"
-            return "x1000 dilution"
-        else:
-            return 0, self.get_dilution_string(default_dilution, default_dilution)
-
-    def handle_dilution_string(self, dilution_str: str, default_dilution: str) -> str:
-        if USE_DILUTION:
-            dilution_string = self.get_dilution_string(dilution_str, default_dilution)
-            if isinstance(dilution_string, tuple):
-                # failed to find dilution
-                logging.warning(f"{dilution_str} is not a valid dilution string")
-                return f" - {dilution_string[1]}"
-            else:
-                return f" - {dilution_string}"
-        else:
-            return ""
-
-    def parse_day_number(self, day_num_str: str):
-        index = 0
-        while day_num_str[:index + 1].isdigit():
-            index += 1
-        self.day_num = int(day_num_str[:index])
-        return self.day_num
-
-    def check_if_int(self, string):
-        try:
-            int(string)
-            return True
-        except ValueError:
-            return False
-
-    def handle_sample_number(self, sample_number_str: str):
-        if sample_number_str.isdigit():
-            self.sample_number = int(sample_number_str)
-            return f"Sample {self.sample_number}"
-
-    def handle_day_src(self, day_source) -> str:
-        day_string = ""
-        if USE_DAY:
-            if isinstance(day_source, list):
-                day_string = day_source[0]
-            elif isinstance(day_source, str):
-                m = re.search(r'(?<=Day )[0-9]{1,3}', day_source)
-                if m:
-                    day_string = m.group(0)
-                    self.day_num = int(day_string)
-            else:
-                logger.LOGGER().warning(
-                    "Day source is incorrect type - expected list or string - not including day in timepoint display name...")
-                logger.LOGGER().warning("Day source type: %s", type(day_source))
-                return day_string
-            if self.check_if_int(day_string):
-                self.day_num = int(day_string)
-                return f"Day {day_string} - "
-            else:
-                logger.LOGGER().warning(
-                    "Unable to parse day string - NOT AN INTEGER - not including day in timepoint display name...")
-                return ""
-        return day_string
+        self.detect_blobs()
 
     def get_custom_name(self, default_dilution=DEFAULT_DILUTION):
-        if self.custom_name is None:
-            if self.image_path is None:
-                return ""
-            basename = os.path.basename(self.image_path)
-            if basename.upper().endswith("LABEL.JPG"):
-                logger.LOGGER().info("Skipping label image...")
-                return basename
-            parts = basename.split('_')
-            folder_name = os.path.basename(os.path.dirname(self.image_path))
-            str_val = ""
-            if len(parts) == 2 or (len(parts) == 3 and parts[2].find("dilution") != -1):
-                str_val += self.handle_day_src(folder_name)
-                str_val += self.handle_sample_number(parts[0])
-                str_val += self.handle_dilution_string(parts[1], default_dilution)
-
-            elif len(parts) == 3 or (len(parts) == 4 and parts[3].find("dilution") != -1):
-                day_string = self.handle_day_src(parts)
-                if day_string == "":
-                    day_string = self.handle_day_src(folder_name)
-                str_val += day_string
-                str_val += self.handle_sample_number(parts[1])
-                str_val += self.handle_dilution_string(parts[2], default_dilution)
-            else:
-                logger.LOGGER().warning("Unable to parse image name - using file name...")
-                day_string = self.handle_day_src(folder_name)
-                str_val += day_string
-                str_val = os.path.basename(self.image_path)
-            self.custom_name = str_val
-            return str_val
-        else:
-            return self.custom_name
+        return self.core.get_custom_name(default_dilution)
 
     def get_display_image(self):
-        image_with_keypoints = self.image.copy()
-        for keypoint in self.keypoints:
-            x, y = keypoint.pt
-            radius = int(keypoint.size / 2)
-            cv2.circle(image_with_keypoints, (int(x), int(y)), radius, CIRCLE_COLOR, CIRCLE_THICKNESS)
-        return image_with_keypoints
+        return self.core.get_display_image()
 
     def get_keypoint_count(self):
         return len(self.keypoints)
 
+    def restore_keypoint(self, keypoint_id):
+        self.keypoints.restore(keypoint_id)
+        x, y = self.keypoints.point(keypoint_id)
+        self.keypoint_index.insert(keypoint_id, x, y, float(self.keypoints.size[keypoint_id]))
+        self.keypoint_added.emit(keypoint_id)
+
+    def discard_keypoint(self, keypoint_id):
+        self.keypoints.remove(keypoint_id)
+        self.keypoint_index.remove(keypoint_id)
+        self.keypoint_removed.emit(keypoint_id)
+
+    def restore_keypoints(self, keypoint_ids):
+        keypoint_index = self.keypoint_index  # Built before the store changes so the keypoints are inserted once
+        keypoint_ids = self.keypoints.restore_many(keypoint_ids).tolist()
+        for keypoint_id in keypoint_ids:
+            x, y = self.keypoints.point(keypoint_id)
+            keypoint_index.insert(keypoint_id, x, y, float(self.keypoints.size[keypoint_id]))
+        self.keypoints_added.emit(keypoint_ids)
+
+    def discard_keypoints(self, keypoint_ids):
+        keypoint_index = self.keypoint_index
+        keypoint_ids = self.keypoints.remove_many(keypoint_ids).tolist()
+        for keypoint_id in keypoint_ids:
+            keypoint_index.remove(keypoint_id)
+        self.keypoints_removed.emit(keypoint_ids)
+
     def add_keypoint(self, x, y):
-        keypoint = cv2.KeyPoint(x, y, self.new_keypoint_size)
-        self.keypoints.append(keypoint)
-        self.undo_redo_tracker.perform_action(Action(ActionType.ADD, keypoint))
-
-    def remove_keypoint(self, keypoint):
-        if keypoint and hasattr(keypoint, 'pt') and len(keypoint.pt) == 2:
-            self.keypoints.remove(keypoint)
-            self.undo_redo_tracker.perform_action(Action(ActionType.REMOVE, keypoint))
+        keypoint_id = self.keypoints.add(x, y, self.new_keypoint_size, source=SOURCE_MANUAL)
+        self.keypoint_index.insert(keypoint_id, x, y, self.new_keypoint_size)
+        self.keypoint_added.emit(keypoint_id)
+        self.undo_redo_tracker.perform_action(Action(ActionType.ADD, keypoint_id))
+
+    def remove_keypoint(self, keypoint_id):
+        if keypoint_id is not None and keypoint_id in self.keypoints:
+            self.discard_keypoint(keypoint_id)
+            self.undo_redo_tracker.perform_action(Action(ActionType.REMOVE, keypoint_id))
         else:
-            logging.error("Invalid keypoint: %s", keypoint)
+            logging.error("Invalid keypoint: %s", keypoint_id)
 
     def update_displayed_keypoints(self, keypoints):
+        # The viewer already redrew the changed keypoint through keypoint_added/keypoint_removed
         self.blob_detector_ui.update_keypoint_count_label(len(self.keypoints))
-        self.blob_detector_ui.update_display_image()
         if self.image_set_reader:
             self.image_set_reader.update_displayed_blob_count(len(self.keypoints))
 
     def add_or_remove_keypoint(self, x, y):
-        for keypoint in self.keypoints:
-            kp_x, kp_y = keypoint.pt
-            radius = keypoint.size / 2
-            if (x - kp_x) ** 2 + (y - kp_y) ** 2 <= radius ** 2:
-                self.remove_keypoint(keypoint)
-                self.update_timepoint()
-                self.update_displayed_keypoints(self.keypoints)
-                return
+        keypoint_id = self.keypoint_index.find_containing(x, y)
+        if keypoint_id is not None:
+            self.remove_keypoint(keypoint_id)
+            self.update_timepoint()
+            self.update_displayed_keypoints(self.keypoints)
+            return
         self.add_keypoint(x, y)
         self.update_timepoint()
         self.update_displayed_keypoints(self.keypoints)
 
+    def edit_keypoints_in_region(self, polygon, restore=False):
+        """
+        Remove every keypoint inside a rectangle or lasso selection, or with restore=True bring back the removed
+        detections inside it. The whole edit is a single undo step and the counts are updated once.
+        :param polygon: Sequence of (x, y) image coordinates, implicitly closed.
+        :return: Number of keypoints removed or restored.
+        """
+        if restore:
+            keypoint_ids = self.keypoints.select_in_polygon(polygon, removed=True, source=SOURCE_DETECTED)
+            action_type = ActionType.ADD
+        else:
+            keypoint_ids = self.keypoints.select_in_polygon(polygon)
+            action_type = ActionType.REMOVE
+        if len(keypoint_ids) == 0:
+            return 0
+        actions = tuple(Action(action_type, keypoint_id) for keypoint_id in keypoint_ids.tolist())
+        self.apply_action(CompoundAction(actions), undo=False)
+        with self.undo_redo_tracker.transaction():
+            for action in actions:
+                self.undo_redo_tracker.perform_action(action)
+        self.update_timepoint()
+        self.update_displayed_keypoints(self.keypoints)
+        return len(keypoint_ids)
+
+    def apply_action(self, action, undo):
+        if isinstance(action, CompoundAction):
+            sub_actions = reversed(action.actions) if undo else action.actions
+            # Consecutive keypoint actions with the same effect, e.g. a region edit, are applied and redrawn at once
+            for restores, run in itertools.groupby(sub_actions, key=lambda sub_action: self.restores(sub_action, undo)):
+                if restores is None:
+                    for sub_action in run:
+                        self.apply_action(sub_action, undo)
+                elif restores:
+                    self.restore_keypoints([keypoint_id for _, keypoint_id in run])
+                else:
+                    self.discard_keypoints([keypoint_id for _, keypoint_id in run])
+            return
+        if isinstance(action, ReplaceAction):
+            self.core.set_keypoints(action.old if undo else action.new)
+            self.keypoints_changed.emit(len(self.keypoints))
+            return
+        if self.restores(action, undo):
+            self.restore_keypoint(action.keypoint)
+        else:
+            self.discard_keypoint(action.keypoint)
+
+    @staticmethod
+    def restores(action, undo):
+        """True if applying a keypoint action brings its keypoint back, None if it is not on a single keypoint."""
+        if not isinstance(action, Action):
+            return None
+        # Undoing an add and redoing a remove both take the keypoint away
+        return (action.action_type == ActionType.ADD) != undo
+
     def handle_undo_redo(self, event):
         undo = False
         action = None
@@ -255,17 +246,7 @@ class BlobDetectorLogic(QObject):
             action = self.undo_redo_tracker.undo()
             undo = True
         if action is not None:
-            action_type, keypoint = action
-            if undo:
-                if action_type == ActionType.ADD:
-                    self.keypoints.remove(keypoint)
-                else:
-                    self.keypoints.append(keypoint)
-            else:
-                if action_type == ActionType.ADD:
-                    self.keypoints.append(keypoint)
-                else:
-                    self.keypoints.remove(keypoint)
+            self.apply_action(action, undo)
             self.update_timepoint()
             self.update_displayed_keypoints(self.keypoints)
             return True
@@ -2,15 +2,24 @@ import logging
 
 import cv2
 from PySide6.QtCore import Qt, QEvent, Signal, QPointF
-from PySide6.QtGui import QImage, QPixmap, QWheelEvent, QKeyEvent, QIcon, QMouseEvent
+from PySide6.QtGui import QImage, QPixmap, QWheelEvent, QKeyEvent, QIcon, QMouseEvent, QPen, QColor, QPainterPath, \
+    QPolygonF
 from PySide6.QtWidgets import QWidget, QVBoxLayout, QLabel, QPushButton, QCheckBox, \
-    QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QGestureEvent, QGesture, QApplication
+    QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QGestureEvent, QGesture, QApplication, QGraphicsEllipseItem, \
+    QGraphicsPathItem, QGroupBox, QGridLayout
 
+from instrumentation import PROFILER
 from ui_utils import UIUtils
 from utils import GRAPHICS_VIEW_WIDTH, GRAPHICS_VIEW_HEIGHT, MIN_SCALE_FACTOR, MAX_SCALE_FACTOR, \
-    DEFAULT_KEYPOINT_SIZE_ADJUSTMENT_STEP
+    DEFAULT_KEYPOINT_SIZE_ADJUSTMENT_STEP, CIRCLE_COLOR, CIRCLE_THICKNESS
 
 TOUCHSCREEN_MODE = False
+SELECTION_RECTANGLE = "rectangle"
+SELECTION_LASSO = "lasso"
+PERCENTAGE_SETTINGS = {"min_circularity", "min_convexity", "min_inertia_ratio"}  # Sliders show these as 0-100
+# The other settings only re-filter cached component statistics, so the count can follow those sliders while they are
+# dragged. A new threshold has to be measured first, so threshold sliders recount when released.
+THRESHOLD_SETTINGS = {"min_threshold", "max_threshold"}
 
 class BlobDetectorUI(QWidget):
     keypoints_changed = Signal(int)
@@ -25,17 +34,71 @@ class BlobDetectorUI(QWidget):
         else:
             self.blob_detector_logic = BlobDetectorLogic(self, image_path=image_path)
             self.image_set_reader = None
+        self.blank_blob_detector_logic = self.blob_detector_logic if not image_path else None
+        self.base_pixmap_key = None  # Image the pixmap item currently shows, it is only rebuilt when this changes
+        self.keypoint_items = {}  # Keypoint store id -> ellipse item drawn over the plate
+        blue, green, red = CIRCLE_COLOR
+        self.keypoint_pen = QPen(QColor(red, green, blue), CIRCLE_THICKNESS)
         self.current_scale_factor = 1.0
         self.is_dragging = False
         self.mouse_is_pressed = False
         self.mouse_press_position = QPointF()
+        self.selection_mode = None  # SELECTION_RECTANGLE or SELECTION_LASSO while a region is being dragged out
+        self.selection_restores = False
+        self.selection_points = []
+        self.selection_item = None
         self.initUI()
         if not image_path:
             self.disable_all_widgets()
             self.blob_detector_logic.image_set_reader = image_set_reader
+        self.connect_blob_detector_logic()
+
+    def connect_blob_detector_logic(self):
         self.blob_detector_logic.keypoints_changed.connect(self.update_display_image)
         self.blob_detector_logic.keypoints_changed.connect(self.update_keypoint_count_label)
         self.blob_detector_logic.keypoints_changed.connect(self.keypoints_changed)
+        self.blob_detector_logic.keypoint_added.connect(self.add_keypoint_item)
+        self.blob_detector_logic.keypoint_removed.connect(self.remove_keypoint_item)
+        self.blob_detector_logic.keypoints_added.connect(self.add_keypoint_items)
+        self.blob_detector_logic.keypoints_removed.connect(self.remove_keypoint_items)
+
+    def disconnect_blob_detector_logic(self):
+        self.blob_detector_logic.keypoints_changed.disconnect(self.update_display_image)
+        self.blob_detector_logic.keypoints_changed.disconnect(self.update_keypoint_count_label)
+        self.blob_detector_logic.keypoints_changed.disconnect(self.keypoints_changed)
+        self.blob_detector_logic.keypoint_added.disconnect(self.add_keypoint_item)
+        self.blob_detector_logic.keypoint_removed.disconnect(self.remove_keypoint_item)
+        self.blob_detector_logic.keypoints_added.disconnect(self.add_keypoint_items)
+        self.blob_detector_logic.keypoints_removed.disconnect(self.remove_keypoint_items)
+
+    def set_blob_detector_logic(self, blob_detector_logic):
+        """
+        Show a different plate in this viewer. Passing None shows the blank viewer again.
+        """
+        if blob_detector_logic is None:
+            blob_detector_logic = self.blank_blob_detector_logic
+        if blob_detector_logic is self.blob_detector_logic:
+            self.update_display_image()
+            return
+        if blob_detector_logic.image_path is not None and not blob_detector_logic.core.is_image_loaded():
+            # Decode before switching so a missing file leaves the current plate on screen
+            blob_detector_logic.load_image()
+        self.disconnect_blob_detector_logic()
+        self.blob_detector_logic = blob_detector_logic
+        self.blob_detector_logic.blob_detector_ui = self
+        self.connect_blob_detector_logic()
+        self.fitted = False
+        self.current_scale_factor = 1.0
+        if blob_detector_logic.image_path is None:
+            self.clear_keypoint_items()
+            self.pixmap_item.setPixmap(QPixmap())
+            self.base_pixmap_key = None
+            self.disable_all_widgets()
+            return
+        self.enable_all_widgets()
+        self.update_detection_settings_controls()
+        self.update_keypoint_count_label(len(blob_detector_logic.keypoints))
+        self.update_display_image()
 
     def initUI(self):
         self.setWindowTitle("Blob Detector")
@@ -45,24 +108,19 @@ class BlobDetectorUI(QWidget):
         self.keypoint_count_label = QLabel('Keypoints: 0')
         self.layout.addWidget(self.keypoint_count_label)
 
-        # sliders = UIUtils.create_blob_detector_sliders()
-        # self.min_area_group_box, self.min_area_slider, self.min_area_input = sliders['min_area']
-        # self.max_area_group_box, self.max_area_slider, self.max_area_input = sliders['max_area']
-        # self.min_circularity_group_box, self.min_circularity_slider, self.min_circularity_input = sliders[
-        #     'min_circularity']
-        # self.min_convexity_group_box, self.min_convexity_slider, self.min_convexity_input = sliders['min_convexity']
-        # self.min_inertia_ratio_group_box, self.min_inertia_ratio_slider, self.min_inertia_ratio_input = sliders[
-        #     'min_inertia_ratio']
-        # self.min_dist_between_blobs_group_box, self.min_dist_between_blobs_slider, self.min_dist_between_blobs_input = \
-        # sliders['min_dist_between_blobs']
-        #
-        # self.layout.addWidget(self.min_area_group_box)
-        # self.layout.addWidget(self.max_area_group_box)
-        # self.layout.addWidget(self.min_circularity_group_box)
-        # self.layout.addWidget(self.min_convexity_group_box)
-        # self.layout.addWidget(self.min_inertia_ratio_group_box)
-        # self.layout.addWidget(self.min_dist_between_blobs_group_box)
-        #
+        # Parameter sliders, only shown for backends driven by them (SimpleBlobCounter)
+        self.detection_settings_group_box = QGroupBox("Detection Parameters")
+        detection_settings_layout = QGridLayout(self.detection_settings_group_box)
+        self.detection_sliders = {}  # Setting name -> (slider, input field)
+        for position, (name, (group_box, slider, input_field)) in \
+                enumerate(UIUtils.create_blob_detector_sliders().items()):
+            detection_settings_layout.addWidget(group_box, position // 2, position % 2)
+            slider.setTracking(name not in THRESHOLD_SETTINGS)
+            slider.valueChanged.connect(lambda value, name=name: self.handle_detection_slider_changed(name, value))
+            self.detection_sliders[name] = (slider, input_field)
+        self.detection_settings_group_box.setVisible(False)
+        self.layout.addWidget(self.detection_settings_group_box)
+
         # self.gaussian_blur_checkbox = QCheckBox('Apply Gaussian Blur')
         # self.morphological_operations_checkbox = QCheckBox('Apply Morphological Operations')
         # self.layout.addWidget(self.gaussian_blur_checkbox)
@@ -90,7 +148,7 @@ class BlobDetectorUI(QWidget):
         self.graphics_view.viewport().grabGesture(Qt.GestureType.PinchGesture)
 
     def fit_in_view(self):
-        rect = self.graphics_scene.itemsBoundingRect()
+        rect = self.pixmap_item.sceneBoundingRect()
         self.graphics_view.setSceneRect(rect)
         self.graphics_view.resetTransform()
         scale_x = GRAPHICS_VIEW_WIDTH * 1.5 / rect.width()
@@ -102,43 +160,98 @@ class BlobDetectorUI(QWidget):
 
     def disable_all_widgets(self):
         self.keypoint_count_label.setEnabled(False)
-        # self.min_area_slider.setEnabled(False)
-        # self.min_area_input.setEnabled(False)
-        # self.max_area_slider.setEnabled(False)
-        # self.max_area_input.setEnabled(False)
-        # self.min_circularity_slider.setEnabled(False)
-        # self.min_circularity_input.setEnabled(False)
-        # self.min_convexity_slider.setEnabled(False)
-        # self.min_convexity_input.setEnabled(False)
-        # self.min_inertia_ratio_slider.setEnabled(False)
-        # self.min_inertia_ratio_input.setEnabled(False)
-        # self.min_dist_between_blobs_slider.setEnabled(False)
-        # self.min_dist_between_blobs_input.setEnabled(False)
+        self.detection_settings_group_box.setEnabled(False)
         # self.gaussian_blur_checkbox.setEnabled(False)
         # self.morphological_operations_checkbox.setEnabled(False)
         self.recount_button.setEnabled(False)
         self.graphics_view.setEnabled(False)
 
+    def enable_all_widgets(self):
+        self.keypoint_count_label.setEnabled(True)
+        self.detection_settings_group_box.setEnabled(True)
+        self.recount_button.setEnabled(True)
+        self.graphics_view.setEnabled(True)
+
+    def update_detection_settings_controls(self):
+        """Show the parameter sliders if the current plate's backend uses them and move them to its settings."""
+        uses_settings = self.blob_detector_logic.uses_detection_settings()
+        self.detection_settings_group_box.setVisible(uses_settings)
+        if not uses_settings:
+            return
+        settings = self.blob_detector_logic.get_detection_settings()
+        for name, (slider, input_field) in self.detection_sliders.items():
+            value = round(settings[name] * 100) if name in PERCENTAGE_SETTINGS else int(settings[name])
+            slider.blockSignals(True)
+            slider.setValue(value)
+            slider.blockSignals(False)
+            input_field.setText(str(value))
+
+    def handle_detection_slider_changed(self, name, value):
+        self.blob_detector_logic.set_detection_setting(name, value / 100 if name in PERCENTAGE_SETTINGS else value)
+
     def update_blob_count(self):
-        self.blob_detector_logic.update_blob_count()
-        self.update_display_image()
+        self.blob_detector_logic.update_blob_count()  # Redraws through keypoints_changed
         QApplication.processEvents()  # Process the event loop to update the UI
 
     def update_display_image(self):
+        """
+        Show the current plate and all of its keypoints. The plate pixmap is only converted when a different image is
+        shown, keypoints are separate scene items on top of it. Single edits go through add_keypoint_item and
+        remove_keypoint_item instead of this.
+        """
         if self.blob_detector_logic.image_path is None:
             return
-        image = self.blob_detector_logic.get_display_image()
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)  # Convert BGR to RGB
-        height, width, channel = image.shape
-        bytes_per_line = 3 * width
-        q_image = QImage(image.data, width, height, bytes_per_line, QImage.Format_RGB888)
-        pixmap = QPixmap.fromImage(q_image)
-        self.pixmap_item.setPixmap(pixmap)
-        self.graphics_scene.setSceneRect(0, 0, width, height)
+        self.update_base_pixmap()
+        with PROFILER().stage("qt_keypoint_items", image=self.blob_detector_logic.image_path,
+                              keypoints=len(self.blob_detector_logic.keypoints)):
+            self.clear_keypoint_items()
+            for keypoint_id in self.blob_detector_logic.keypoints.ids().tolist():
+                self.add_keypoint_item(keypoint_id)
         if not self.fitted:
             self.fit_in_view()
             self.fitted = True
 
+    def update_base_pixmap(self):
+        key = self.blob_detector_logic.core.image_cache_key()
+        if key == self.base_pixmap_key:
+            return
+        image = self.blob_detector_logic.image
+        with PROFILER().stage("qt_pixmap", image=self.blob_detector_logic.image_path):
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)  # Convert BGR to RGB
+            height, width, channel = image.shape
+            bytes_per_line = 3 * width
+            q_image = QImage(image.data, width, height, bytes_per_line, QImage.Format_RGB888)
+            self.pixmap_item.setPixmap(QPixmap.fromImage(q_image))
+        self.graphics_scene.setSceneRect(0, 0, width, height)
+        self.base_pixmap_key = key
+
+    def add_keypoint_item(self, keypoint_id):
+        keypoints = self.blob_detector_logic.keypoints
+        x, y = keypoints.point(keypoint_id)
+        radius = keypoints.radius(keypoint_id)
+        item = QGraphicsEllipseItem(x - radius, y - radius, 2 * radius, 2 * radius, self.pixmap_item)
+        item.setPen(self.keypoint_pen)
+        item.setAcceptedMouseButtons(Qt.MouseButton.NoButton)
+        self.keypoint_items[keypoint_id] = item
+
+    def remove_keypoint_item(self, keypoint_id):
+        item = self.keypoint_items.pop(keypoint_id, None)
+        if item is not None:
+            self.graphics_scene.removeItem(item)
+
+    def add_keypoint_items(self, keypoint_ids):
+        for keypoint_id in keypoint_ids:
+            self.add_keypoint_item(keypoint_id)
+
+    def remove_keypoint_items(self, keypoint_ids):
+        for keypoint_id in keypoint_ids:
+            self.remove_keypoint_item(keypoint_id)
+
+    def clear_keypoint_items(self):
+        for item in self.keypoint_items.values():
+            self.graphics_scene.removeItem(item)
+        self.keypoint_items.clear()
+
     def update_keypoint_count_label(self, count):
         self.keypoint_count_label.setText(f'Keypoints: {count}')
         QApplication.processEvents()
@@ -264,9 +377,14 @@ class BlobDetectorUI(QWidget):
                         and not self.is_dragging:
                     self.mouse_is_pressed = True
                     self.is_dragging = False
+                    self.start_selection(event)
                     return True
         elif event.type() == QEvent.Type.MouseMove:
             event = event if isinstance(event, QMouseEvent) else None
+            if self.mouse_is_pressed and self.selection_mode is not None:
+                self.is_dragging = True
+                self.update_selection(event.position())
+                return True
             if self.mouse_is_pressed and self.graphics_view.viewport().rect().contains(
                     self.graphics_view.mapFromGlobal(event.globalPosition().toPoint())):
                 self.is_dragging = True
@@ -280,7 +398,9 @@ class BlobDetectorUI(QWidget):
         elif event.type() == QEvent.Type.MouseButtonRelease:
             event = event if isinstance(event, QMouseEvent) else None
             if event.button() == Qt.MouseButton.LeftButton:
-                if not self.is_dragging and self.graphics_view.viewport().rect().contains(
+                if self.selection_mode is not None:
+                    self.finish_selection(apply=self.is_dragging)
+                elif not self.is_dragging and self.graphics_view.viewport().rect().contains(
                         self.graphics_view.mapFromGlobal(event.globalPosition().toPoint())):
                     self.add_or_remove_keypoint(event.position())
                 self.is_dragging = False
@@ -288,6 +408,59 @@ class BlobDetectorUI(QWidget):
                 return True
         return False
 
+    def start_selection(self, event: QMouseEvent):
+        """
+        Shift+drag selects a rectangle and Alt+drag draws a lasso. On release the keypoints inside are removed, or with
+        Ctrl/Cmd held as well the removed detections inside are restored.
+        """
+        modifiers = event.modifiers()
+        if modifiers & Qt.KeyboardModifier.ShiftModifier:
+            self.selection_mode = SELECTION_RECTANGLE
+        elif modifiers & Qt.KeyboardModifier.AltModifier:
+            self.selection_mode = SELECTION_LASSO
+        else:
+            self.selection_mode = None
+            return
+        self.selection_restores = bool(modifiers & (Qt.KeyboardModifier.ControlModifier |
+                                                    Qt.KeyboardModifier.MetaModifier))
+        self.selection_points = [self.graphics_view.mapToScene(event.position().toPoint())]
+        pen = QPen(QColor(0, 200, 0) if self.selection_restores else QColor(255, 200, 0), 1, Qt.PenStyle.DashLine)
+        pen.setCosmetic(True)  # Same width at every zoom level
+        self.selection_item = QGraphicsPathItem()
+        self.selection_item.setPen(pen)
+        self.graphics_scene.addItem(self.selection_item)
+
+    def update_selection(self, position):
+        point = self.graphics_view.mapToScene(position.toPoint())
+        if self.selection_mode == SELECTION_RECTANGLE:
+            self.selection_points = [self.selection_points[0], point]
+        else:
+            self.selection_points.append(point)
+        self.selection_item.setPath(self.selection_path())
+
+    def selection_polygon(self):
+        if self.selection_mode == SELECTION_RECTANGLE:
+            start, end = self.selection_points[0], self.selection_points[-1]
+            return [(start.x(), start.y()), (end.x(), start.y()), (end.x(), end.y()), (start.x(), end.y())]
+        return [(point.x(), point.y()) for point in self.selection_points]
+
+    def selection_path(self):
+        path = QPainterPath()
+        path.addPolygon(QPolygonF([QPointF(x, y) for x, y in self.selection_polygon()]))
+        path.closeSubpath()
+        return path
+
+    def finish_selection(self, apply=True):
+        if apply:
+            count = self.blob_detector_logic.edit_keypoints_in_region(self.selection_polygon(),
+                                                                      restore=self.selection_restores)
+            logging.debug("%s %s keypoints in the selection", "Restored" if self.selection_restores else "Removed",
+                          count)
+        self.graphics_scene.removeItem(self.selection_item)
+        self.selection_item = None
+        self.selection_points = []
+        self.selection_mode = None
+
     def add_or_remove_keypoint(self, position):
         scene_pos = self.graphics_view.mapToScene(position.toPoint())
         self.blob_detector_logic.add_or_remove_keypoint(scene_pos.x(), scene_pos.y())
\ No newline at end of file
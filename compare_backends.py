@@ -0,0 +1,136 @@
+"""
+Accuracy-vs-speed comparison of the ONNX Runtime backends against the PyTorch YOLO path on a folder of reference
+plates.
+
+Every image is decoded and cropped once, as for counting, and then counted by each backend with the detection cache
+off. The PyTorch counts are the reference: for ONNX Runtime (FP32 and, with --int8, the dynamically quantized INT8
+model) the comparison reports the throughput, the speedup, how far the counts are off and how many of the reference
+detections are found again.
+
+    python compare_backends.py "<image folder>" [--model yolo11x.pt] [--int8] [--threads 8] [--output comparison.json]
+"""
+import argparse
+import functools
+import json
+import logging
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from batch_counter import list_image_paths
+from blob_counter import YOLOBlobCounter, OnnxBlobCounter, ModelRegistry, load_onnx_model
+from benchmarks import environment
+from image_loader import decode_image
+from utils import DEFAULT_MODEL_PATH, DEFAULT_INFERENCE_BATCH_SIZE, DEFAULT_TARGET_IMAGE_SIZE, DEFAULT_ONNX_THREADS
+
+COMPARISON_LOGGER = logging.getLogger("compare_backends")
+DEFAULT_COMPARISON_PATH = "backend_comparison.json"
+
+
+def match_detections(reference, detections):
+    """
+    Number of reference detections with a detection of the other backend within their radius (at least 2 px), each
+    detection matched at most once, closest pairs first.
+    """
+    if not len(reference) or not len(detections):
+        return 0
+    distance = np.hypot(reference[:, None, 0] - detections[None, :, 0], reference[:, None, 1] - detections[None, :, 1])
+    within = distance <= np.maximum(reference[:, 2] / 2, 2.0)[:, None]
+    matched_reference, matched_detections = set(), set()
+    for i, j in zip(*np.unravel_index(np.argsort(distance, axis=None), distance.shape)):
+        if not within[i, j]:
+            break
+        if i not in matched_reference and j not in matched_detections:
+            matched_reference.add(i)
+            matched_detections.add(j)
+    return len(matched_reference)
+
+
+def time_backend(blob_counter, images, batch_size):
+    """Count all images once for warm-up and once timed. :return: (detections per image, seconds per image)."""
+    blob_counter.count_blobs_batch(images[:batch_size], batch_size=batch_size)  # Loads or exports the model
+    seconds_per_image, detections = [], []
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        started = time.perf_counter()
+        stores = blob_counter.count_blobs_batch(batch, batch_size=batch_size)
+        seconds_per_image.extend([(time.perf_counter() - started) / len(batch)] * len(batch))
+        detections.extend(store.to_array() for store in stores)
+    return detections, seconds_per_image
+
+
+def summarize(name, detections, seconds_per_image, reference=None, reference_seconds=None):
+    result = {"backend": name, "images": len(detections), "median_s_per_image": statistics.median(seconds_per_image),
+              "images_per_s": len(seconds_per_image) / sum(seconds_per_image),
+              "counts": [len(image_detections) for image_detections in detections]}
+    if reference is not None:
+        count_errors = [abs(len(a) - len(b)) for a, b in zip(reference, detections)]
+        matched = sum(match_detections(a, b) for a, b in zip(reference, detections))
+        reference_total, total = sum(len(a) for a in reference), sum(len(b) for b in detections)
+        result.update({"speedup": statistics.median(reference_seconds) / result["median_s_per_image"],
+                       "mean_abs_count_error": statistics.fmean(count_errors), "max_abs_count_error": max(count_errors),
+                       "recall": matched / reference_total if reference_total else 1.0,
+                       "precision": matched / total if total else 1.0})
+    return result
+
+
+def print_summary(results):
+    print(f"{'Backend':<16}{'Images/s':>10}{'Speedup':>9}{'Mean |dCount|':>15}{'Max |dCount|':>14}{'Recall':>8}"
+          f"{'Precision':>11}")
+    for result in results:
+        if "speedup" in result:
+            print(f"{result['backend']:<16}{result['images_per_s']:>10.2f}{result['speedup']:>8.2f}x"
+                  f"{result['mean_abs_count_error']:>15.2f}{result['max_abs_count_error']:>14}"
+                  f"{result['recall']:>8.3f}{result['precision']:>11.3f}")
+        else:
+            print(f"{result['backend']:<16}{result['images_per_s']:>10.2f}{'1.00x':>9}{'reference':>15}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the ONNX Runtime backends with the PyTorch YOLO path.")
+    parser.add_argument("folder", help="Folder of reference plate images.")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="YOLO weights to compare.")
+    parser.add_argument("--int8", action="store_true", help="Also compare the dynamically quantized INT8 model.")
+    parser.add_argument("--threads", type=int, default=DEFAULT_ONNX_THREADS, help="ONNX Runtime threads.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_INFERENCE_BATCH_SIZE,
+                        help="Number of images counted per forward pass.")
+    parser.add_argument("--output", default=DEFAULT_COMPARISON_PATH, help="JSON file to write the results to.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', force=True)
+    COMPARISON_LOGGER.setLevel(logging.INFO)
+
+    image_paths = list_image_paths(args.folder)
+    if not image_paths:
+        parser.error(f"No images found in \"{args.folder}\".")
+    images = [decode_image(image_path, DEFAULT_TARGET_IMAGE_SIZE) for image_path in image_paths]
+    batch_size = max(args.batch_size, 1)
+    registry = ModelRegistry(loader=functools.partial(load_onnx_model, threads=max(args.threads, 1)))
+    backends = [("pytorch", YOLOBlobCounter(model_path=args.model, use_detection_cache=False)),
+                ("onnx", OnnxBlobCounter(model_path=args.model, registry=registry, use_detection_cache=False))]
+    if args.int8:
+        backends.append(("onnx_int8", OnnxBlobCounter(model_path=args.model, quantize=True, registry=registry,
+                                                      use_detection_cache=False)))
+
+    results, reference, reference_seconds = [], None, None
+    for name, blob_counter in backends:
+        COMPARISON_LOGGER.info(f"Counting {len(images)} images with {name}...")
+        try:
+            detections, seconds_per_image = time_backend(blob_counter, images, batch_size)
+        finally:
+            blob_counter.close()
+        results.append(summarize(name, detections, seconds_per_image, reference, reference_seconds))
+        if reference is None:
+            reference, reference_seconds = detections, seconds_per_image
+
+    print_summary(results)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"folder": args.folder, "model": args.model, "threads": args.threads, "batch_size": batch_size,
+                   "environment": environment(), "results": results}, f, indent=1)
+    COMPARISON_LOGGER.info(f"SUCCESS: Comparison saved to \"{args.output}\".")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,228 @@
+import bisect
+import math
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from instrumentation import PROFILER
+from utils import DEFAULT_THRESHOLD_STEP, DEFAULT_MIN_REPEATABILITY, DEFAULT_COMPONENT_CACHE_SIZE
+
+
+class ComponentStats:
+    """
+    Every contour of the plate at one threshold level, measured the way cv2.SimpleBlobDetector measures them. The
+    measurements do not depend on any filter setting, so filter() can be applied again and again without touching
+    the image. Moments, perimeters and radii are computed for all contours at once; convex hulls are the only
+    per-contour work left and are computed the first time a contour survives the other filters.
+    """
+
+    def __init__(self, gray, threshold):
+        _, binary = cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY)
+        contours, _ = cv2.findContours(binary, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+        lengths = np.fromiter((len(contour) for contour in contours), dtype=np.int64, count=len(contours))
+        points = np.concatenate(contours).reshape(-1, 2).astype(np.float64) if contours else np.empty((0, 2))
+        ids = np.repeat(np.arange(len(contours)), lengths)
+        starts = np.cumsum(lengths) - lengths
+
+        def per_contour(values):
+            return np.bincount(ids, values, minlength=len(contours))
+
+        # Polygon moments from the edges between each point and the previous one, wrapping around every contour
+        previous = np.arange(len(points)) - 1
+        previous[starts] = starts + lengths - 1
+        x, y = points[:, 0], points[:, 1]
+        px, py = x[previous], y[previous]
+        dxy = px * y - x * py
+        a00 = per_contour(dxy)
+        sign = np.where(a00 < 0, -1.0, 1.0)  # Moments do not depend on the contour orientation
+        m00 = sign * a00 / 2
+        m10 = sign * per_contour(dxy * (px + x)) / 6
+        m01 = sign * per_contour(dxy * (py + y)) / 6
+        m20 = sign * per_contour(dxy * (px * (px + x) + x * x)) / 12
+        m11 = sign * per_contour(dxy * (px * (2 * py + y) + x * (py + 2 * y))) / 24
+        m02 = sign * per_contour(dxy * (py * (py + y) + y * y)) / 12
+        perimeter = per_contour(np.hypot(x - px, y - py))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            center_x, center_y = m10 / m00, m01 / m00
+            # Radius is the median distance from the center to the contour
+            distances = np.hypot(x - center_x[ids], y - center_y[ids])
+            distances = distances[np.lexsort((distances, ids))]
+            radius = (distances[starts + (lengths - 1) // 2] + distances[starts + lengths // 2]) / 2 \
+                if len(contours) else np.empty(0)
+
+            valid = m00 != 0  # Degenerate contours are dropped by SimpleBlobDetector whatever the filters are
+            self.contours = [contour for contour, keep in zip(contours, valid) if keep]
+            self.x, self.y, self.radius = center_x[valid], center_y[valid], radius[valid]
+            self.area, self.perimeter = m00[valid], perimeter[valid]
+            self.mu20 = m20[valid] - m10[valid] * self.x
+            self.mu11 = m11[valid] - m10[valid] * self.y
+            self.mu02 = m02[valid] - m01[valid] * self.y
+            self.circularity = 4 * np.pi * self.area / (self.perimeter ** 2)
+            # Ratio of the smallest to the largest second moment, 1 for a circle and 0 for a line
+            spread = np.sqrt((2 * self.mu11) ** 2 + (self.mu20 - self.mu02) ** 2)
+            self.inertia_ratio = np.where(spread > 1e-2, (self.mu20 + self.mu02 - spread) /
+                                          (self.mu20 + self.mu02 + spread), 1.0)
+        self.hull_area = np.full(len(self.contours), np.nan)  # Filled in by filter() as needed
+
+    def __len__(self):
+        return len(self.contours)
+
+    def convexity(self, indices):
+        missing = indices[np.isnan(self.hull_area[indices])]
+        for i in missing.tolist():
+            self.hull_area[i] = cv2.contourArea(cv2.convexHull(self.contours[i]))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            hull_area = self.hull_area[indices]
+            return np.where(np.abs(hull_area) < np.finfo(np.float64).eps, np.nan, self.area[indices] / hull_area)
+
+    def filter(self, settings):
+        """Indices of the components passing the area, circularity, inertia and convexity filters."""
+        candidates = np.flatnonzero((self.area >= settings["min_area"]) & (self.area < settings["max_area"]) &
+                                    (self.circularity >= settings["min_circularity"]) &
+                                    (self.inertia_ratio >= settings["min_inertia_ratio"]))
+        return candidates[self.convexity(candidates) >= settings["min_convexity"]]
+
+
+def group_centers(levels, min_dist_between_blobs, min_repeatability):
+    """
+    Merge the blob centers found at each threshold level into blobs exactly as SimpleBlobDetector does: a center
+    joins the first blob whose representative (its member with the median radius) is closer than
+    min_dist_between_blobs or either radius, otherwise it starts a new blob. Blobs found at fewer than
+    min_repeatability levels are dropped. Representatives are kept in a grid, so each center is only compared with
+    the blobs around it.
+    :param levels: (x, y, radius, confidence) arrays of the filtered centers of each level, lowest threshold first.
+    :return: (N, 4) float32 array of (x, y, size, confidence) rows.
+    """
+    radii = np.concatenate([radius for _, _, radius, _ in levels] + [np.empty(0)])
+    # Blobs and centers with a radius up to the cell size can only be close to something in a neighbouring cell, the
+    # few larger ones are compared with everything
+    cell_size = max(min_dist_between_blobs, float(np.percentile(radii, 90)) if len(radii) else 0.0, 1.0)
+    members = []  # Per blob: (radius, x, y, confidence) of every member, sorted by radius
+    representatives = []  # Per blob: (x, y, radius)
+    cells, large_blobs = {}, set()
+
+    def cell_of(x, y):
+        return int(x // cell_size), int(y // cell_size)
+
+    def place(blob, add):
+        x, y, radius = representatives[blob]
+        if radius > cell_size:
+            large_blobs.add(blob) if add else large_blobs.discard(blob)
+        elif add:
+            cells.setdefault(cell_of(x, y), set()).add(blob)
+        else:
+            cells[cell_of(x, y)].discard(blob)
+
+    for level in levels:
+        blob_count = len(members)  # Blobs started at this level are only matched from the next level on
+        new_blobs = []
+        for x, y, radius, confidence in zip(*(values.tolist() for values in level)):
+            if radius > cell_size:
+                candidates = range(blob_count)
+            else:
+                column, row = cell_of(x, y)
+                candidates = set(large_blobs)
+                for neighbour in ((column + i, row + j) for i in (-1, 0, 1) for j in (-1, 0, 1)):
+                    candidates.update(cells.get(neighbour, ()))
+                candidates = sorted(candidates)
+            match = None
+            for blob in candidates:
+                blob_x, blob_y, blob_radius = representatives[blob]
+                distance = math.hypot(x - blob_x, y - blob_y)
+                if distance < min_dist_between_blobs or distance < blob_radius or distance < radius:
+                    match = blob
+                    break
+            if match is None:
+                new_blobs.append((radius, x, y, confidence))
+                continue
+            blob_members = members[match]
+            bisect.insort_right(blob_members, (radius, x, y, confidence), key=lambda member: member[0])
+            median = blob_members[len(blob_members) // 2]
+            if (median[1], median[2], median[0]) != representatives[match]:
+                place(match, add=False)
+                representatives[match] = (median[1], median[2], median[0])
+                place(match, add=True)
+        for member in new_blobs:
+            members.append([member])
+            representatives.append((member[1], member[2], member[0]))
+            place(len(members) - 1, add=True)
+
+    members = [blob_members for blob_members in members if len(blob_members) >= min_repeatability]
+    if not members:
+        return np.empty((0, 4), dtype=np.float32)
+    blob = np.repeat(np.arange(len(members)), [len(blob_members) for blob_members in members])
+    _, x, y, confidence = np.array([member for blob_members in members for member in blob_members]).T
+    # The center is the confidence-weighted mean, rounder shapes count more. Blobs without any confidence use the
+    # plain mean.
+    weights = np.bincount(blob, confidence)
+    confidence = np.where(weights[blob] > 0, confidence, 1.0)
+    weights = np.bincount(blob, confidence)
+    return np.column_stack((np.bincount(blob, confidence * x) / weights, np.bincount(blob, confidence * y) / weights,
+                            [blob_members[len(blob_members) // 2][0] * 2 for blob_members in members],
+                            np.ones(len(members)))).astype(np.float32)
+
+
+class MultiThresholdComponents:
+    """
+    The component statistics of one plate at every threshold level. Each level is thresholded and measured the first
+    time a threshold range includes it and cached from then on, so changing a filter setting only re-applies masks
+    to the cached arrays and changing the threshold range only measures the levels that were not needed before.
+    """
+
+    def __init__(self, gray, threshold_step=DEFAULT_THRESHOLD_STEP, min_repeatability=DEFAULT_MIN_REPEATABILITY):
+        self.gray = gray
+        self.threshold_step = threshold_step
+        self.min_repeatability = min_repeatability
+        self._levels = {}  # Threshold -> component stats
+        self._lock = threading.Lock()
+
+    def thresholds(self, min_threshold, max_threshold):
+        return np.arange(min_threshold, max_threshold, self.threshold_step, dtype=np.float64).tolist()
+
+    def level(self, threshold):
+        with self._lock:
+            stats = self._levels.get(threshold)
+            if stats is None:
+                with PROFILER().stage("threshold_components", threshold=threshold):
+                    stats = self._levels[threshold] = ComponentStats(self.gray, threshold)
+            return stats
+
+    def detect(self, settings):
+        """Blobs for these detector settings, as (N, 4) float32 rows of (x, y, size, confidence)."""
+        levels = []
+        for threshold in self.thresholds(settings["min_threshold"], settings["max_threshold"]):
+            stats = self.level(threshold)
+            keep = stats.filter(settings)
+            levels.append((stats.x[keep], stats.y[keep], stats.radius[keep], stats.inertia_ratio[keep] ** 2))
+        return group_centers(levels, settings["min_dist_between_blobs"], self.min_repeatability)
+
+
+class ComponentStatsCache:
+    """Least recently used MultiThresholdComponents of the last few plates, keyed by image content."""
+
+    def __init__(self, max_entries=DEFAULT_COMPONENT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, gray_factory):
+        """The components cached under key, or new ones for the plate gray_factory() returns."""
+        with self._lock:
+            components = self._entries.get(key)
+            if components is not None:
+                self._entries.move_to_end(key)
+                return components
+        components = MultiThresholdComponents(gray_factory())
+        with self._lock:
+            components = self._entries.setdefault(key, components)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return components
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,384 @@
+"""
+Local HTTP service that counts plates with a warm model, for robots and scripts that cannot drive the GUI.
+
+    python main.py serve [--port 8765] [--model yolo11x.pt] [--backend yolo] [--max-batch-size 8]
+
+POST /count takes either an image file as the request body (any format OpenCV decodes) or a JSON body
+{"path": "<image file readable by the service>"}, and answers with {"count": N, "keypoints": [[x, y, size,
+confidence], ...], "cached": bool, ...} in the coordinates of the preprocessed image. Requests arriving within the
+batch window are counted in a single forward pass. When the queue is full, requests are turned away with 503 and a
+Retry-After header. GET /health (or /metrics) reports the queue, the batch sizes and the latency percentiles.
+"""
+import argparse
+import collections
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from detection_cache import hash_bytes, hash_file
+from image_loader import decode_image, decode_image_data
+from utils import DEFAULT_SERVICE_HOST, DEFAULT_SERVICE_PORT, DEFAULT_SERVICE_BATCH_WINDOW_MS, \
+    DEFAULT_SERVICE_MAX_QUEUE, DEFAULT_SERVICE_REQUEST_TIMEOUT, DEFAULT_SERVICE_MAX_UPLOAD_MB, \
+    DEFAULT_SERVICE_LATENCY_WINDOW, DEFAULT_INFERENCE_BATCH_SIZE, DEFAULT_MODEL_PATH, DEFAULT_TARGET_IMAGE_SIZE, \
+    DEFAULT_DETECTION_BACKEND, DETECTION_BACKENDS, BACKEND_YOLO_TILED, BACKEND_SIMPLE_BLOB
+
+
+class CountJob:
+    __slots__ = ("image", "image_hash", "preprocessing", "future")
+
+    def __init__(self, image, image_hash, preprocessing):
+        self.image = image
+        self.image_hash = image_hash
+        self.preprocessing = preprocessing
+        self.future = Future()
+
+
+class ServiceMetrics:
+    """Thread-safe request and batch counters with latency percentiles over the latest requests."""
+
+    def __init__(self, latency_window=DEFAULT_SERVICE_LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=latency_window)
+        self.started = time.monotonic()
+        self.requests = 0
+        self.cached = 0
+        self.rejected = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_images = 0
+        self.largest_batch = 0
+        self.inference_seconds = 0.0
+
+    def record_request(self, seconds, cached=False):
+        with self._lock:
+            self.requests += 1
+            self.cached += cached
+            self._latencies.append(seconds)
+
+    def record_rejected(self):
+        with self._lock:
+            self.rejected += 1
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def record_batch(self, size, seconds):
+        with self._lock:
+            self.batches += 1
+            self.batched_images += size
+            self.largest_batch = max(self.largest_batch, size)
+            self.inference_seconds += seconds
+
+    def snapshot(self):
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            stats = {"uptime_s": time.monotonic() - self.started, "requests": self.requests, "cached": self.cached,
+                     "rejected": self.rejected, "errors": self.errors, "batches": self.batches,
+                     "mean_batch_size": self.batched_images / self.batches if self.batches else 0.0,
+                     "largest_batch": self.largest_batch, "inference_s": self.inference_seconds}
+        if len(latencies):
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99]).tolist()
+            stats["latency_ms"] = {"p50": p50, "p90": p90, "p99": p99, "max": float(latencies.max()),
+                                   "samples": len(latencies)}
+        return stats
+
+
+class DynamicBatcher:
+    """
+    Feeds queued jobs to the counter from a single worker thread. The worker takes the oldest job, then keeps
+    collecting jobs until the batch window has passed or the batch is full, and counts them with one
+    count_blobs_batch call. Jobs that queue up while a batch runs join the next one without waiting.
+
+    The queue is bounded by slots that callers reserve() before preparing a job, so a full queue turns requests away
+    before they decode anything. A slot is freed when the worker takes its job off the queue.
+    """
+
+    def __init__(self, blob_counter, max_batch_size=DEFAULT_INFERENCE_BATCH_SIZE,
+                 batch_window=DEFAULT_SERVICE_BATCH_WINDOW_MS / 1000, max_queue=DEFAULT_SERVICE_MAX_QUEUE,
+                 metrics: ServiceMetrics = None):
+        self.blob_counter = blob_counter
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.batch_window = batch_window
+        self.metrics = metrics if metrics is not None else ServiceMetrics()
+        self.max_queue = max(int(max_queue), 1)
+        self.queue = queue.Queue()  # Bounded by the slots
+        self._slots = threading.BoundedSemaphore(self.max_queue)
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name="count-batcher", daemon=True)
+        self._thread.start()
+
+    def reserve(self):
+        """Reserve a queue slot for a job about to be submitted. :raises queue.Full: If every slot is taken."""
+        if not self._slots.acquire(blocking=False):
+            raise queue.Full
+
+    def release(self):
+        """Give back a reserved slot whose job will not be submitted."""
+        self._slots.release()
+
+    def submit(self, job: CountJob):
+        """Queue a job in a slot reserved with reserve()."""
+        if self._closing:
+            self.release()
+            raise RuntimeError("The counting service is shutting down.")
+        self.queue.put(job)
+        return job.future
+
+    def _next_batch(self):
+        job = self.queue.get()
+        if job is None:
+            return None
+        self.release()
+        batch = [job]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            try:
+                job = self.queue.get_nowait() if self.batch_window <= 0 else \
+                    self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if job is None:
+                self.queue.put(None)  # Count what was collected, then stop
+                break
+            self.release()
+            batch.append(job)
+        return batch
+
+    def _run(self):
+        while (batch := self._next_batch()) is not None:
+            groups = {}  # Jobs with the same preprocessing share a count_blobs_batch call
+            for job in batch:
+                # Jobs of requests that timed out were cancelled, their clients are gone
+                if job.future.set_running_or_notify_cancel():
+                    groups.setdefault(json.dumps(job.preprocessing, sort_keys=True), []).append(job)
+            for jobs in groups.values():
+                started = time.perf_counter()
+                try:
+                    # The request threads have looked the images up in the detection cache already
+                    results = self.blob_counter.count_blobs_batch(
+                        [job.image for job in jobs], batch_size=self.max_batch_size,
+                        preprocessing=jobs[0].preprocessing, image_hashes=[job.image_hash for job in jobs],
+                        lookup_cache=False)
+                except Exception as e:
+                    logging.error(f"Counting a batch of {len(jobs)} images failed: {e}")
+                    for job in jobs:
+                        job.future.set_exception(e)
+                    continue
+                self.metrics.record_batch(len(jobs), time.perf_counter() - started)
+                for job, keypoints in zip(jobs, results):
+                    job.future.set_result(keypoints)
+
+    def close(self):
+        self._closing = True
+        self.queue.put(None)
+        self._thread.join()
+
+
+class CountingService:
+    """
+    Counts single images for the HTTP handler. The request threads hash and decode their image and answer from the
+    detection cache when they can; everything else goes through the DynamicBatcher.
+    """
+
+    def __init__(self, blob_counter, target_size=DEFAULT_TARGET_IMAGE_SIZE, max_batch_size=DEFAULT_INFERENCE_BATCH_SIZE,
+                 batch_window=DEFAULT_SERVICE_BATCH_WINDOW_MS / 1000, max_queue=DEFAULT_SERVICE_MAX_QUEUE,
+                 request_timeout=DEFAULT_SERVICE_REQUEST_TIMEOUT):
+        self.blob_counter = blob_counter
+        self.target_size = target_size
+        self.request_timeout = request_timeout
+        self.metrics = ServiceMetrics()
+        self.batcher = DynamicBatcher(blob_counter, max_batch_size=max_batch_size, batch_window=batch_window,
+                                      max_queue=max_queue, metrics=self.metrics)
+
+    def warm_up(self):
+        """Load the model and run it once, so the first request does not pay for either."""
+        size = self.target_size or DEFAULT_TARGET_IMAGE_SIZE
+        blank = np.zeros((size, size, 3), dtype=np.uint8)
+        started = time.perf_counter()
+        if hasattr(self.blob_counter, "detect_batch"):
+            self.blob_counter.detect_batch([blank])  # Bypasses the detection cache
+        else:
+            self.blob_counter.count_blobs(blank)
+        logging.info(f"Model warmed up in {time.perf_counter() - started:.1f} s.")
+
+    def preprocessing_settings(self):
+        return {"target_size": self.target_size}
+
+    def count(self, data=None, path=None):
+        """
+        Count the image in data (file contents) or at path.
+        :return: Response dict with the count and keypoints.
+        :raises queue.Full: If the queue is full. TimeoutError if the count did not finish in time.
+        """
+        started = time.perf_counter()
+        try:
+            image_hash = hash_bytes(data) if data is not None else hash_file(path)
+            preprocessing = self.preprocessing_settings()
+            keypoints = self.blob_counter.lookup_cached_keypoints(image_hash, preprocessing)
+            cached = keypoints is not None
+            if not cached:
+                self.batcher.reserve()  # Before decoding, so turning a request away costs nothing
+                try:
+                    image = decode_image_data(data, self.target_size) if data is not None else \
+                        decode_image(path, self.target_size)
+                except BaseException:
+                    self.batcher.release()
+                    raise
+                future = self.batcher.submit(CountJob(image, image_hash, preprocessing))
+                try:
+                    keypoints = future.result(timeout=self.request_timeout)
+                except TimeoutError:
+                    future.cancel()  # Skipped by the batcher if it has not been counted yet
+                    raise
+        except queue.Full:
+            self.metrics.record_rejected()
+            raise
+        except Exception:
+            self.metrics.record_error()
+            raise
+        seconds = time.perf_counter() - started
+        self.metrics.record_request(seconds, cached=cached)
+        return {"count": len(keypoints), "keypoints": keypoints.to_array().tolist(), "cached": cached,
+                "image_hash": image_hash, "preprocessing": preprocessing, "latency_ms": seconds * 1000}
+
+    def health(self):
+        return {"status": "ok", "backend": self.blob_counter.backend,
+                "model": getattr(self.blob_counter, "model_path", None), "queue_depth": self.batcher.queue.qsize(),
+                "max_queue": self.batcher.max_queue, "max_batch_size": self.batcher.max_batch_size,
+                "batch_window_ms": self.batcher.batch_window * 1000, **self.metrics.snapshot()}
+
+    def close(self):
+        self.batcher.close()
+
+
+class CountingRequestHandler(BaseHTTPRequestHandler):
+    server_version = "BlobCounter/1.0"
+    max_upload_bytes = DEFAULT_SERVICE_MAX_UPLOAD_MB * 1024 * 1024
+
+    @property
+    def service(self) -> CountingService:
+        return self.server.service
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} - {format % args}")
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message, headers=None):
+        self.send_json(status, {"error": message}, headers)
+
+    def do_GET(self):
+        if self.path.split("?")[0] in ("/health", "/metrics"):
+            self.send_json(HTTPStatus.OK, self.service.health())
+        else:
+            self.send_error_json(HTTPStatus.NOT_FOUND, f"Unknown endpoint \"{self.path}\".")
+
+    def do_POST(self):
+        if self.path.split("?")[0] != "/count":
+            self.send_error_json(HTTPStatus.NOT_FOUND, f"Unknown endpoint \"{self.path}\".")
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0:
+            self.send_error_json(HTTPStatus.BAD_REQUEST, "Send an image file or {\"path\": ...} as the request body.")
+            return
+        if length > self.max_upload_bytes:
+            self.send_error_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Uploads are limited to "
+                                                                     f"{self.max_upload_bytes // 2 ** 20} MB.")
+            return
+        body = self.rfile.read(length)
+        try:
+            if self.headers.get_content_type() == "application/json":
+                request = json.loads(body)
+                path = request.get("path") if isinstance(request, dict) else None
+                if not isinstance(path, str):
+                    raise ValueError("The JSON body needs a \"path\" string.")
+                result = self.service.count(path=path)
+            else:
+                result = self.service.count(data=body)
+        except queue.Full:
+            self.send_error_json(HTTPStatus.SERVICE_UNAVAILABLE, "The counting queue is full, retry later.",
+                                 {"Retry-After": "1"})
+        except (FileNotFoundError, IsADirectoryError) as e:
+            self.send_error_json(HTTPStatus.NOT_FOUND, str(e))
+        except ValueError as e:  # Includes JSON decoding errors
+            self.send_error_json(HTTPStatus.BAD_REQUEST, str(e))
+        except TimeoutError:
+            self.send_error_json(HTTPStatus.GATEWAY_TIMEOUT, "Counting did not finish in time.")
+        except Exception as e:
+            logging.error(f"Counting request failed: {e}")
+            self.send_error_json(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+        else:
+            self.send_json(HTTPStatus.OK, result)
+
+
+def make_server(service: CountingService, host=DEFAULT_SERVICE_HOST, port=DEFAULT_SERVICE_PORT):
+    """An HTTP server handling each request on its own thread. Port 0 picks a free port (see server_address)."""
+    server = ThreadingHTTPServer((host, port), CountingRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="main.py serve", description="Serve blob counts over local HTTP.")
+    parser.add_argument("--host", default=DEFAULT_SERVICE_HOST, help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=DEFAULT_SERVICE_PORT, help="Port to listen on.")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="YOLO model weights to count with.")
+    parser.add_argument("--backend", choices=DETECTION_BACKENDS, default=DEFAULT_DETECTION_BACKEND,
+                        help="Detection backend, see main.py batch --help.")
+    parser.add_argument("--max-batch-size", type=int, default=DEFAULT_INFERENCE_BATCH_SIZE,
+                        help="Most images counted in one forward pass.")
+    parser.add_argument("--batch-window-ms", type=float, default=DEFAULT_SERVICE_BATCH_WINDOW_MS,
+                        help="How long a batch waits for more requests after its first one, in milliseconds.")
+    parser.add_argument("--max-queue", type=int, default=DEFAULT_SERVICE_MAX_QUEUE,
+                        help="Images waiting for inference before requests are rejected with 503.")
+    parser.add_argument("--request-timeout", type=float, default=DEFAULT_SERVICE_REQUEST_TIMEOUT,
+                        help="Seconds a request waits for its count.")
+    parser.add_argument("--no-detection-cache", action="store_true",
+                        help="Always run the model instead of reusing results cached on disk.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', force=True)
+
+    from blob_counter import create_blob_counter
+    if args.backend == BACKEND_SIMPLE_BLOB:
+        blob_counter = create_blob_counter(args.backend)
+    else:
+        blob_counter = create_blob_counter(args.backend, model_path=args.model,
+                                           use_detection_cache=not args.no_detection_cache)
+    target_size = None if args.backend == BACKEND_YOLO_TILED else DEFAULT_TARGET_IMAGE_SIZE
+    service = CountingService(blob_counter, target_size=target_size, max_batch_size=args.max_batch_size,
+                              batch_window=max(args.batch_window_ms, 0) / 1000, max_queue=args.max_queue,
+                              request_timeout=args.request_timeout)
+    service.warm_up()
+    server = make_server(service, args.host, args.port)
+    logging.info(f"Counting service listening on http://{args.host}:{server.server_address[1]} "
+                 f"(POST /count, GET /health).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Shutting down the counting service...")
+    finally:
+        server.server_close()
+        service.close()
+        blob_counter.close()
+        if blob_counter.detection_cache is not None:
+            logging.info(blob_counter.detection_cache.report())
+        if blob_counter.report() is not None:
+            logging.info(blob_counter.report())
+    return 0
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from utils import DEFAULT_DETECTION_CACHE_PATH, DEFAULT_DETECTION_CACHE_MAX_MB
+
+DETECTION_COLUMNS = 4  # x, y, size, confidence
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def hash_file(path):
+    """Content hash of a file, memoized on its path, size and modification time."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        file_hash = _file_hashes.get(memo_key)
+    if file_hash is None:
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        file_hash = digest.hexdigest()
+        with _file_hashes_lock:
+            _file_hashes[memo_key] = file_hash
+    return file_hash
+
+
+def hash_bytes(data):
+    """Content hash of file contents already in memory, equal to hash_file of the same file."""
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def hash_image(image):
+    """Content hash of a decoded image array, used when the image has no source file."""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{image.shape}{image.dtype}".encode())
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()
+
+
+def make_cache_key(image_hash, model_hash, preprocessing, inference):
+    description = json.dumps({"image": image_hash, "model": model_hash, "preprocessing": preprocessing,
+                              "inference": inference}, sort_keys=True, default=str)
+    return hashlib.blake2b(description.encode(), digest_size=20).hexdigest()
+
+
+class DetectionCache:
+    """
+    Persistent SQLite cache of detection results.
+
+    Entries are keyed by a hash covering the image content, the model weights, the preprocessing settings and the
+    inference parameters (see make_cache_key), so changing any of them simply misses. Results are stored as float32
+    arrays of (x, y, size, confidence) rows. When the stored results exceed max_bytes the least recently used entries
+    are deleted.
+    """
+
+    def __init__(self, path=DEFAULT_DETECTION_CACHE_PATH, max_bytes=DEFAULT_DETECTION_CACHE_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            if path != ":memory:":
+                self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS detections (key TEXT PRIMARY KEY, image_hash TEXT, model_hash TEXT, "
+                "data BLOB, num_bytes INTEGER, created REAL, last_access REAL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS detections_last_access ON detections (last_access)")
+
+    def get(self, key):
+        """Return the cached (N, 4) float32 detections for key, or None on a miss."""
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT data FROM detections WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute("UPDATE detections SET last_access = ? WHERE key = ?", (time.time(), key))
+        return np.frombuffer(row[0], dtype=np.float32).reshape(-1, DETECTION_COLUMNS)
+
+    def put(self, key, detections, image_hash=None, model_hash=None):
+        data = np.ascontiguousarray(detections, dtype=np.float32).reshape(-1, DETECTION_COLUMNS).tobytes()
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, image_hash, model_hash, data, len(data), now, now))
+            self._enforce_size_limit()
+
+    def _enforce_size_limit(self):
+        total = self._connection.execute("SELECT COALESCE(SUM(num_bytes), 0) FROM detections").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Delete least recently used entries until the cache fits again
+        removed = 0
+        for key, num_bytes in self._connection.execute(
+                "SELECT key, num_bytes FROM detections ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._connection.execute("DELETE FROM detections WHERE key = ?", (key,))
+            total -= num_bytes
+            removed += 1
+        logging.debug(f"Detection cache over its size limit, removed {removed} entries.")
+
+    def invalidate(self, image_hash=None, model_hash=None):
+        """Delete all entries for an image and/or a model. Returns the number of deleted entries."""
+        clauses, params = [], []
+        if image_hash is not None:
+            clauses.append("image_hash = ?")
+            params.append(image_hash)
+        if model_hash is not None:
+            clauses.append("model_hash = ?")
+            params.append(model_hash)
+        if not clauses:
+            return 0
+        with self._lock, self._connection:
+            return self._connection.execute(f"DELETE FROM detections WHERE {' AND '.join(clauses)}", params).rowcount
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM detections")
+
+    def stats(self):
+        with self._lock:
+            entries, total = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(num_bytes), 0) FROM detections").fetchone()
+        return {"entries": entries, "bytes": total, "max_bytes": self.max_bytes, "hits": self.hits,
+                "misses": self.misses, "path": self.path}
+
+    def report(self):
+        stats = self.stats()
+        return (f"Detection cache: {stats['entries']} results, {stats['bytes'] / 2 ** 20:.1f} of "
+                f"{stats['max_bytes'] / 2 ** 20:.0f} MB, {stats['hits']} hits, {stats['misses']} misses "
+                f"(\"{stats['path']}\")")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+__DETECTION_CACHE__ = None
+__DETECTION_CACHE_LOCK__ = threading.Lock()
+
+
+def DETECTION_CACHE():
+    global __DETECTION_CACHE__
+    with __DETECTION_CACHE_LOCK__:
+        if __DETECTION_CACHE__ is None:
+            __DETECTION_CACHE__ = DetectionCache()
+        return __DETECTION_CACHE__
@@ -1,46 +1,94 @@
 import logging
+import re
 
 import openpyxl
 from openpyxl.cell import MergedCell
 
 import logger
 
+DAY_HEADER_PATTERN = re.compile(r"day (\d+)")
+
 
 class ExcelOutput:
+    """
+    Fills blob counts into an existing Excel template. Row 1 holds one header per day ("Day 3" or just 3) and somewhere
+    below each header a "colonies" cell marks the row before sample 1. Both are indexed once when the workbook is
+    opened, so writing a count is a dictionary lookup instead of a scan of the sheet.
+    """
+
     def __init__(self, file_path):
         self.file_path = file_path
         self.workbook = openpyxl.load_workbook(file_path)
         self.sheet = self.workbook.active
+        self.day_columns = self.index_day_columns()
+        self.colonies_rows = self.index_colonies_rows()
+
+    def index_day_columns(self):
+        day_columns = {}
+        for cell in next(self.sheet.iter_rows(min_row=1, max_row=1), ()):
+            if isinstance(cell, MergedCell) or cell.value is None:
+                continue
+            logger.LOGGER().debug(f"CELL ADDRESS: {cell.column_letter}1, VALUE: {cell.value}")
+            if isinstance(cell.value, (int, float)) and not isinstance(cell.value, bool):
+                if not float(cell.value).is_integer():
+                    continue
+                day_num = int(cell.value)
+            else:
+                match = DAY_HEADER_PATTERN.fullmatch(str(cell.value).strip().lower())
+                if match is None:
+                    continue
+                day_num = int(match.group(1))
+            day_columns.setdefault(day_num, cell.column)  # The first matching header wins
+        return day_columns
+
+    def index_colonies_rows(self):
+        """Map each day column to the row of the first "colonies" cell under it, in one pass over the sheet."""
+        columns = set(self.day_columns.values())
+        colonies_rows = {}
+        for row in self.sheet.iter_rows():
+            for cell in row:
+                if cell.column in columns and cell.column not in colonies_rows and \
+                        str(cell.value).lower() == "colonies":
+                    colonies_rows[cell.column] = cell.row
+            if len(colonies_rows) == len(columns):
+                break
+        return colonies_rows
 
     def find_day_column(self, day_num):
-        for col in self.sheet.iter_cols(min_row=1, max_row=1):
-            for cell in col:
-                if not isinstance(cell, MergedCell):
-                    logger.LOGGER().debug(f"CELL ADDRESS: {cell.column_letter+"1"}, VALUE: {cell.value} - Looking for: {day_num}")
-                if cell.value == day_num or str(cell.value).lower() == f"day {day_num}":
-                    return cell.column
-        return None
+        return self.day_columns.get(day_num)
 
     def write_blob_counts(self, day_num, sample_number, num_keypoints):
         col = self.find_day_column(day_num)
         if col is None:
-            logging.warn(f"Unable to find the column for day {day_num} sample #{sample_number} with {num_keypoints} keypoints in the Excel sheet. Skipping this sample...")
-
-        # Find the "colonies" cell under the day_num column
-        for row in self.sheet.iter_rows(min_col=col, max_col=col):
-            for cell in row:
-                if str(cell.value).lower() == "colonies":
-                    colonies_row = cell.row
-                    break
-            else:
-                continue
-            break
-        else:
+            raise ValueError(f"No column for day {day_num} in the Excel sheet.")
+        colonies_row = self.colonies_rows.get(col)
+        if colonies_row is None:
             raise ValueError(f"'colonies' cell not found under day {day_num} column.")
+        if sample_number < 1:
+            raise ValueError(f"No sample number for day {day_num}, unable to pick a row.")
 
         # Write the number of keypoints under the "colonies" cell
         target_cell = self.sheet.cell(row=colonies_row + sample_number, column=col)
         target_cell.value = num_keypoints
 
+    def write_all_blob_counts(self, timepoints):
+        """
+        Write the counts of every timepoint. Samples that cannot be placed in the sheet are skipped and reported
+        together in one warning.
+        :return: List of (timepoint, reason) pairs for the skipped samples.
+        """
+        unmatched = []
+        for timepoint in timepoints:
+            if timepoint is None:
+                continue
+            try:
+                self.write_blob_counts(timepoint.day, timepoint.sample_number, timepoint.num_keypoints)
+            except ValueError as e:
+                unmatched.append((timepoint, str(e)))
+        if unmatched:
+            details = "\n".join(f"  {timepoint.filename}: {reason}" for timepoint, reason in unmatched)
+            logging.warning(f"Skipped {len(unmatched)} sample(s) that do not match the Excel sheet:\n{details}")
+        return unmatched
+
     def save(self):
-        self.workbook.save(self.file_path)
\ No newline at end of file
+        self.workbook.save(self.file_path)
@@ -0,0 +1,120 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from utils import DEFAULT_IMAGE_CACHE_BUDGET_MB
+
+
+class ImageCache:
+    """
+    Thread-safe LRU cache of decoded, preprocessed plate images with an explicit memory budget.
+
+    Cached arrays are marked read-only because they are shared by every reader; callers that draw on an image must
+    copy it first. An image larger than the whole budget is returned to the caller but never cached.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_IMAGE_CACHE_BUDGET_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._loading = {}  # Key -> Event set when the thread decoding it is done
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, loader):
+        """
+        Return the cached image for key, calling loader() to decode it on a miss. If another thread is already
+        decoding the same key (e.g. a prefetch), wait for it instead of decoding twice.
+        """
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return image
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = self._loading[key] = threading.Event()
+                self.misses += 1
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            loading.wait()
+            # Retries the lookup, and decodes here if the other load failed or was too large to cache
+            return self.get(key, loader)
+        try:
+            # Decode outside the lock so other plates can be served while this one loads
+            return self.put(key, loader())
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            loading.set()
+
+    def put(self, key, image):
+        image.setflags(write=False)
+        with self._lock:
+            existing = self._entries.get(key)
+            if existing is not None:
+                # Another thread decoded the same image first, keep a single copy
+                self._entries.move_to_end(key)
+                return existing
+            if image.nbytes > self.max_bytes:
+                logging.debug(f"Image {key} ({image.nbytes} bytes) exceeds the image cache budget, not caching it.")
+                return image
+            self._entries[key] = image
+            self.current_bytes += image.nbytes
+            self._evict_to_budget()
+        return image
+
+    def contains(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def invalidate(self, key):
+        with self._lock:
+            image = self._entries.pop(key, None)
+            if image is not None:
+                self.current_bytes -= image.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict_to_budget()
+
+    def _evict_to_budget(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, image = self._entries.popitem(last=False)
+            self.current_bytes -= image.nbytes
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "current_bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def report(self):
+        stats = self.stats()
+        return (f"Image cache: {stats['entries']} images, {stats['current_bytes'] / 2 ** 20:.1f} of "
+                f"{stats['max_bytes'] / 2 ** 20:.0f} MB, {stats['hits']} hits, {stats['misses']} misses, "
+                f"{stats['evictions']} evictions")
+
+
+__IMAGE_CACHE__ = ImageCache()
+
+
+def IMAGE_CACHE():
+    return __IMAGE_CACHE__
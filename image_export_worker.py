@@ -0,0 +1,49 @@
+import logging
+import threading
+
+from PySide6.QtCore import QObject, Signal, QRunnable
+
+from keypoint_export import CountedImageWriter
+
+
+class CountedImageExportSignals(QObject):
+    progress = Signal(int, int)  # completed, total
+    finished = Signal(bool, int, object)  # cancelled, images written, [(core, error message)]
+
+
+class CountedImageExportTask(QRunnable):
+    """
+    Exports the counted images of an image set off the GUI thread. The task itself only feeds a CountedImageWriter,
+    which renders and encodes the plates on its own worker pool. Progress and the result are handed back through
+    signals. Keypoints must not be edited while the task runs.
+    """
+
+    def __init__(self, cores, output_root, image_format, quality=None, max_workers=None):
+        super().__init__()
+        self.cores = list(cores)
+        self.output_root = output_root
+        self.image_format = image_format
+        self.quality = quality
+        self.max_workers = max_workers
+        self.cancel_event = threading.Event()
+        self.signals = CountedImageExportSignals()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        written, errors = [], []
+        try:
+            writer_options = {} if self.max_workers is None else {"max_workers": self.max_workers}
+            with CountedImageWriter(self.output_root, self.image_format, self.quality, **writer_options) as writer:
+                written, errors = writer.write_all(self.cores, progress=self.signals.progress.emit,
+                                                   cancel_event=self.cancel_event)
+        except Exception as e:
+            logging.error(f"Exporting counted images failed: {e}")
+            errors.append((None, e))
+        finally:
+            for core, error in errors:
+                if core is not None:
+                    logging.error(f"Unable to export \"{core.image_path}\": {error}")
+            self.signals.finished.emit(self.cancel_event.is_set(), len(written),
+                                       [(core, str(error)) for core, error in errors])
@@ -0,0 +1,225 @@
+import io
+import logging
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from instrumentation import PROFILER
+from utils import DEFAULT_TARGET_IMAGE_SIZE, DEFAULT_PREFETCH_THREADS
+
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+EXIF_ORIENTATION_TAG = 0x0112
+# Start-of-frame markers carry the image size, 0xC4, 0xC8 and 0xCC are other segments in the same range
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+REDUCED_READ_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                      (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def resize_and_crop(image, target_size=DEFAULT_TARGET_IMAGE_SIZE):
+    if target_size is None:
+        return image  # Full resolution, used by tiled detection
+    # Resize so height is target_size
+    h, w = image.shape[:2]
+    scale = target_size / h
+    new_w = int(w * scale)
+    resized = cv2.resize(image, (new_w, target_size), interpolation=cv2.INTER_AREA)
+    # Crop width to target_size, centered
+    start_x = max((new_w - target_size) // 2, 0)
+    cropped = resized[:, start_x:start_x + target_size]
+    return cropped
+
+
+def parse_exif_orientation(exif):
+    """
+    Return the orientation tag of an APP1 EXIF payload (without the "Exif\\0\\0" prefix), or 1 if it has none.
+    """
+    if len(exif) < 8 or exif[:2] not in (b'II', b'MM'):
+        return 1
+    endian = '<' if exif[:2] == b'II' else '>'
+    ifd_offset = struct.unpack(endian + 'I', exif[4:8])[0]
+    if ifd_offset + 2 > len(exif):
+        return 1
+    num_entries = struct.unpack(endian + 'H', exif[ifd_offset:ifd_offset + 2])[0]
+    for i in range(num_entries):
+        entry = ifd_offset + 2 + i * 12
+        if entry + 12 > len(exif):
+            break
+        tag, _, _ = struct.unpack(endian + 'HHI', exif[entry:entry + 8])
+        if tag == EXIF_ORIENTATION_TAG:
+            return struct.unpack(endian + 'H', exif[entry + 8:entry + 10])[0]
+    return 1
+
+
+def read_jpeg_header(image_path):
+    """
+    Read the stored size and EXIF orientation of a JPEG file without decoding it, see parse_jpeg_header.
+    """
+    with open(image_path, "rb") as f:
+        return parse_jpeg_header(f)
+
+
+def parse_jpeg_header(f):
+    """
+    Parse the stored size and EXIF orientation of a JPEG from a binary file object, without decoding it.
+    :return: (height, width, orientation) with height and width as displayed after applying the orientation, or None
+    if the data is not a JPEG or its header could not be parsed.
+    """
+    orientation = 1
+    if f.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        if marker[1] == 0xFF:
+            f.seek(-1, 1)  # Fill byte, the next byte starts the marker
+            continue
+        if marker[1] in (0xD9, 0xDA):
+            return None  # End of image or start of scan before any frame header
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack('>H', length_bytes)[0] - 2
+        if marker[1] in SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            if orientation in (5, 6, 7, 8):
+                height, width = width, height  # Rotated by 90 degrees when displayed
+            return height, width, orientation
+        segment = f.read(length)
+        if marker[1] == 0xE1 and segment.startswith(b'Exif\x00\x00'):
+            orientation = parse_exif_orientation(segment[6:])
+
+
+def get_reduced_read_flag(image_path, target_size):
+    """
+    Pick the smallest libjpeg scale (1/8, 1/4 or 1/2) whose decoded height still covers target_size, so the image
+    is never upscaled by resize_and_crop. Falls back to a full decode for other formats and for full-resolution use.
+    """
+    if target_size is None or not image_path.lower().endswith(JPEG_EXTENSIONS):
+        return cv2.IMREAD_COLOR
+    try:
+        header = read_jpeg_header(image_path)
+    except OSError:
+        header = None
+    return reduced_read_flag(header, target_size)
+
+
+def reduced_read_flag(header, target_size):
+    """The read flag for a JPEG with this read_jpeg_header result, see get_reduced_read_flag."""
+    if target_size is None or header is None:
+        return cv2.IMREAD_COLOR
+    height = header[0]
+    for factor, flag in REDUCED_READ_FLAGS:
+        if height // factor >= target_size:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def decode_image(image_path, target_size=DEFAULT_TARGET_IMAGE_SIZE):
+    """
+    Decode an image at the lowest resolution that still fills target_size, then resize and crop it. cv2.imread
+    applies the EXIF orientation for the reduced modes too.
+    """
+    with PROFILER().stage("imread", image=image_path):
+        image = cv2.imread(image_path, get_reduced_read_flag(image_path, target_size))
+    if image is None:
+        raise FileNotFoundError(f"Image not found at path: {image_path}")
+    with PROFILER().stage("resize_and_crop", image=image_path):
+        return resize_and_crop(image, target_size)
+
+
+def decode_image_data(data, target_size=DEFAULT_TARGET_IMAGE_SIZE):
+    """
+    decode_image for the contents of an image file held in memory, e.g. an upload. Decodes at the same reduced JPEG
+    scale as decode_image would for the file, so both give the same pixels.
+    """
+    header = parse_jpeg_header(io.BytesIO(data))
+    with PROFILER().stage("imdecode"):
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), reduced_read_flag(header, target_size))
+    if image is None:
+        raise ValueError("The data is not an image OpenCV can decode.")
+    with PROFILER().stage("resize_and_crop"):
+        return resize_and_crop(image, target_size)
+
+
+class ImagePrefetcher:
+    """
+    Decodes plates into the shared image cache on a small thread pool, ahead of when they are shown or counted.
+    cv2.imread releases the GIL, so several files decode in parallel. Loads that are already cached or in flight are
+    not submitted again, and a plate read while it is being prefetched waits for that decode (see ImageCache.get).
+    """
+
+    def __init__(self, max_workers=DEFAULT_PREFETCH_THREADS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-prefetch")
+        self._lock = threading.Lock()
+        self._pending = {}  # Image cache key -> Future
+
+    def prefetch(self, cores):
+        """
+        Start decoding every core whose image is not cached yet. Cores are submitted in order, so pass the most
+        urgent ones first.
+        """
+        for core in cores:
+            if core.image_path is None or core.is_image_loaded():
+                continue
+            key = core.image_cache_key()
+            with self._lock:
+                if key in self._pending:
+                    continue
+                future = self._executor.submit(self._load, core)
+                self._pending[key] = future
+            future.add_done_callback(lambda _, key=key: self._finish(key))
+
+    def _load(self, core):
+        try:
+            core.load_image()
+        except Exception as e:
+            # Reported by whoever actually needs the image
+            logging.debug(f"Unable to prefetch \"{core.image_path}\": {e}")
+
+    def _finish(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def cancel(self):
+        """Drop prefetches that have not started yet, e.g. when another image set is opened."""
+        with self._lock:
+            futures = list(self._pending.values())
+        for future in futures:
+            future.cancel()
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=True)
+
+
+__IMAGE_PREFETCHER__ = None
+__IMAGE_PREFETCHER_LOCK__ = threading.Lock()
+
+
+def IMAGE_PREFETCHER():
+    global __IMAGE_PREFETCHER__
+    with __IMAGE_PREFETCHER_LOCK__:
+        if __IMAGE_PREFETCHER__ is None:
+            __IMAGE_PREFETCHER__ = ImagePrefetcher()
+        return __IMAGE_PREFETCHER__
+
+
+def prefetch_neighbours(cores, index, count):
+    """Prefetch up to count plates on each side of index, nearest first."""
+    neighbours = []
+    for offset in range(1, count + 1):
+        for i in (index + offset, index - offset):
+            if 0 <= i < len(cores):
+                neighbours.append(cores[i])
+    IMAGE_PREFETCHER().prefetch(neighbours)
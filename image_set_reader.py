@@ -1,25 +1,43 @@
 import logging
-from time import sleep, time
 
 from PySide6.QtGui import QWheelEvent
 
-from blob_counter_worker import BlobCounterWorker
+from blob_counter_worker import BlobCountScheduler
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 import math
 import os
-import xml.dom.minidom
-import xml.etree.ElementTree as ET
-import cv2
-from PySide6.QtCore import Qt, QEvent, QThread
+from PySide6.QtCore import Qt, QEvent, QThreadPool
 from PySide6.QtWidgets import QListWidget, QFileDialog, QWidget, QHBoxLayout, QVBoxLayout, QPushButton, \
-    QApplication, QGroupBox, QStackedWidget, QProgressDialog, QMessageBox
+    QApplication, QGroupBox, QProgressDialog, QMessageBox, QComboBox
 
+from blob_counter import create_blob_counter, evict_unused_models
+from blob_detector_core import BlobDetectorCore
+from blob_detector_logic import BlobDetectorLogic
 from blob_detector_ui import BlobDetectorUI
 from excel_output import ExcelOutput
+from image_cache import IMAGE_CACHE
+from image_export_worker import CountedImageExportTask
+from image_loader import IMAGE_PREFETCHER, prefetch_neighbours
+from instrumentation import PROFILER, report_profile
+from keypoint_archive import save_keypoint_archive
+from keypoint_export import save_keypoints_as_xml, get_day_folder, EXPORT_IMAGE_FORMATS
+from keypoint_store import KeypointStore
 from logger import LOGGER
-from utils import DEFAULT_DILUTION, IMAGE_LIST_WIDGET_WIDTH
+from utils import DEFAULT_DILUTION, IMAGE_LIST_WIDGET_WIDTH, DEFAULT_INFERENCE_BATCH_SIZE, \
+    DEFAULT_MAX_COUNTING_THREADS, DEFAULT_TARGET_IMAGE_SIZE, DEFAULT_PREFETCH_DISTANCE, DEFAULT_OUTPUT_FOLDER, \
+    KEYPOINT_ARCHIVE_FOLDER, DEFAULT_EXPORT_IMAGE_FORMAT, DEFAULT_DETECTION_BACKEND, BACKEND_YOLO, BACKEND_YOLO_TILED, \
+    BACKEND_SIMPLE_BLOB, BACKEND_ONNX, BACKEND_ONNX_INT8, BACKEND_CASCADE
+
+DETECTION_BACKEND_LABELS = {
+    BACKEND_YOLO: "YOLO",
+    BACKEND_YOLO_TILED: "YOLO, Tiled Full Resolution",
+    BACKEND_ONNX: "YOLO, ONNX Runtime",
+    BACKEND_ONNX_INT8: "YOLO, ONNX Runtime INT8",
+    BACKEND_CASCADE: "YOLO Cascade, Small Then Large",
+    BACKEND_SIMPLE_BLOB: "SimpleBlobDetector (Fast)",
+}
 
 
 def extract_sample_number(item_text):
@@ -31,10 +49,24 @@ def extract_sample_number(item_text):
 
 
 class ImageSetBlobDetector(QWidget):
-    def __init__(self):
+    """
+    Image set window. Every plate is a lightweight BlobDetectorCore record (path, filename metadata, keypoints) whose
+    pixels are only decoded when the plate is shown or counted. A single BlobDetectorUI viewer displays the selected
+    plate, and the BlobDetectorLogic (undo history, editing) for a plate is only created the first time it is shown.
+    """
+
+    def __init__(self, max_counting_threads=DEFAULT_MAX_COUNTING_THREADS):
         super().__init__()
-        self.currently_updating = False
-        self.blob_detector_logic_list= []
+        self.max_counting_threads = max_counting_threads
+        self.blob_count_scheduler = None
+        self.counting_rows = {}  # Image path -> image list row of the plates being counted
+        self.edits_at_count_start = {}  # Image path -> last undoable action of the open plates when counting started
+        self.export_task = None
+        self.export_image_quality = None  # PNG compression level or JPEG/WebP quality, None for the OpenCV default
+        self.blob_counter = create_blob_counter(DEFAULT_DETECTION_BACKEND)  # Shared by every plate in the set
+        self.records = []
+        self.blob_detector_logics = {}  # Image path -> BlobDetectorLogic, created on first display
+        self.current_index = -1
         self.image_paths = []
         self.timepoints = []
         self.initUI()
@@ -46,15 +78,11 @@ class ImageSetBlobDetector(QWidget):
         # Add image list widget
         self.create_image_list_widget()
 
-        # Add blob detector UI
-        self.blob_detector_stack = QStackedWidget()
-        self.layout.addWidget(self.blob_detector_stack)
+        # Add the single blob detector viewer, blank until a plate is selected
+        self.blob_detector_ui = BlobDetectorUI(image_path=None, image_set_reader=self)
+        self.layout.addWidget(self.blob_detector_ui)
         self.progress_dialog = None
 
-        # Add a blank BlobDetectorUI widget initially
-        blank_blob_detector = BlobDetectorUI(image_path=None, image_set_reader=self)
-        self.blob_detector_stack.addWidget(blank_blob_detector)
-
         # Create tools panel
         self.create_tools_panel()
 
@@ -63,21 +91,17 @@ class ImageSetBlobDetector(QWidget):
 
     # noinspection PyTypeChecker
     def eventFilter(self, source, event):
+        if self.current_index == -1:
+            return super().eventFilter(source, event)
         if event.type() == QEvent.Type.MouseMove or event.type() == QEvent.Type.MouseButtonPress or event.type() == QEvent.Type.MouseButtonRelease:
-            current_widget = self.blob_detector_stack.currentWidget()
-            if isinstance(current_widget, BlobDetectorUI):
-                return current_widget.handle_mouse_event(event)
+            return self.blob_detector_ui.handle_mouse_event(event)
         elif event.type() == QEvent.Type.Wheel:
             event = event if isinstance(event, QWheelEvent) else None
-            current_widget = self.blob_detector_stack.currentWidget()
-            if isinstance(current_widget, BlobDetectorUI):
-                current_widget.handle_wheel_zoom(event)
-                return True
+            self.blob_detector_ui.handle_wheel_zoom(event)
+            return True
         elif event.type() == QEvent.Type.KeyPress:
-            current_widget = self.blob_detector_stack.currentWidget()
-            if isinstance(current_widget, BlobDetectorUI):
-                current_widget.handle_key_zoom(event)
-                return True
+            self.blob_detector_ui.handle_key_zoom(event)
+            return True
         return super().eventFilter(source, event)
 
     def create_tools_panel(self):
@@ -96,14 +120,33 @@ class ImageSetBlobDetector(QWidget):
         self.controls_layout.addWidget(self.update_all_button)
         self.update_all_button.setEnabled(False)
 
-        self.export_button = QPushButton('Export Counted Images to XML and PNG')
+        self.backend_combo_box = QComboBox()
+        self.backend_combo_box.setToolTip('Detection backend for this image set. Tiled YOLO counts overlapping tiles '
+                                          'of the full-resolution image: slower, but finds small colonies and '
+                                          'colonies near the plate edge. SimpleBlobDetector counts in milliseconds '
+                                          'and is tuned with the parameter sliders.')
+        for backend, label in DETECTION_BACKEND_LABELS.items():
+            self.backend_combo_box.addItem(label, backend)
+        self.backend_combo_box.setCurrentIndex(self.backend_combo_box.findData(self.blob_counter.backend))
+        self.backend_combo_box.currentIndexChanged.connect(
+            lambda _: self.set_detection_backend(self.backend_combo_box.currentData()))
+        self.controls_layout.addWidget(self.backend_combo_box)
+
+        self.export_button = QPushButton('Export Counted Images, XML and NPY')
         # self.export_button.setIcon(QIcon('icons/export.svg'))
         self.export_button.clicked.connect(self.export_counted_images)
+        self.export_format_combo_box = QComboBox()
+        self.export_format_combo_box.setToolTip('Image format of the exported counted images.')
+        for image_format in EXPORT_IMAGE_FORMATS:
+            self.export_format_combo_box.addItem(image_format.upper(), image_format)
+        self.export_format_combo_box.setCurrentIndex(
+            self.export_format_combo_box.findData(DEFAULT_EXPORT_IMAGE_FORMAT))
         self.export_to_excel_button = QPushButton('Export Blob Counts to Excel')
         self.export_to_excel_button.clicked.connect(self.export_to_excel)
 
 
         self.controls_layout.addWidget(self.export_button)
+        self.controls_layout.addWidget(self.export_format_combo_box)
         self.controls_layout.addWidget(self.export_to_excel_button)
         self.export_button.setEnabled(False)
         self.export_to_excel_button.setEnabled(False)
@@ -132,255 +175,290 @@ class ImageSetBlobDetector(QWidget):
             LOGGER().warning("No images found in the selected folder.")
             QMessageBox.warning(self, "No Images Found", "No images found in the selected folder.")
             return
+        IMAGE_PREFETCHER().cancel()  # Plates of the previous set are no longer needed
         self.image_list_widget.clear()
         self.timepoints.clear()
-
-        # Remove all widgets from the stack
-        while self.blob_detector_stack.count() > 0:
-            self.blob_detector_stack.removeWidget(self.blob_detector_stack.widget(0))
-
-        progress_dialog = self.show_progress_dialog(len(self.image_paths), "Loading Images...", "Cancel")
-        QApplication.processEvents()
-
-        for i, image_path in enumerate(self.image_paths):
-            blob_detector_ui = BlobDetectorUI(image_path, image_set_reader=self)
-            self.blob_detector_stack.addWidget(blob_detector_ui)
-            self.add_to_image_list(blob_detector_ui.blob_detector_logic)
-            progress_dialog.setValue(i + 1)
-            QApplication.processEvents()
-        progress_dialog.close()
+        self.blob_detector_logics.clear()
+        self.current_index = -1
+        self.blob_detector_ui.set_blob_detector_logic(None)
+
+        # Only the file names are parsed here, pixels are decoded when a plate is shown or counted
+        self.records = [BlobDetectorCore(image_path, blob_counter=self.blob_counter, load_image=False)
+                        for image_path in self.image_paths]
+        for record in self.records:
+            record.target_size = self.get_target_size()
         self.update_image_list()
         if self.timepoints:
             self.export_button.setEnabled(True)
             self.export_to_excel_button.setEnabled(True)
             self.update_all_button.setEnabled(True)
-        QApplication.processEvents()
+            self.show_image(0)
+
+    def get_target_size(self, backend=None):
+        # Tiled detection works on the full-resolution image, so nothing is downscaled or cropped
+        backend = backend or self.blob_counter.backend
+        return None if backend == BACKEND_YOLO_TILED else DEFAULT_TARGET_IMAGE_SIZE
+
+    def set_detection_backend(self, backend):
+        if backend == self.blob_counter.backend:
+            return
+        if self.blob_count_scheduler is not None and self.blob_count_scheduler.is_running():
+            self.revert_backend_combo_box()
+            return
+        # Keypoints are in the coordinates of the image they were counted on, so they only survive the switch if
+        # both backends count on the same preprocessed image
+        target_size_changes = self.get_target_size(backend) != self.get_target_size()
+        if target_size_changes and any(record.keypoints for record in self.records):
+            answer = QMessageBox.question(self, "Change Detection Mode",
+                                          "Changing the detection mode discards all counted keypoints. Continue?")
+            if answer != QMessageBox.StandardButton.Yes:
+                self.revert_backend_combo_box()
+                return
+        self.blob_counter.close()
+        self.blob_counter = create_blob_counter(backend)
+        evict_unused_models()  # The old backend's weights are not held by anything anymore
+        for record in self.records:
+            record.blob_counter = self.blob_counter
+            if target_size_changes:
+                record.unload_image()
+                record.target_size = self.get_target_size()
+                record.set_keypoints(KeypointStore())
+        blank_logic = self.blob_detector_ui.blank_blob_detector_logic
+        if blank_logic is not None:
+            blank_logic.yolo_blob_counter = self.blob_counter
+        if target_size_changes:
+            # Logics hold undo history in the old coordinates, recreate them on next display
+            self.blob_detector_logics.clear()
+            self.update_image_list()
+        if self.current_index != -1:
+            self.show_image(self.current_index)
+        self.blob_detector_ui.update_detection_settings_controls()
+        logging.info(f"Detection backend set to {DETECTION_BACKEND_LABELS[backend]}.")
+
+    def revert_backend_combo_box(self):
+        self.backend_combo_box.blockSignals(True)
+        self.backend_combo_box.setCurrentIndex(self.backend_combo_box.findData(self.blob_counter.backend))
+        self.backend_combo_box.blockSignals(False)
+
+    def get_blob_detector_logic(self, index) -> BlobDetectorLogic:
+        record = self.records[index]
+        logic = self.blob_detector_logics.get(record.image_path)
+        if logic is None:
+            logic = BlobDetectorLogic(self.blob_detector_ui, image_set_reader=self, core=record)
+            self.blob_detector_logics[record.image_path] = logic
+        return logic
+
+    def show_image(self, index):
+        if not 0 <= index < len(self.records):
+            return
+        # Start decoding the neighbours first so they are ready by the time the user moves on
+        prefetch_neighbours(self.records, index, DEFAULT_PREFETCH_DISTANCE)
+        if self.blob_count_scheduler is not None and self.blob_count_scheduler.is_running():
+            self.blob_count_scheduler.set_focus(index)  # Count the plate being looked at next
+        try:
+            logic = self.get_blob_detector_logic(index)
+            self.current_index = index
+            with PROFILER().stage("show_image", image=logic.image_path):
+                self.blob_detector_ui.set_blob_detector_logic(logic)
+        except FileNotFoundError as e:
+            logging.error(f"Unable to display image: {e}")
+            QMessageBox.warning(self, "Unable to Load Image", str(e))
+            return
+        self.image_list_widget.setCurrentRow(index)
 
     def handle_image_list_widget_item_clicked(self, item):
         selected_index = self.image_list_widget.row(item) # Get the index of item just clicked on
-        # Set the current index of the StackedWidget to the newly selected index
-        # This displays the proper BlobDetectorUI widget
-        self.blob_detector_stack.setCurrentIndex(selected_index)
-        current_widget = self.blob_detector_stack.currentWidget()
-        if isinstance(current_widget, BlobDetectorUI):
-            current_widget.update_display_image() # Update the displayed image for the selected BlobDetectorUI widget
-
-    def show_progress_dialog(self, max_value, message, cancel_button_text):
+        self.show_image(selected_index)
+
+    def show_progress_dialog(self, max_value, message, cancel_button_text, modal=True):
         progress_dialog = QProgressDialog(message, cancel_button_text, 0, max_value, self)
-        progress_dialog.setWindowModality(Qt.WindowModality.WindowModal)
+        progress_dialog.setWindowModality(Qt.WindowModality.WindowModal if modal else Qt.WindowModality.NonModal)
         progress_dialog.setValue(0)
         progress_dialog.show()
         # logging.debug("Progress dialog initialized and shown")
         return progress_dialog
 
     def count_all_blobs(self):
-        i = self.blob_detector_stack.count() - 1
-        while i >= 0:
-            cur_logic = self.blob_detector_stack.widget(i).blob_detector_logic
-            if cur_logic.image_path is None:
-                self.blob_detector_stack.removeWidget(cur_logic)
-                self.image_list_widget.takeItem(i)
-                logging.debug("Image list widget removed at index: %s", i)
-            i -= 1
-        self.progress_dialog = self.show_progress_dialog(self.blob_detector_stack.count() + 1, "Counting Blobs...",
-                                                         "Cancel")
+        if self.blob_count_scheduler is not None and self.blob_count_scheduler.is_running():
+            return
+        if not self.records:
+            return
+        # Plates that are already open are counted through their logic so the viewer and undo history stay in sync
+        countables = [self.blob_detector_logics.get(record.image_path, record) for record in self.records]
+
+        # Not modal, so plates can be reviewed while the rest of the set is counted
+        self.progress_dialog = self.show_progress_dialog(len(countables), "Counting Blobs...", "Cancel", modal=False)
         self.progress_dialog.setAutoClose(False)
         self.progress_dialog.setAutoReset(False)
         self.progress_dialog.setValue(0)
-        QApplication.processEvents()
-
-        self.threads = []
-        self.workers = []
-        self.completed_tasks = 0
-
-        def update_progress():
-            self.completed_tasks += 1
-            self.progress_dialog.setValue(self.completed_tasks)
-            QApplication.processEvents()
-
-        for i in range(self.blob_detector_stack.count()):
-            ui = self.blob_detector_stack.widget(i)
-            ui = ui if isinstance(ui, BlobDetectorUI) else None
-            logic = ui.blob_detector_logic
-            if logic.image_path is None:
-                continue
-            worker = BlobCounterWorker(logic)
-            thread = QThread()
-            worker.moveToThread(thread)
-            worker.progress.connect(update_progress)
-            worker.finished.connect(thread.quit)
-            worker.finished.connect(worker.deleteLater)
-            thread.finished.connect(thread.deleteLater)
-            worker.error.connect(lambda e: logging.error(f"Error counting blobs: {e}"))
-            thread.started.connect(worker.run)
-            self.threads.append(thread)
-            self.workers.append(worker)
-            thread.start()
-
-        start_time = time()
-        timeout = 30000  # Timeout in seconds
-
-        while self.progress_dialog.isVisible():
-            sleep(0.01)
-            QApplication.processEvents()
-            if self.completed_tasks >= self.blob_detector_stack.count():
-                self.update_displayed_blob_counts_finished_loading()
-                self.progress_dialog.setValue(self.progress_dialog.value() + 1)
-                logging.debug("All tasks completed, closing progress dialog.")
-                self.progress_dialog.close()
-                break
-            if time() - start_time > timeout:
-                logging.warning("Timeout reached, forcing progress dialog to close.")
-                self.progress_dialog.close()
-                break
-
-    def __update_displayed_blob_counts__(self):
-        for i in range(self.blob_detector_stack.count()):
-            widget = self.blob_detector_stack.widget(i)
-            if isinstance(widget, BlobDetectorUI):
-                if i >= self.blob_detector_stack.count():
-                    continue
-                blob_detector_logic = self.blob_detector_stack.widget(i).blob_detector_logic
-                if blob_detector_logic.image_path is None:
-                    continue
-                list_name = blob_detector_logic.get_custom_name(DEFAULT_DILUTION)
-                widget.update_display_image()
-                if len(blob_detector_logic.keypoints) > 0:
-                    self.image_list_widget.item(i).setText(f"{list_name} - Keypoints: {len(blob_detector_logic.keypoints)}")
-
-    def update_all_displayed_blob_counts(self):
-        if self.currently_updating:
-            return
-        self.__update_displayed_blob_counts__()
+
+        PROFILER().reset()  # The summary logged when counting finishes covers this run only
+        # All plates share one model, so a small bounded pool counts them in batches
+        self.blob_count_scheduler = BlobCountScheduler(self.blob_counter,
+                                                       max_concurrency=self.max_counting_threads,
+                                                       batch_size=DEFAULT_INFERENCE_BATCH_SIZE,
+                                                       apply_keypoints=self.apply_counted_keypoints, parent=self)
+        self.blob_count_scheduler.image_counted.connect(self.handle_image_counted)
+        self.blob_count_scheduler.progress.connect(self.handle_count_progress)
+        self.blob_count_scheduler.finished.connect(self.handle_count_finished)
+        self.progress_dialog.canceled.connect(self.blob_count_scheduler.cancel)
+        self.set_counting_controls_enabled(False)
+        self.counting_rows = {record.image_path: row for row, record in enumerate(self.records)}
+        self.edits_at_count_start = {path: logic.undo_redo_tracker.last_action()
+                                     for path, logic in self.blob_detector_logics.items()}
+        # Countables are in list order, so the focus index is the selected row of the image list
+        self.blob_count_scheduler.start(countables, focus_index=max(self.current_index, 0))
+
+    def set_counting_controls_enabled(self, enabled):
+        # Loading another set or exporting while counting would act on a half-counted set
+        for widget in (self.update_all_button, self.open_folder_button, self.backend_combo_box,
+                       self.export_button, self.export_to_excel_button):
+            widget.setEnabled(enabled)
+
+    def apply_counted_keypoints(self, countable, keypoints):
+        # Plates stay editable while the set is counted, and edits made since counting started win over the new count
+        logic = self.blob_detector_logics.get(countable.image_path)
+        if logic is None:
+            countable.set_keypoints(keypoints)
+        elif logic.undo_redo_tracker.last_action() is self.edits_at_count_start.get(countable.image_path):
+            logic.set_keypoints(keypoints)  # Undoable, and redraws the viewer if the plate is on screen
+        else:
+            logging.info(f"Kept the keypoints edited in \"{countable.image_path}\" instead of its new count.")
+
+    def handle_image_counted(self, countable, keypoints_length):
+        self.update_displayed_blob_count_at(self.counting_rows[countable.image_path], keypoints_length)
+
+    def handle_count_progress(self, completed, total):
+        if self.progress_dialog is not None:
+            self.progress_dialog.setValue(completed)
+
+    def handle_count_finished(self, cancelled):
+        scheduler = self.blob_count_scheduler
+        if self.progress_dialog is not None:
+            self.progress_dialog.canceled.disconnect(scheduler.cancel)
+            self.progress_dialog.close()
+            self.progress_dialog = None
+        self.set_counting_controls_enabled(True)
+        if cancelled:
+            logging.info(f"Blob counting cancelled after {scheduler.completed} of {scheduler.total} images.")
+        else:
+            logging.debug("All tasks completed, closing progress dialog.")
+        logging.info(IMAGE_CACHE().report())
+        if self.blob_counter.detection_cache is not None:
+            logging.info(self.blob_counter.detection_cache.report())
+        if self.blob_counter.report() is not None:
+            logging.info(self.blob_counter.report())
+        report_profile()
+        if scheduler.errors:
+            details = "\n".join(f"{os.path.basename(path)}: {message}" for path, message in scheduler.errors)
+            QMessageBox.warning(self, "Blob Counting Errors",
+                                f"Unable to count blobs in {len(scheduler.errors)} image(s):\n{details}")
 
     def update_displayed_blob_count(self, keypoints_length):
-        index = self.blob_detector_stack.indexOf(self.blob_detector_stack.currentWidget())
-        if index == -1:
+        if self.current_index == -1:
             return
-        list_name = self.blob_detector_stack.widget(index).blob_detector_logic.get_custom_name(DEFAULT_DILUTION)
-        self.image_list_widget.item(index).setText(f"{list_name} - Keypoints: {keypoints_length}")
-
-    def update_displayed_blob_counts_finished_loading(self):
-        self.currently_updating = True
-        self.__update_displayed_blob_counts__()
-        QApplication.processEvents()
-        self.currently_updating = False
+        self.update_displayed_blob_count_at(self.current_index, keypoints_length)
 
-
-    def add_to_image_list(self, blob_detector_logic):
-        list_name = blob_detector_logic.get_custom_name(DEFAULT_DILUTION)
-        self.image_list_widget.addItem(f"{list_name}")
-        self.timepoints.append(blob_detector_logic.get_timepoint())
+    def update_displayed_blob_count_at(self, index, keypoints_length):
+        list_name = self.records[index].get_custom_name(DEFAULT_DILUTION)
+        self.image_list_widget.item(index).setText(f"{list_name} - Keypoints: {keypoints_length}")
 
     def update_image_list(self):
-        old_selected_index = self.image_list_widget.selectedIndexes()[
-            0].row() if self.image_list_widget.selectedIndexes() else 0
-        timepoints_with_widgets = []
-        for i in range(self.blob_detector_stack.count()):
-            widget = self.blob_detector_stack.widget(i)
-            if isinstance(widget, BlobDetectorUI):
-                widget.blob_detector_logic.update_timepoint()
-                timepoints_with_widgets.append((widget.blob_detector_logic.get_timepoint(), widget))
-        # Sort timepoints and widgets by sample number
-        timepoints_with_widgets.sort(key=lambda x: x[0].sample_number if x[0] else math.inf)
-
-        # Re-order widgets in the StackedWidget and in the Image List Widget and the timepoints list - these shoudld always be ordered the same
-        # Clear the Image List Widget and the list of timepoints first
+        current_record = self.records[self.current_index] if self.current_index != -1 else None
+        for record in self.records:
+            record.update_timepoint()
+        # Sort records by sample number
+        self.records.sort(key=lambda record: record.sample_number if record.sample_number != -1 else math.inf)
+        self.timepoints = [record.get_timepoint() for record in self.records]
+
+        # The list widget and the timepoints list are always ordered the same as the records
         self.image_list_widget.clear()
-        self.timepoints = []
-        for _, (timepoint, widget) in enumerate(timepoints_with_widgets):
-            # Start by removing every single widget - we want to add them all back in the correct order
-            self.blob_detector_stack.removeWidget(widget)
-        # Add the widgets back in the correct order to both the StackedWidget and the Image List Widget
-        for _, (timepoint, widget) in enumerate(timepoints_with_widgets):
-            self.blob_detector_stack.addWidget(widget)
-            list_name = widget.blob_detector_logic.get_custom_name(DEFAULT_DILUTION)
-            self.image_list_widget.addItem(f"{list_name}")
-            self.timepoints.append(timepoint)
-
-        # Ensure the correct widget is selected
-        self.image_list_widget.setCurrentRow(old_selected_index)
-        self.blob_detector_stack.setCurrentIndex(old_selected_index)
+        for record in self.records:
+            list_name = record.get_custom_name(DEFAULT_DILUTION)
+            if len(record.keypoints) > 0:
+                list_name = f"{list_name} - Keypoints: {len(record.keypoints)}"
+            self.image_list_widget.addItem(list_name)
+
+        # Ensure the correct plate is selected
+        if current_record is not None:
+            self.current_index = self.records.index(current_record)
+            self.image_list_widget.setCurrentRow(self.current_index)
 
     def export_to_excel(self):
-        if not self.timepoints:
+        if not self.records:
             return
         # Update timepoints with the latest keypoint counts, should be redundant
-        self.timepoints.clear()
-        for i in range(self.blob_detector_stack.count()):
-            widget = self.blob_detector_stack.widget(i)
-            if isinstance(widget, BlobDetectorUI):
-                widget.blob_detector_logic.update_timepoint()
-                self.timepoints.append(widget.blob_detector_logic.get_timepoint())
+        for record in self.records:
+            record.update_timepoint()
+        self.timepoints = [record.get_timepoint() for record in self.records]
         file_path, _ = QFileDialog.getSaveFileName(self, "Save Blob Counts", "", "Excel Files (*.xlsx)")
         if not file_path:
             return
         excel_output = ExcelOutput(file_path)
-        for timepoint in self.timepoints:
-            if timepoint is not None:
-                excel_output.write_blob_counts(timepoint.day, timepoint.sample_number, timepoint.num_keypoints)
+        unmatched = excel_output.write_all_blob_counts(self.timepoints)
         excel_output.save()
         logging.info(f"SUCCESS: Blob counts exported to Excel and saved to disk in file: \"{file_path}\".")
+        if unmatched:
+            details = "\n".join(f"{os.path.basename(timepoint.filename)}: {reason}" for timepoint, reason in unmatched)
+            QMessageBox.warning(self, "Samples Not Exported",
+                                f"{len(unmatched)} sample(s) could not be placed in the Excel sheet:\n{details}")
 
     def export_counted_images(self):
+        if self.export_task is not None or not self.records:
+            return
         self.save_all_keypoints_as_xml()
-        logging.info(
-            f"About to save counted images to disk, this may take a while...\".")
-        day = -1
-        for timepoint in self.timepoints:
-            if timepoint is not None and timepoint.day != -1:
-                if day == -1:
-                    day = timepoint.day
-                self.save_image_with_keypoints(timepoint)
-        day_folder = os.path.join("counted_images", f"Day {day}")
-        logging.info(
-            f"SUCCESS: Images with counted keypoints saved to disk in folder: \"{os.path.join(day_folder, 'counted_images')}\".")
-
-    def save_image_with_keypoints(self, timepoint):
-        day_folder = os.path.join("counted_images", f"Day {timepoint.day}")
-        os.makedirs(day_folder, exist_ok=True)
-        for i in range(self.blob_detector_stack.count()):
-            widget = self.blob_detector_stack.widget(i)
-            if isinstance(widget, BlobDetectorUI) and widget.blob_detector_logic.get_timepoint().filename == timepoint.filename:
-                image_with_keypoints = widget.blob_detector_logic.get_display_image()
-                image_path = os.path.join(day_folder, f"{timepoint.filename=}.png") if timepoint.sample_number == -1 \
-                    else os.path.join(day_folder, f"Sample_{timepoint.sample_number}.png")
-                cv2.imwrite(image_path, image_with_keypoints)  # Save without converting to BGR
-                break
+        self.save_keypoint_archive()
+        # Records and timepoints are ordered the same, so each plate is exported straight from its record
+        cores = [record for record, timepoint in zip(self.records, self.timepoints)
+                 if timepoint is not None and timepoint.day != -1]
+        if not cores:
+            return
+        logging.info(f"About to save {len(cores)} counted images to disk...")
+        self.export_task = CountedImageExportTask(cores, DEFAULT_OUTPUT_FOLDER,
+                                                  self.export_format_combo_box.currentData(),
+                                                  self.export_image_quality)
+        self.export_task.setAutoDelete(False)  # Kept alive until its finished signal is handled
+        self.export_task.signals.progress.connect(self.handle_export_progress)
+        self.export_task.signals.finished.connect(self.handle_export_finished)
+        # The dialog is modal, so keypoints cannot be edited while the plates are rendered
+        self.progress_dialog = self.show_progress_dialog(len(cores), "Exporting Counted Images...", "Cancel")
+        self.progress_dialog.setAutoClose(False)
+        self.progress_dialog.setAutoReset(False)
+        self.progress_dialog.canceled.connect(self.export_task.cancel)
+        self.export_button.setEnabled(False)
+        QThreadPool.globalInstance().start(self.export_task)
+
+    def handle_export_progress(self, completed, total):
+        if self.progress_dialog is not None:
+            self.progress_dialog.setValue(completed)
+
+    def handle_export_finished(self, cancelled, written, errors):
+        task = self.export_task
+        self.export_task = None
+        if self.progress_dialog is not None:
+            self.progress_dialog.canceled.disconnect(task.cancel)
+            self.progress_dialog.close()
+            self.progress_dialog = None
+        self.export_button.setEnabled(True)
+        day_folder = get_day_folder(task.cores[0].get_timepoint().day)
+        if cancelled:
+            logging.info(f"Export cancelled after saving {written} of {len(task.cores)} counted images.")
+        else:
+            logging.info(f"SUCCESS: Images with counted keypoints saved to disk in folder: \"{day_folder}\".")
+        if errors:
+            details = "\n".join(f"{os.path.basename(core.image_path) if core is not None else 'Export'}: {message}"
+                                for core, message in errors)
+            QMessageBox.warning(self, "Export Errors", f"Unable to export {len(errors)} image(s):\n{details}")
+
+    def save_keypoint_archive(self):
+        if not self.records:
+            return
+        archive_path = os.path.join(DEFAULT_OUTPUT_FOLDER, KEYPOINT_ARCHIVE_FOLDER)
+        save_keypoint_archive(((record.get_timepoint(), record.keypoints) for record in self.records),
+                              archive_path, preprocessing=self.records[0].preprocessing_settings())
+        logging.info(f"SUCCESS: Keypoint archive saved to disk in folder: \"{archive_path}\".")
 
     def save_all_keypoints_as_xml(self):
-        root = ET.Element("Keypoints")
-        day_element = None
-        for i in range(self.blob_detector_stack.count()):
-            widget = self.blob_detector_stack.widget(i)
-            if isinstance(widget, BlobDetectorUI):
-                keypoints = widget.blob_detector_logic.keypoints
-                timepoint = widget.blob_detector_logic.get_timepoint()
-                if timepoint is None:
-                    continue
-                if day_element is None or day_element.get("number") != str(timepoint.day):
-                    day_element = ET.SubElement(root, "Day")
-                    day_element.set("number", str(timepoint.day))
-                sample_element = ET.SubElement(day_element, "Sample")
-                if timepoint.sample_number == -1:
-                    sample_element.set("filename", timepoint.filename)
-                else:
-                    sample_element.set("number", str(timepoint.sample_number))
-                for keypoint in keypoints:
-                    kp_element = ET.SubElement(sample_element, "Keypoint")
-                    ET.SubElement(kp_element, "X").text = str(keypoint.pt[0])
-                    ET.SubElement(kp_element, "Y").text = str(keypoint.pt[1])
-                    ET.SubElement(kp_element, "Size").text = str(keypoint.size)
-
-        xml_dir_path = os.path.join("counted_images", f"Day {timepoint.day}")
-        os.makedirs(xml_dir_path, exist_ok=True)  # Ensure the directory exists
-        xml_path = os.path.join(xml_dir_path, "keypoints.xml")
-
-        # Pretty print the XML
-        xml_str = ET.tostring(root, encoding='utf-8')
-        parsed_xml = xml.dom.minidom.parseString(xml_str)
-        pretty_xml_str = parsed_xml.toprettyxml(indent="  ")
-
-        with open(xml_path, "w") as f:
-            f.write(pretty_xml_str)
-        logging.info(f"SUCCESS: Keypoints exported to XML and saved to disk at path: \"{xml_path}\".")
\ No newline at end of file
+        # Streamed straight from the records, one sample at a time
+        save_keypoints_as_xml((record.get_timepoint(), record.keypoints) for record in self.records
+                              if record.get_timepoint() is not None)
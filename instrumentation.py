@@ -0,0 +1,155 @@
+import contextlib
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+from utils import PROFILE_ENV_VAR, TRACE_ENV_VAR
+
+NULL_STAGE = contextlib.nullcontext()  # Returned by stage() while profiling is off, reusable and free to enter
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None where it cannot be read."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # Bytes on macOS, kilobytes on Linux
+
+
+class _Stage:
+    __slots__ = ("profiler", "name", "image", "args", "start")
+
+    def __init__(self, profiler, name, image, args):
+        self.profiler = profiler
+        self.name = name
+        self.image = image
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start, self.image, self.args)
+
+
+class StageProfiler:
+    """
+    Records how long each pipeline stage (decode, resize, inference, redraw, ...) takes per image, together with the
+    peak memory of the process, and turns the records into a summary table or a Chrome trace.
+
+    Wrap a stage in `with PROFILER().stage("imread", image=path):`. While profiling is off stage() returns a shared
+    null context, so instrumented code only pays for one attribute check.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._events = []  # (name, image, thread id, start, duration, peak RSS in MB, args)
+        self._origin = time.perf_counter()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self._lock:
+            self._events = []
+            self._origin = time.perf_counter()
+
+    def stage(self, name, image=None, **args):
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name, image, args)
+
+    def record(self, name, start, duration, image=None, args=None):
+        event = (name, image, threading.get_ident(), start, duration, peak_rss_mb(), args or {})
+        with self._lock:
+            self._events.append(event)
+
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def stage_stats(self):
+        """Per-stage statistics in seconds, in the order the stages first ran."""
+        durations, images = {}, {}
+        for name, image, _, _, duration, _, _ in self.events():
+            durations.setdefault(name, []).append(duration)
+            if image is not None:
+                images.setdefault(name, set()).add(image)
+        stats = {}
+        for name, values in durations.items():
+            values.sort()
+            image_count = len(images.get(name, ()))
+            stats[name] = {"calls": len(values), "images": image_count, "total_s": sum(values),
+                           "mean_s": statistics.fmean(values), "median_s": statistics.median(values),
+                           "p95_s": values[min(int(len(values) * 0.95), len(values) - 1)], "max_s": values[-1],
+                           "per_image_s": sum(values) / image_count if image_count else None}
+        return stats
+
+    def summary(self):
+        stats = self.stage_stats()
+        if not stats:
+            return "Profile: no stages recorded."
+        lines = [f"{'Stage':<28}{'Calls':>7}{'Images':>8}{'Total s':>10}{'Mean ms':>10}{'p95 ms':>10}"
+                 f"{'Per image ms':>14}"]
+        for name, stage in sorted(stats.items(), key=lambda item: -item[1]["total_s"]):
+            per_image = f"{stage['per_image_s'] * 1000:.1f}" if stage["per_image_s"] is not None else "-"
+            lines.append(f"{name:<28}{stage['calls']:>7}{stage['images']:>8}{stage['total_s']:>10.2f}"
+                         f"{stage['mean_s'] * 1000:>10.1f}{stage['p95_s'] * 1000:>10.1f}{per_image:>14}")
+        peak = peak_rss_mb()
+        if peak is not None:
+            lines.append(f"Peak memory (RSS): {peak:.0f} MB")
+        return "Profile:\n" + "\n".join(lines)
+
+    def chrome_trace(self):
+        """The recorded stages as Chrome trace events (chrome://tracing, ui.perfetto.dev), with a memory counter."""
+        pid = os.getpid()
+        trace_events = []
+        for name, image, thread_id, start, duration, peak, args in sorted(self.events(), key=lambda e: e[3]):
+            timestamp = (start - self._origin) * 1e6
+            event_args = dict(args, image=os.path.basename(str(image))) if image is not None else dict(args)
+            trace_events.append({"name": name, "cat": "stage", "ph": "X", "ts": timestamp, "dur": duration * 1e6,
+                                 "pid": pid, "tid": thread_id, "args": event_args})
+            if peak is not None:
+                trace_events.append({"name": "peak_rss_mb", "ph": "C", "ts": timestamp + duration * 1e6, "pid": pid,
+                                     "args": {"peak_rss_mb": round(peak, 1)}})
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, path):
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f)
+        return path
+
+
+__PROFILER__ = StageProfiler(enabled=bool(os.environ.get(PROFILE_ENV_VAR) or os.environ.get(TRACE_ENV_VAR)))
+
+
+def PROFILER():
+    return __PROFILER__
+
+
+def report_profile(trace_path=None):
+    """
+    Log the stage summary and write the Chrome trace, if profiling is on. The trace goes to trace_path or the path in
+    the BLOB_COUNTER_TRACE environment variable.
+    """
+    profiler = PROFILER()
+    if not profiler.enabled:
+        return
+    logging.info(profiler.summary())
+    trace_path = trace_path or os.environ.get(TRACE_ENV_VAR)
+    if trace_path:
+        profiler.export_chrome_trace(trace_path)
+        logging.info(f"SUCCESS: Trace saved to disk at path: \"{trace_path}\", open it in ui.perfetto.dev.")
@@ -0,0 +1,104 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from keypoint_store import KeypointStore
+from utils import Timepoint
+
+ARCHIVE_FORMAT_VERSION = 1
+KEYPOINTS_FILE = "keypoints.npy"  # (N, 4) float32 rows of (x, y, size, confidence) for all images back to back
+SOURCES_FILE = "sources.npy"  # (N,) uint8 keypoint source, SOURCE_DETECTED or SOURCE_MANUAL
+OFFSETS_FILE = "offsets.npy"  # (images + 1,) int64, keypoints of image i are rows offsets[i]:offsets[i + 1]
+DAYS_FILE = "days.npy"  # (images,) int32 day of each image, for filtering without reading the metadata
+SAMPLE_NUMBERS_FILE = "sample_numbers.npy"  # (images,) int32 sample number of each image, -1 if unknown
+METADATA_FILE = "metadata.json"  # Format version, preprocessing and the Timepoint fields of each image
+
+
+def save_keypoint_archive(samples, archive_path, preprocessing=None):
+    """
+    Write the keypoints of every sample to a directory of .npy files that can be memory-mapped by training scripts.
+    Keypoint coordinates are in the preprocessed image (see preprocessing, e.g. {"target_size": 1024}).
+    :param samples: Iterable of (timepoint, KeypointStore) pairs.
+    :return: archive_path, or None if there were no samples.
+    """
+    keypoints, sources, counts, images = [], [], [], []
+    for timepoint, store in samples:
+        columns = store.columns()
+        keypoints.append(store.to_array())
+        sources.append(columns["source"])
+        counts.append(len(store))
+        images.append(timepoint._asdict())
+    if not images:
+        return None
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    metadata = {"version": ARCHIVE_FORMAT_VERSION, "preprocessing": preprocessing or {}, "images": images}
+
+    # Write next to the destination and swap it in at the end, so readers never see a half-written archive
+    parent = os.path.dirname(os.path.abspath(archive_path))
+    os.makedirs(parent, exist_ok=True)
+    temp_path = tempfile.mkdtemp(dir=parent, prefix=".keypoint_archive_")
+    try:
+        np.save(os.path.join(temp_path, KEYPOINTS_FILE), np.concatenate(keypoints).astype(np.float32, copy=False))
+        np.save(os.path.join(temp_path, SOURCES_FILE), np.concatenate(sources).astype(np.uint8, copy=False))
+        np.save(os.path.join(temp_path, OFFSETS_FILE), offsets)
+        np.save(os.path.join(temp_path, DAYS_FILE), np.array([image["day"] for image in images], dtype=np.int32))
+        np.save(os.path.join(temp_path, SAMPLE_NUMBERS_FILE),
+                np.array([image["sample_number"] for image in images], dtype=np.int32))
+        with open(os.path.join(temp_path, METADATA_FILE), "w", encoding="utf-8") as f:
+            json.dump(metadata, f, indent=1)
+        if os.path.isdir(archive_path):
+            shutil.rmtree(archive_path)
+        os.replace(temp_path, archive_path)
+    except BaseException:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+    return archive_path
+
+
+class KeypointArchive:
+    """
+    Read access to an archive written by save_keypoint_archive. The keypoint arrays are memory-mapped by default, so
+    opening an archive of any size is cheap and only the images actually read are paged in.
+    """
+
+    def __init__(self, archive_path, mmap=True):
+        self.archive_path = archive_path
+        mmap_mode = "r" if mmap else None
+        with open(os.path.join(archive_path, METADATA_FILE), encoding="utf-8") as f:
+            metadata = json.load(f)
+        if metadata.get("version") != ARCHIVE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported keypoint archive version {metadata.get('version')} in \"{archive_path}\".")
+        self.preprocessing = metadata["preprocessing"]
+        self.timepoints = [Timepoint(**image) for image in metadata["images"]]
+        self.keypoints = np.load(os.path.join(archive_path, KEYPOINTS_FILE), mmap_mode=mmap_mode)
+        self.sources = np.load(os.path.join(archive_path, SOURCES_FILE), mmap_mode=mmap_mode)
+        self.offsets = np.load(os.path.join(archive_path, OFFSETS_FILE))
+        self.days = np.load(os.path.join(archive_path, DAYS_FILE))
+        self.sample_numbers = np.load(os.path.join(archive_path, SAMPLE_NUMBERS_FILE))
+
+    def __len__(self):
+        return len(self.timepoints)
+
+    def __getitem__(self, index):
+        """(timepoint, (N, 4) keypoint array) of one image. The array is a view into the memory map."""
+        return self.timepoints[index], self.keypoints[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def find(self, day, sample_number):
+        """Index of the image with this day and sample number, or None."""
+        matches = np.flatnonzero((self.days == day) & (self.sample_numbers == sample_number))
+        return int(matches[0]) if len(matches) else None
+
+    def to_store(self, index):
+        """The keypoints of one image as an editable KeypointStore."""
+        start, end = self.offsets[index], self.offsets[index + 1]
+        store = KeypointStore.from_detections(np.array(self.keypoints[start:end]))
+        store.source[:end - start] = self.sources[start:end]
+        return store
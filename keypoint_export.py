@@ -0,0 +1,228 @@
+import logging
+import os
+import tempfile
+import threading
+import xml.sax.saxutils
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from instrumentation import PROFILER
+from utils import DEFAULT_OUTPUT_FOLDER, DEFAULT_EXPORT_IMAGE_FORMAT, DEFAULT_EXPORT_THREADS
+
+# Format -> (cv2.imwrite parameter, minimum, maximum). PNG takes a compression level, JPEG and WebP a quality.
+EXPORT_IMAGE_FORMATS = {
+    "png": (cv2.IMWRITE_PNG_COMPRESSION, 0, 9),
+    "jpg": (cv2.IMWRITE_JPEG_QUALITY, 0, 100),
+    "webp": (cv2.IMWRITE_WEBP_QUALITY, 1, 100),
+}
+
+
+def get_day_folder(day, output_root=DEFAULT_OUTPUT_FOLDER):
+    return os.path.join(output_root, f"Day {day}")
+
+
+def get_counted_image_path(timepoint, output_root=DEFAULT_OUTPUT_FOLDER, extension="png"):
+    day_folder = get_day_folder(timepoint.day, output_root)
+    if timepoint.sample_number == -1:
+        file_stem = os.path.splitext(os.path.basename(timepoint.filename))[0]
+        return os.path.join(day_folder, f"{file_stem}.{extension}")
+    return os.path.join(day_folder, f"Sample_{timepoint.sample_number}.{extension}")
+
+
+def get_imwrite_params(image_format, quality=None):
+    """
+    cv2.imwrite parameters for an export format.
+    :param quality: PNG compression level (0-9) or JPEG/WebP quality (0-100), None for the OpenCV default.
+    """
+    if image_format not in EXPORT_IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format \"{image_format}\", expected one of "
+                         f"{', '.join(EXPORT_IMAGE_FORMATS)}.")
+    if quality is None:
+        return []
+    flag, minimum, maximum = EXPORT_IMAGE_FORMATS[image_format]
+    if not minimum <= quality <= maximum:
+        raise ValueError(f"Quality for {image_format} must be between {minimum} and {maximum}, got {quality}.")
+    return [flag, int(quality)]
+
+
+def save_image_with_keypoints(image_with_keypoints, timepoint, output_root=DEFAULT_OUTPUT_FOLDER,
+                              image_format=DEFAULT_EXPORT_IMAGE_FORMAT, quality=None):
+    image_path = get_counted_image_path(timepoint, output_root, extension=image_format)
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    # Save without converting to BGR
+    with PROFILER().stage("imwrite", image=timepoint.filename, format=image_format):
+        written = cv2.imwrite(image_path, image_with_keypoints, get_imwrite_params(image_format, quality))
+    if not written:
+        raise IOError(f"Unable to write \"{image_path}\".")
+    return image_path
+
+
+class CountedImageWriter:
+    """
+    Renders and encodes counted images on a thread pool. cv2.circle and cv2.imwrite release the GIL, so plates are
+    encoded in parallel. At most max_pending images are queued at once; submit blocks when the queue is full, which
+    keeps the memory held by rendered images bounded.
+    """
+
+    def __init__(self, output_root=DEFAULT_OUTPUT_FOLDER, image_format=DEFAULT_EXPORT_IMAGE_FORMAT, quality=None,
+                 max_workers=DEFAULT_EXPORT_THREADS, max_pending=None):
+        get_imwrite_params(image_format, quality)  # Fail before anything is queued
+        self.output_root = output_root
+        self.image_format = image_format
+        self.quality = quality
+        self.executor = ThreadPoolExecutor(max_workers=max(int(max_workers), 1), thread_name_prefix="image-export")
+        self.slots = threading.BoundedSemaphore(max_pending or 2 * max(int(max_workers), 1))
+
+    def _submit(self, function, *args):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def _write(self, image, timepoint):
+        return save_image_with_keypoints(image, timepoint, self.output_root, self.image_format, self.quality)
+
+    def _render_and_write(self, core):
+        return self._write(core.get_display_image(), core.get_timepoint())
+
+    def submit_image(self, image_with_keypoints, timepoint):
+        """Encode an already rendered image. Returns a Future of the written path."""
+        return self._submit(self._write, image_with_keypoints, timepoint)
+
+    def submit(self, core):
+        """Render and encode the counted image of a BlobDetectorCore. Returns a Future of the written path."""
+        return self._submit(self._render_and_write, core)
+
+    def write_all(self, cores, progress=None, cancel_event=None):
+        """
+        Render and write the counted image of every core, blocking until all are done.
+        :param progress: Called as progress(completed, total) after each image, from the calling thread.
+        :param cancel_event: threading.Event; images not yet queued when it is set are skipped.
+        :return: (written paths, [(core, exception)] for the images that failed).
+        """
+        cores = list(cores)
+        futures = {}
+        written, errors = [], []
+
+        def collect(done_futures):
+            for future in done_futures:
+                error = future.exception()
+                if error is None:
+                    written.append(future.result())
+                else:
+                    errors.append((futures[future], error))
+                if progress is not None:
+                    progress(len(written) + len(errors), len(cores))
+
+        pending = set()
+        for core in cores:
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            future = self.submit(core)
+            futures[future] = core
+            pending.add(future)
+            done = {future for future in pending if future.done()}
+            pending -= done
+            collect(done)
+        for future in list(pending):
+            future.exception()  # Wait for it
+            collect([future])
+        return written, errors
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class KeypointXMLWriter:
+    """
+    Streams the keypoints.xml schema (Keypoints > Day > Sample > Keypoint with X, Y and Size) to a text file one
+    sample at a time, so memory use does not grow with the number of keypoints. With indent set the output matches
+    what minidom's toprettyxml produced, with indent=None it is written on a single line.
+    """
+
+    def __init__(self, file, indent="  "):
+        self.file = file
+        self.indent = indent
+        self.newline = "\n" if indent is not None else ""
+        self.current_day = None
+        self.file.write(f'<?xml version="1.0" ?>{self.newline}<Keypoints>{self.newline}')
+
+    def _indent(self, level):
+        return self.indent * level if self.indent is not None else ""
+
+    def write_sample(self, timepoint, keypoints):
+        if self.current_day != str(timepoint.day):
+            self._close_day()
+            self.current_day = str(timepoint.day)
+            self.file.write(f'{self._indent(1)}<Day number={quote_attribute(self.current_day)}>{self.newline}')
+        if timepoint.sample_number == -1:
+            attribute = f'filename={quote_attribute(timepoint.filename)}'
+        else:
+            attribute = f'number={quote_attribute(str(timepoint.sample_number))}'
+        if len(keypoints) == 0:
+            self.file.write(f'{self._indent(2)}<Sample {attribute}/>{self.newline}')
+            return
+        columns = keypoints.columns()
+        indent3, indent4, newline = self._indent(3), self._indent(4), self.newline
+        self.file.write(f'{self._indent(2)}<Sample {attribute}>{newline}')
+        self.file.write("".join(
+            f'{indent3}<Keypoint>{newline}{indent4}<X>{x}</X>{newline}{indent4}<Y>{y}</Y>{newline}'
+            f'{indent4}<Size>{size}</Size>{newline}{indent3}</Keypoint>{newline}'
+            for x, y, size in zip(columns["x"].tolist(), columns["y"].tolist(), columns["size"].tolist())))
+        self.file.write(f'{self._indent(2)}</Sample>{newline}')
+
+    def _close_day(self):
+        if self.current_day is not None:
+            self.file.write(f'{self._indent(1)}</Day>{self.newline}')
+
+    def close(self):
+        self._close_day()
+        self.current_day = None
+        self.file.write(f'</Keypoints>{self.newline}')
+
+
+def quote_attribute(value):
+    return '"' + xml.sax.saxutils.escape(value, {'"': "&quot;"}) + '"'
+
+
+def save_keypoints_as_xml(samples, output_root=DEFAULT_OUTPUT_FOLDER, indent="  "):
+    """
+    Write the keypoints of every sample to <output_root>/Day <day>/keypoints.xml, streaming one sample at a time.
+    :param samples: Iterable of (timepoint, KeypointStore) pairs, ordered so samples of the same day are adjacent.
+    :param indent: Indentation per nesting level, or None to write without whitespace.
+    :return: The path of the written XML file, or None if there were no samples.
+    """
+    os.makedirs(output_root, exist_ok=True)
+    # The file is named after the day of the last sample, so stream to a temporary file and move it at the end
+    temp_file = tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=output_root, suffix=".xml", delete=False)
+    timepoint = None
+    try:
+        with temp_file:
+            writer = KeypointXMLWriter(temp_file, indent)
+            for timepoint, keypoints in samples:
+                writer.write_sample(timepoint, keypoints)
+            writer.close()
+        if timepoint is None:
+            os.remove(temp_file.name)
+            return None
+        xml_dir_path = get_day_folder(timepoint.day, output_root)
+        os.makedirs(xml_dir_path, exist_ok=True)  # Ensure the directory exists
+        xml_path = os.path.join(xml_dir_path, "keypoints.xml")
+        os.replace(temp_file.name, xml_path)
+    except BaseException:
+        if os.path.exists(temp_file.name):
+            os.remove(temp_file.name)
+        raise
+    logging.info(f"SUCCESS: Keypoints exported to XML and saved to disk at path: \"{xml_path}\".")
+    return xml_path
@@ -0,0 +1,143 @@
+import math
+
+from utils import DEFAULT_KEYPOINT_INDEX_CELL_SIZE
+
+
+class KeypointIndex:
+    """
+    Uniform grid over keypoint centres for hit-testing and neighbourhood queries.
+
+    Each keypoint is filed under the grid cell containing its centre, so inserts and removes are O(1) and a query only
+    looks at the cells it overlaps instead of every keypoint on the plate. Keypoints are referred to by a key, the
+    KeypointStore id in BlobDetectorLogic, and queries return keys.
+    """
+
+    def __init__(self, cell_size=DEFAULT_KEYPOINT_INDEX_CELL_SIZE):
+        self.cell_size = cell_size
+        self._cells = {}  # (column, row) -> {key: (x, y, radius)}
+        self._cell_of = {}  # key -> (column, row)
+        self.max_radius = 0.0  # Largest radius ever inserted, bounds how far point-in-circle queries have to look
+
+    @classmethod
+    def from_store(cls, store, cell_size=DEFAULT_KEYPOINT_INDEX_CELL_SIZE):
+        index = cls(cell_size)
+        index.rebuild(store)
+        return index
+
+    def __len__(self):
+        return len(self._cell_of)
+
+    def __contains__(self, key):
+        return key in self._cell_of
+
+    def _cell(self, x, y):
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def insert(self, key, x, y, size):
+        if key in self._cell_of:
+            return
+        cell = self._cell(x, y)
+        self._cells.setdefault(cell, {})[key] = (x, y, size / 2)
+        self._cell_of[key] = cell
+        self.max_radius = max(self.max_radius, size / 2)
+
+    def remove(self, key):
+        cell = self._cell_of.pop(key, None)
+        if cell is None:
+            return False
+        bucket = self._cells[cell]
+        del bucket[key]
+        if not bucket:
+            del self._cells[cell]
+        return True
+
+    def clear(self):
+        self._cells.clear()
+        self._cell_of.clear()
+        self.max_radius = 0.0
+
+    def rebuild(self, store):
+        """Index every alive keypoint of a KeypointStore under its id."""
+        self.clear()
+        columns = store.columns()
+        for key, x, y, size in zip(store.ids().tolist(), columns["x"].tolist(), columns["y"].tolist(),
+                                   columns["size"].tolist()):
+            self.insert(key, x, y, size)
+
+    def _entries_in_cells(self, x0, y0, x1, y1):
+        column0, row0 = self._cell(x0, y0)
+        column1, row1 = self._cell(x1, y1)
+        if (column1 - column0 + 1) * (row1 - row0 + 1) > len(self._cells):
+            # Sparse grid, walking the occupied cells is cheaper than walking the query range
+            for (column, row), bucket in self._cells.items():
+                if column0 <= column <= column1 and row0 <= row <= row1:
+                    yield from bucket.items()
+            return
+        for column in range(column0, column1 + 1):
+            for row in range(row0, row1 + 1):
+                bucket = self._cells.get((column, row))
+                if bucket:
+                    yield from bucket.items()
+
+    def query_rect(self, x0, y0, x1, y1):
+        """Keys of the keypoints whose centre lies inside the rectangle (inclusive)."""
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        return [key for key, (x, y, _) in self._entries_in_cells(x0, y0, x1, y1) if x0 <= x <= x1 and y0 <= y <= y1]
+
+    def query_radius(self, x, y, radius):
+        """Keys of the keypoints whose centre is within radius of (x, y)."""
+        return [key for key, (kp_x, kp_y, _) in self._entries_in_cells(x - radius, y - radius, x + radius, y + radius)
+                if (kp_x - x) ** 2 + (kp_y - y) ** 2 <= radius ** 2]
+
+    def find_containing(self, x, y):
+        """
+        Key of the keypoint whose circle contains (x, y), or None. If circles overlap, the closest centre wins.
+        """
+        best, best_distance = None, math.inf
+        reach = self.max_radius
+        for key, (kp_x, kp_y, radius) in self._entries_in_cells(x - reach, y - reach, x + reach, y + reach):
+            distance = (kp_x - x) ** 2 + (kp_y - y) ** 2
+            if distance <= radius ** 2 and distance < best_distance:
+                best, best_distance = key, distance
+        return best
+
+    def nearest(self, x, y, max_distance=math.inf):
+        """
+        Key of the keypoint with the closest centre to (x, y) within max_distance, or None. Searches rings of cells
+        outwards from the query cell and stops once no unvisited cell can hold anything closer.
+        """
+        if not self._cell_of:
+            return None
+        column, row = self._cell(x, y)
+        best, best_distance = None, max_distance ** 2
+        ring = 0
+        # Every cell in a ring is at least (ring - 1) cells away from the query point
+        while ((ring - 1) * self.cell_size) ** 2 <= best_distance:
+            exhaustive = (2 * ring + 1) ** 2 > 4 * len(self._cells)
+            if exhaustive:
+                # The rings now cover far more cells than are occupied, finish by checking every keypoint
+                buckets = self._cells.values()
+            else:
+                buckets = (self._cells.get(cell, {}) for cell in self._ring_cells(column, row, ring))
+            for bucket in buckets:
+                for key, (kp_x, kp_y, _) in bucket.items():
+                    distance = (kp_x - x) ** 2 + (kp_y - y) ** 2
+                    if distance <= best_distance:
+                        best, best_distance = key, distance
+            if exhaustive:
+                break
+            ring += 1
+        return best
+
+    @staticmethod
+    def _ring_cells(column, row, ring):
+        if ring == 0:
+            yield column, row
+            return
+        for offset in range(-ring, ring + 1):
+            yield column + offset, row - ring
+            yield column + offset, row + ring
+        for offset in range(-ring + 1, ring):
+            yield column - ring, row + offset
+            yield column + ring, row + offset
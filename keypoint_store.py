@@ -0,0 +1,166 @@
+import numpy as np
+
+SOURCE_DETECTED = 0  # Found by a blob counter
+SOURCE_MANUAL = 1  # Added by clicking on the plate
+
+INITIAL_CAPACITY = 16
+
+
+class KeypointStore:
+    """
+    Columnar keypoint container backed by NumPy arrays (x, y, size, confidence, source).
+
+    Every keypoint gets a stable integer id, its row in the arrays. Removing a keypoint only clears its alive flag
+    (a tombstone), so remove and restore are O(1) and ids held by the undo history stay valid. Bulk conversions to and
+    from (N, 4) detection arrays and exports only touch the alive rows, with vectorized operations.
+    """
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        capacity = max(capacity, 1)
+        self.x = np.zeros(capacity, dtype=np.float32)
+        self.y = np.zeros(capacity, dtype=np.float32)
+        self.size = np.zeros(capacity, dtype=np.float32)
+        self.confidence = np.zeros(capacity, dtype=np.float32)
+        self.source = np.zeros(capacity, dtype=np.uint8)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self._count = 0  # Rows in use, alive or not
+        self._alive_count = 0
+
+    @classmethod
+    def from_detections(cls, detections, source=SOURCE_DETECTED):
+        """
+        Build a store from an (N, 4) array of (x, y, size, confidence) rows, as returned by the blob counters and the
+        detection cache.
+        """
+        detections = np.asarray(detections, dtype=np.float32).reshape(-1, 4)
+        store = cls(capacity=len(detections))
+        store._append_rows(detections[:, 0], detections[:, 1], detections[:, 2], detections[:, 3], source)
+        return store
+
+    @classmethod
+    def from_keypoints(cls, keypoints, source=SOURCE_DETECTED):
+        """Build a store from cv2.KeyPoint-like objects (anything with .pt, .size and optionally .response)."""
+        keypoints = list(keypoints)
+        detections = np.array([(kp.pt[0], kp.pt[1], kp.size, getattr(kp, "response", 0.0)) for kp in keypoints],
+                              dtype=np.float32).reshape(-1, 4)
+        return cls.from_detections(detections, source)
+
+    def __len__(self):
+        return self._alive_count
+
+    def __contains__(self, keypoint_id):
+        return 0 <= keypoint_id < self._count and bool(self.alive[keypoint_id])
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in (self.x, self.y, self.size, self.confidence, self.source, self.alive))
+
+    def _reserve(self, count):
+        capacity = len(self.x)
+        if count <= capacity:
+            return
+        new_capacity = max(count, capacity * 2)
+        for name in ("x", "y", "size", "confidence", "source", "alive"):
+            column = getattr(self, name)
+            grown = np.zeros(new_capacity, dtype=column.dtype)
+            grown[:self._count] = column[:self._count]
+            setattr(self, name, grown)
+
+    def _append_rows(self, x, y, size, confidence, source):
+        start, count = self._count, len(x)
+        self._reserve(start + count)
+        end = start + count
+        self.x[start:end] = x
+        self.y[start:end] = y
+        self.size[start:end] = size
+        self.confidence[start:end] = confidence
+        self.source[start:end] = source
+        self.alive[start:end] = True
+        self._count = end
+        self._alive_count += count
+        return np.arange(start, end)
+
+    def add(self, x, y, size, confidence=1.0, source=SOURCE_MANUAL):
+        """Append a keypoint and return its id."""
+        return int(self._append_rows([x], [y], [size], [confidence], source)[0])
+
+    def remove(self, keypoint_id):
+        if not self.alive[keypoint_id]:
+            return False
+        self.alive[keypoint_id] = False
+        self._alive_count -= 1
+        return True
+
+    def restore(self, keypoint_id):
+        """Bring back a removed keypoint under the same id, used by undo and redo."""
+        if keypoint_id >= self._count or self.alive[keypoint_id]:
+            return False
+        self.alive[keypoint_id] = True
+        self._alive_count += 1
+        return True
+
+    def remove_many(self, keypoint_ids):
+        """Remove several keypoints at once. Returns the ids that were actually alive."""
+        keypoint_ids = np.asarray(keypoint_ids, dtype=np.int64)
+        keypoint_ids = np.unique(keypoint_ids[self.alive[keypoint_ids]]) if len(keypoint_ids) else keypoint_ids
+        self.alive[keypoint_ids] = False
+        self._alive_count -= len(keypoint_ids)
+        return keypoint_ids
+
+    def restore_many(self, keypoint_ids):
+        """Restore several removed keypoints at once. Returns the ids that were actually restored."""
+        keypoint_ids = np.asarray(keypoint_ids, dtype=np.int64)
+        if len(keypoint_ids):
+            keypoint_ids = keypoint_ids[keypoint_ids < self._count]
+            keypoint_ids = np.unique(keypoint_ids[~self.alive[keypoint_ids]])
+        self.alive[keypoint_ids] = True
+        self._alive_count += len(keypoint_ids)
+        return keypoint_ids
+
+    def ids(self):
+        """Ids of the alive keypoints, in insertion order."""
+        return np.flatnonzero(self.alive[:self._count])
+
+    def select_in_polygon(self, polygon, removed=False, source=None):
+        """
+        Ids of the keypoints whose centre lies inside a polygon, e.g. a rectangle or lasso selection.
+        :param polygon: Sequence of (x, y) vertices, implicitly closed.
+        :param removed: Select removed (tombstoned) keypoints instead of alive ones, to bring them back.
+        :param source: Only select keypoints from this source (SOURCE_DETECTED or SOURCE_MANUAL).
+        """
+        polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+        candidates = ~self.alive[:self._count] if removed else self.alive[:self._count].copy()
+        if source is not None:
+            candidates &= self.source[:self._count] == source
+        if len(polygon) < 3:
+            return np.zeros(0, dtype=np.int64)
+        # Only test points inside the bounding box, then even-odd ray casting against every edge
+        (min_x, min_y), (max_x, max_y) = polygon.min(axis=0), polygon.max(axis=0)
+        x, y = self.x[:self._count], self.y[:self._count]
+        candidates &= (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+        ids = np.flatnonzero(candidates)
+        x, y = x[ids].astype(np.float64), y[ids].astype(np.float64)
+        inside = np.zeros(len(ids), dtype=bool)
+        for (x0, y0), (x1, y1) in zip(polygon, np.roll(polygon, -1, axis=0)):
+            if y0 == y1:
+                continue  # Horizontal edges never cross a horizontal ray
+            crosses = (y0 > y) != (y1 > y)
+            inside ^= crosses & (x < x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+        return ids[inside]
+
+    def point(self, keypoint_id):
+        return float(self.x[keypoint_id]), float(self.y[keypoint_id])
+
+    def radius(self, keypoint_id):
+        return float(self.size[keypoint_id]) / 2
+
+    def to_array(self):
+        """Alive keypoints as an (N, 4) float32 array of (x, y, size, confidence) rows."""
+        alive = self.alive[:self._count]
+        return np.stack((self.x[:self._count][alive], self.y[:self._count][alive], self.size[:self._count][alive],
+                         self.confidence[:self._count][alive]), axis=1)
+
+    def columns(self):
+        """Alive keypoints as a dict of column arrays, including the source of each keypoint."""
+        alive = self.alive[:self._count]
+        return {name: getattr(self, name)[:self._count][alive] for name in ("x", "y", "size", "confidence", "source")}
@@ -1,14 +1,27 @@
 import logging
-
-from PySide6.QtWidgets import QApplication, QMessageBox
 import sys
 sys.setrecursionlimit(1500)
-from image_set_reader import ImageSetBlobDetector
-from blob_detector_ui import BlobDetectorUI
-from blob_detector_logic import BlobDetectorLogic
-from utils import DEFAULT_IMAGE_PATH
 
-if __name__ == "__main__":
+HEADLESS_MODES = ("batch", "serve")
+
+
+def run_headless(mode, argv):
+    # Headless modes never import PySide6 so they can run on machines without a display
+    if mode == "batch":
+        from batch_counter import main as batch_main
+        return batch_main(argv)
+    if mode == "serve":
+        from counting_service import main as serve_main
+        return serve_main(argv)
+
+
+def run_gui():
+    from PySide6.QtWidgets import QApplication, QMessageBox
+    from image_set_reader import ImageSetBlobDetector
+    from blob_detector_ui import BlobDetectorUI
+    from blob_detector_logic import BlobDetectorLogic
+    from utils import DEFAULT_IMAGE_PATH
+
     app = QApplication([])
 
     # Load and apply the stylesheet
@@ -16,7 +29,7 @@ if __name__ == "__main__":
         app.setStyleSheet(file.read())
 
     if len(sys.argv) != 2:
-        QMessageBox.critical(None, "Error", "Usage: main.py <mode>\nModes: image_set, single_blob")
+        QMessageBox.critical(None, "Error", "Usage: main.py <mode>\nModes: image_set, single_blob, batch, serve")
         sys.exit(1)
 
     mode = sys.argv[1]
@@ -28,10 +41,17 @@ if __name__ == "__main__":
         logging.debug("Single image mode")
         logging.debug("Image path: %s", blob_detector_logic.image_path)
         widget = BlobDetectorUI(blob_detector_logic)
+        app.aboutToQuit.connect(blob_detector_logic.close)
         widget.update_display_image()  # Ensure the image is displayed
     else:
-        QMessageBox.critical(None, "Error", f"Unknown mode: {mode}\nModes: image_set, single_blob")
+        QMessageBox.critical(None, "Error", f"Unknown mode: {mode}\nModes: image_set, single_blob, batch, serve")
         sys.exit(1)
 
     widget.show()
-    app.exec()
\ No newline at end of file
+    app.exec()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] in HEADLESS_MODES:
+        sys.exit(run_headless(sys.argv[1], sys.argv[2:]))
+    run_gui()
@@ -0,0 +1,21 @@
+import json
+
+from benchmarks import BenchmarkRunner, compare_results, make_synthetic_plate
+
+
+def test_synthetic_plate():
+    image, colonies = make_synthetic_plate(400, 300, 25, seed=3)
+    assert image.shape == (400, 300, 3)
+    assert colonies.shape == (25, 4)
+    x, y = colonies[:, 0].astype(int), colonies[:, 1].astype(int)
+    assert (image[y, x].mean(axis=1) > 200).all()  # Colonies are bright on the darker dish
+
+
+def test_runner_writes_comparable_results(tmp_path, capsys):
+    results = BenchmarkRunner("small", str(tmp_path)).run(["hit_testing", "xml_export", "excel_output"])
+    names = {result["benchmark"] for result in results["results"]}
+    assert names == {"keypoint_index_build", "keypoint_hit_test", "save_keypoints_as_xml",
+                     "excel_write_all_blob_counts"}
+    assert all(result["median_s"] > 0 for result in results["results"])
+    compare_results(results, json.loads(json.dumps(results)))
+    assert "1.00x" in capsys.readouterr().out
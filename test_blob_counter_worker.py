@@ -0,0 +1,103 @@
+import os
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np
+from PySide6.QtWidgets import QApplication
+
+import blob_counter_worker
+from blob_counter_worker import BlobCountScheduler
+from keypoint_store import KeypointStore
+
+
+class Plate:
+    """Stands in for a BlobDetectorLogic, count_cores is replaced below so no image is needed."""
+
+    def __init__(self, position):
+        self.image_path = f"plate_{position}.png"
+        self.position = position
+        self.keypoints = KeypointStore()
+
+    def set_keypoints(self, keypoints):
+        self.keypoints = keypoints
+
+
+def make_scheduler(monkeypatch, batch_size=3):
+    batches = []
+
+    def count_cores(cores, blob_counter, batch_size, on_error):
+        batches.append([core.position for core in cores])
+        return [KeypointStore.from_detections(np.zeros((core.position, 4), dtype=np.float32)) for core in cores]
+
+    monkeypatch.setattr(blob_counter_worker, "count_cores", count_cores)
+    return BlobCountScheduler(None, max_concurrency=1, batch_size=batch_size), batches
+
+
+def run_until_finished(scheduler):
+    app = QApplication.instance() or QApplication([])  # Not a QCoreApplication, other tests create widgets
+    finished = []
+    scheduler.finished.connect(finished.append)
+    deadline = time.monotonic() + 10
+    while not finished and time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.001)
+    return finished
+
+
+def test_batches_follow_the_focus(monkeypatch):
+    scheduler, _ = make_scheduler(monkeypatch)
+    scheduler.logics = [Plate(position) for position in range(10)]
+    scheduler.pending = [(0, position) for position in range(10)]
+    scheduler.set_focus(4)
+    assert [plate.position for plate in scheduler._next_batch()] == [4]  # The focused plate is sent alone
+    assert [plate.position for plate in scheduler._next_batch()] == [3, 5, 2]  # Then its nearest neighbours
+
+    scheduler.set_focus(9)  # Selecting another plate reorders what is left
+    assert [plate.position for plate in scheduler._next_batch()] == [9]
+    assert [plate.position for plate in scheduler._next_batch()] == [8, 7, 6]
+    assert [plate.position for plate in scheduler._next_batch()] == [1, 0]
+
+
+def test_counts_every_plate_and_reports_the_applied_counts(monkeypatch):
+    scheduler, batches = make_scheduler(monkeypatch)
+    plates = [Plate(position) for position in range(5)]
+    kept = KeypointStore.from_detections(np.zeros((7, 4), dtype=np.float32))
+    # Plate 1 stands for one edited while counting, its result is not applied
+    scheduler.apply_keypoints = lambda plate, keypoints: plate.set_keypoints(kept if plate.position == 1 else keypoints)
+    counted = []
+    scheduler.image_counted.connect(lambda plate, count: counted.append((plate.position, count)))
+    scheduler.start(plates, focus_index=2)
+
+    assert run_until_finished(scheduler) == [False]
+    assert batches == [[2], [1, 3, 0], [4]]
+    assert sorted(counted) == [(0, 0), (1, 7), (2, 2), (3, 3), (4, 4)]
+    assert (scheduler.completed, scheduler.total) == (5, 5)
+
+
+def test_cancel_stops_after_the_running_batch(monkeypatch):
+    scheduler, batches = make_scheduler(monkeypatch)
+    plates = [Plate(position) for position in range(10)]
+    scheduler.image_counted.connect(lambda plate, count: scheduler.cancel())
+    scheduler.start(plates, focus_index=0)
+
+    assert run_until_finished(scheduler) == [True]
+    assert batches == [[0]]
+    assert not scheduler.is_running() and scheduler.completed == 1
+
+
+def test_unexpected_errors_fail_the_whole_batch(monkeypatch):
+    scheduler, _ = make_scheduler(monkeypatch)
+
+    def count_cores(cores, blob_counter, batch_size, on_error):
+        on_error(cores[0], ValueError("unreadable"))
+        raise MemoryError("out of memory")
+
+    monkeypatch.setattr(blob_counter_worker, "count_cores", count_cores)
+    scheduler.start([Plate(position) for position in range(3)], focus_index=1)
+
+    assert run_until_finished(scheduler) == [False]
+    # Plate 1 is counted alone, then plates 0 and 2 together; the first plate of each batch failed on its own
+    assert sorted(scheduler.errors) == [("plate_0.png", "unreadable"), ("plate_1.png", "unreadable"),
+                                        ("plate_2.png", "out of memory")]
+    assert scheduler.completed == 3
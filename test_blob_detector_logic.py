@@ -0,0 +1,60 @@
+import types
+
+import numpy as np
+
+from blob_detector_core import BlobDetectorCore
+from blob_detector_logic import BlobDetectorLogic
+from keypoint_store import KeypointStore
+
+
+def store(*points):
+    return KeypointStore.from_detections(np.array([(x, y, 4, 0.9) for x, y in points], dtype=np.float32))
+
+
+def undo(logic):
+    logic.apply_action(logic.undo_redo_tracker.undo(), undo=True)
+
+
+def redo(logic):
+    logic.apply_action(logic.undo_redo_tracker.redo(), undo=False)
+
+
+def test_recount_is_undoable_and_keeps_the_edits_before_it():
+    logic = BlobDetectorLogic(None, core=BlobDetectorCore())
+    logic.set_keypoints(store((10, 10), (50, 50)))
+    assert len(logic.undo_redo_tracker.undo_stack) == 0  # The first count of a plate is not an edit
+    logic.add_keypoint(100, 100)
+    logic.remove_keypoint(logic.keypoint_index.find_containing(10, 10))
+    edited = logic.keypoints
+
+    logic.set_keypoints(store((20, 20)))
+    logic.set_keypoints(store((30, 30)))  # e.g. a detection slider being dragged
+    assert len(logic.keypoints) == 1
+
+    undo(logic)  # Both recounts are undone in one step
+    assert logic.keypoints is edited
+    assert sorted(map(tuple, logic.keypoints.to_array()[:, :2].tolist())) == [(50, 50), (100, 100)]
+    undo(logic)  # The manual edits before the recount still undo
+    undo(logic)
+    assert len(logic.keypoints) == 2 and logic.keypoint_index.find_containing(10, 10) is not None
+    for _ in range(3):
+        redo(logic)
+    assert logic.keypoints.to_array()[:, :2].tolist() == [[30, 30]]
+
+
+def test_region_edits_are_signalled_once():
+    ui = types.SimpleNamespace(update_keypoint_count_label=lambda count: None)
+    logic = BlobDetectorLogic(ui, core=BlobDetectorCore())
+    logic.set_keypoints(store(*[(x, 10) for x in range(10, 1000, 10)], (500, 500)))
+    signals = []
+    for signal in ("keypoint_added", "keypoint_removed", "keypoints_added", "keypoints_removed"):
+        getattr(logic, signal).connect(lambda ids, signal=signal: signals.append((signal, ids)))
+
+    assert logic.edit_keypoints_in_region([(0, 0), (1000, 0), (1000, 20), (0, 20)]) == 99
+    assert [(signal, len(ids)) for signal, ids in signals] == [("keypoints_removed", 99)]
+    assert len(logic.keypoints) == 1 and logic.keypoint_index.find_containing(10, 10) is None
+
+    signals.clear()
+    undo(logic)
+    assert [(signal, len(ids)) for signal, ids in signals] == [("keypoints_added", 99)]
+    assert len(logic.keypoints) == 100 and logic.keypoint_index.find_containing(10, 10) is not None
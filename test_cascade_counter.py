@@ -0,0 +1,60 @@
+import numpy as np
+
+from blob_counter import CascadeBlobCounter, YOLOBlobCounter, create_blob_counter
+from utils import BACKEND_CASCADE, ESCALATE_REGION
+
+
+def detections(*rows):
+    return np.array(rows, dtype=np.float32).reshape(-1, 4)
+
+
+def make_cascade(monkeypatch, small, large, **kwargs):
+    """A cascade whose small model returns small[i] for the i-th image and whose large model is the large callable."""
+    cascade = create_blob_counter(BACKEND_CASCADE, model_path="large.pt", small_model_path="small.pt",
+                                  use_detection_cache=False, **kwargs)
+    cascade.small_counter.detect_batch = lambda images: [small[int(image[0, 0, 0])].copy() for image in images]
+    large_calls = []
+
+    def detect_large(self, images):
+        large_calls.append([image.shape for image in images])
+        return [large(image) for image in images]
+
+    monkeypatch.setattr(YOLOBlobCounter, "detect_batch", detect_large)
+    return cascade, large_calls
+
+
+def plate(index, size=1000):
+    image = np.zeros((size, size, 3), dtype=np.uint8)
+    image[0, 0, 0] = index  # Tells the stub small model which detections to return
+    return image
+
+
+def test_escalates_only_uncertain_and_dense_plates(monkeypatch):
+    confident = detections((100, 100, 20, 0.9), (300, 300, 20, 0.8))
+    uncertain = detections((100, 100, 20, 0.3), (300, 300, 20, 0.9))
+    dense = np.tile(detections((500, 500, 10, 0.9)), (200, 1))
+    cascade, large_calls = make_cascade(monkeypatch, [confident, uncertain, dense],
+                                        lambda image: detections((1, 2, 3, 0.99)))
+    assert isinstance(cascade, CascadeBlobCounter)
+
+    stores = cascade.count_blobs_batch([plate(0), plate(1), plate(2)])
+    assert [len(store) for store in stores] == [2, 1, 1]
+    assert large_calls == [[(1000, 1000, 3), (1000, 1000, 3)]]  # One large batch with the two escalated plates
+    stats = cascade.stats.stats()
+    assert (stats["plates"], stats["escalated_plates"]) == (3, 2)
+    assert stats["reasons"] == {"uncertain": 1, "dense": 1}
+    assert "2 of 3 plates escalated" in cascade.report()
+
+
+def test_region_escalation_replaces_only_the_uncertain_region(monkeypatch):
+    small = detections((100, 100, 20, 0.3), (800, 800, 20, 0.9))
+    # In crop coordinates: one blob inside the escalated region and one in its margin, which must be dropped
+    large = detections((150, 150, 20, 0.95), (560, 150, 20, 0.95))
+    cascade, large_calls = make_cascade(monkeypatch, [small], lambda image: large.copy(), escalation=ESCALATE_REGION,
+                                        region_size=512, region_margin=64)
+
+    store = cascade.count_blobs(plate(0, size=1024))
+    assert large_calls == [[(576, 576, 3)]]
+    assert sorted(map(tuple, store.to_array()[:, :2].tolist())) == [(150, 150), (800, 800)]
+    stats = cascade.stats.stats()
+    assert (stats["regions"], stats["escalated_regions"], stats["escalated_plates"]) == (4, 1, 1)
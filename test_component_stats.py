@@ -0,0 +1,39 @@
+import cv2
+import numpy as np
+
+from benchmarks import make_synthetic_plate
+from blob_counter import DEFAULT_SIMPLE_BLOB_SETTINGS, create_blob_detector_params
+from component_stats import MultiThresholdComponents, ComponentStatsCache
+
+
+def reference_detections(gray, settings):
+    keypoints = cv2.SimpleBlobDetector_create(create_blob_detector_params(settings)).detect(gray)
+    return np.array(sorted((kp.pt[0], kp.pt[1], kp.size) for kp in keypoints)).reshape(-1, 3)
+
+
+def test_matches_simple_blob_detector():
+    image, _ = make_synthetic_plate(1024, 1024, 80, seed=5)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    components = MultiThresholdComponents(gray)
+    # Colonies are brighter than the dish, so threshold above it
+    base = {**DEFAULT_SIMPLE_BLOB_SETTINGS, "min_threshold": 170, "max_threshold": 230, "min_area": 20}
+    for changes in ({}, {"min_area": 100}, {"min_circularity": 0.85, "min_convexity": 0.95},
+                    {"min_inertia_ratio": 0.6, "min_dist_between_blobs": 40}, {"min_threshold": 120}):
+        settings = {**base, **changes}
+        detections = components.detect(settings)
+        expected = reference_detections(gray, settings)
+        assert len(expected) > 0
+        np.testing.assert_allclose(np.array(sorted(map(tuple, detections[:, :3]))), expected, atol=1e-3)
+
+
+def test_filter_changes_reuse_cached_levels():
+    image, _ = make_synthetic_plate(300, 300, 10, seed=1)
+    cache = ComponentStatsCache(max_entries=1)
+    components = cache.get("plate", lambda: cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+    components.detect(DEFAULT_SIMPLE_BLOB_SETTINGS)
+    levels = dict(components._levels)
+    components.detect({**DEFAULT_SIMPLE_BLOB_SETTINGS, "min_area": 10, "min_circularity": 0.1})
+    assert all(components._levels[threshold] is stats for threshold, stats in levels.items())
+    assert cache.get("plate", None) is components
+    cache.get("other plate", lambda: np.zeros((10, 10), dtype=np.uint8))
+    assert cache.get("plate", lambda: np.zeros((10, 10), dtype=np.uint8)) is not components
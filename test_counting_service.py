@@ -0,0 +1,124 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import cv2
+import numpy as np
+import pytest
+
+from blob_counter import BlobCounterBase
+from counting_service import CountingService, make_server
+from keypoint_store import KeypointStore
+
+
+class StubCounter(BlobCounterBase):
+    """Finds one blob per image, at the brightness of its top left pixel, and records the batch sizes."""
+    backend = "stub"
+
+    def __init__(self, release=None):
+        super().__init__()
+        self.batch_sizes = []
+        self.release = release
+        self.counting = threading.Event()
+
+    def count_blobs_batch(self, images, batch_size=1, **kwargs):
+        self.counting.set()
+        if self.release is not None:
+            self.release.wait(5)
+        self.batch_sizes.append(len(images))
+        return [KeypointStore.from_detections(np.array([[image[0, 0, 0], 1, 4, 0.9]], dtype=np.float32))
+                for image in images]
+
+
+def png(value):
+    return cv2.imencode(".png", np.full((32, 32, 3), value, dtype=np.uint8))[1].tobytes()
+
+
+def post(url, body, content_type="image/png"):
+    request = urllib.request.Request(url + "/count", data=body, headers={"Content-Type": content_type})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+@pytest.fixture
+def serve():
+    started = []
+
+    def start(blob_counter, **kwargs):
+        service = CountingService(blob_counter, target_size=None, **kwargs)
+        server = make_server(service, "127.0.0.1", 0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        started.append((server, service))
+        return f"http://127.0.0.1:{server.server_address[1]}", service
+
+    yield start
+    for server, service in started:
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+def test_batches_concurrent_uploads_and_paths(serve, tmp_path):
+    counter = StubCounter()
+    url, _ = serve(counter, batch_window=0.5, max_batch_size=8)
+    image_path = tmp_path / "plate.png"
+    image_path.write_bytes(png(70))
+    results = [None] * 4
+
+    def request(i):
+        results[i] = post(url, png(10 * i)) if i < 3 else \
+            post(url, json.dumps({"path": str(image_path)}).encode(), "application/json")
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [status for status, _ in results] == [200] * 4
+    assert [result["keypoints"][0][0] for _, result in results] == [0, 10, 20, 70]
+    assert all(result["count"] == 1 for _, result in results)
+    assert sum(counter.batch_sizes) == 4 and len(counter.batch_sizes) < 4
+
+    with urllib.request.urlopen(url + "/health", timeout=10) as response:
+        health = json.loads(response.read())
+    assert health["requests"] == 4 and health["latency_ms"]["samples"] == 4
+    assert post(url, b"not an image")[0] == 400
+    assert post(url, json.dumps({"path": str(tmp_path / "missing.png")}).encode(), "application/json")[0] == 404
+
+
+def test_rejects_requests_when_the_queue_is_full(serve):
+    release = threading.Event()
+    counter = StubCounter(release)
+    url, service = serve(counter, batch_window=0, max_batch_size=1, max_queue=1)
+    threads = [threading.Thread(target=post, args=(url, png(i))) for i in range(2)]
+    threads[0].start()  # Counted while the second one fills the queue
+    assert counter.counting.wait(5)
+    threads[1].start()
+    while service.batcher.queue.qsize() < 1:
+        threading.Event().wait(0.01)
+
+    status, result = post(url, b"not an image")  # Turned away before decoding, so not a 400
+    assert status == 503 and "full" in result["error"]
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert service.metrics.snapshot()["rejected"] == 1
+
+
+def test_timed_out_requests_are_not_counted(serve):
+    release = threading.Event()
+    counter = StubCounter(release)
+    url, service = serve(counter, batch_window=0, max_batch_size=1, request_timeout=0.2)
+    first = threading.Thread(target=post, args=(url, png(1)))
+    first.start()
+    assert counter.counting.wait(5)
+    assert post(url, png(2))[0] == 504  # Gives up while the first request is still being counted
+    release.set()
+    first.join()
+    service.close()  # Lets the batcher finish everything still queued
+    assert counter.batch_sizes == [1]
@@ -0,0 +1,69 @@
+import itertools
+import types
+
+import numpy as np
+import pytest
+
+import detection_cache
+from blob_counter import YOLOBlobCounter
+from detection_cache import DetectionCache, make_cache_key
+
+DETECTIONS = np.array([[10.5, 20.25, 8, 0.9], [30, 40, 12, 0.5]], dtype=np.float32)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = DetectionCache(str(tmp_path / "cache.sqlite3"))
+    yield cache
+    cache.close()
+
+
+def test_round_trips_keypoints_and_counts_hits_and_misses(cache):
+    counter = YOLOBlobCounter(model_path="model.pt", detection_cache=cache)
+    preprocessing = {"target_size": 1024}
+    assert counter.lookup_cached_keypoints("image", preprocessing) is None
+
+    cache.put(counter.detection_cache_key("image", preprocessing), DETECTIONS, image_hash="image",
+              model_hash=counter.model_hash())
+    keypoints = counter.lookup_cached_keypoints("image", preprocessing)
+    assert np.array_equal(keypoints.to_array(), DETECTIONS)
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 1)
+
+
+def test_key_changes_with_model_preprocessing_and_inference_settings():
+    key = make_cache_key("image", "model", {"target_size": 1024}, {"backend": "YOLOBlobCounter"})
+    assert key == make_cache_key("image", "model", {"target_size": 1024}, {"backend": "YOLOBlobCounter"})
+    assert key != make_cache_key("image", "other model", {"target_size": 1024}, {"backend": "YOLOBlobCounter"})
+    assert key != make_cache_key("image", "model", {"target_size": None}, {"backend": "YOLOBlobCounter"})
+    assert key != make_cache_key("image", "model", {"target_size": 1024}, {"backend": "YOLOBlobCounter", "conf": 0.5})
+
+    counter = YOLOBlobCounter(model_path="model.pt", use_detection_cache=False)
+    assert counter.detection_cache_key("image") != \
+        YOLOBlobCounter(model_path="other.pt").detection_cache_key("image")
+    assert counter.detection_cache_key("image") != \
+        YOLOBlobCounter(model_path="model.pt", predict_kwargs={"conf": 0.5}).detection_cache_key("image")
+
+
+def test_invalidate_by_image_and_by_model(cache):
+    for image_hash, model_hash in itertools.product(("a", "b"), ("m1", "m2")):
+        cache.put(f"{image_hash}-{model_hash}", DETECTIONS, image_hash=image_hash, model_hash=model_hash)
+    assert cache.invalidate(image_hash="a") == 2
+    assert cache.get("a-m1") is None and cache.get("b-m1") is not None
+    assert cache.invalidate(model_hash="m2") == 1
+    assert cache.get("b-m2") is None and cache.get("b-m1") is not None
+    assert cache.invalidate() == 0  # Nothing to match, nothing deleted
+
+
+def test_evicts_least_recently_used_entries_at_the_size_limit(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(detection_cache, "time", types.SimpleNamespace(time=lambda: next(clock)))  # Distinct times
+    cache = DetectionCache(str(tmp_path / "cache.sqlite3"), max_bytes=3 * DETECTIONS.nbytes)
+    try:
+        for key in ("a", "b", "c"):
+            cache.put(key, DETECTIONS)
+        cache.get("a")  # Now b is the least recently used
+        cache.put("d", DETECTIONS)
+        assert [key for key in "abcd" if cache.get(key) is not None] == ["a", "c", "d"]
+        assert cache.stats()["bytes"] <= cache.max_bytes
+    finally:
+        cache.close()
@@ -0,0 +1,52 @@
+import openpyxl
+import pytest
+
+from excel_output import ExcelOutput
+from utils import Timepoint
+
+
+def make_template(path):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet["A1"] = "Strain"
+    sheet["B1"] = "Day 3"
+    sheet["C1"] = 5  # Plain numbers are day headers too
+    sheet["B4"] = "Colonies"
+    sheet["C6"] = "colonies"
+    sheet["D1"] = "Day 7"  # No "colonies" cell under this one
+    workbook.save(path)
+    return str(path)
+
+
+def test_indexes_template(tmp_path):
+    excel_output = ExcelOutput(make_template(tmp_path / "template.xlsx"))
+    assert excel_output.day_columns == {3: 2, 5: 3, 7: 4}
+    assert excel_output.colonies_rows == {2: 4, 3: 6}
+    assert excel_output.find_day_column(4) is None
+
+
+def test_write_all_blob_counts(tmp_path):
+    path = make_template(tmp_path / "template.xlsx")
+    excel_output = ExcelOutput(path)
+    timepoints = [
+        Timepoint(day=3, sample_number=1, dilution="x10", num_keypoints=12, filename="3_1.jpg"),
+        Timepoint(day=5, sample_number=2, dilution="x10", num_keypoints=34, filename="5_2.jpg"),
+        Timepoint(day=4, sample_number=1, dilution="x10", num_keypoints=56, filename="4_1.jpg"),  # Day missing
+        Timepoint(day=7, sample_number=1, dilution="x10", num_keypoints=78, filename="7_1.jpg"),  # No anchor
+        Timepoint(day=3, sample_number=-1, dilution=None, num_keypoints=90, filename="plate.jpg"),  # No sample
+        None,
+    ]
+    unmatched = excel_output.write_all_blob_counts(timepoints)
+    assert [timepoint.filename for timepoint, _ in unmatched] == ["4_1.jpg", "7_1.jpg", "plate.jpg"]
+    excel_output.save()
+
+    sheet = openpyxl.load_workbook(path).active
+    assert sheet["B5"].value == 12
+    assert sheet["C8"].value == 34
+    assert sheet["B3"].value is None
+
+
+def test_write_blob_counts_missing_day(tmp_path):
+    excel_output = ExcelOutput(make_template(tmp_path / "template.xlsx"))
+    with pytest.raises(ValueError):
+        excel_output.write_blob_counts(4, 1, 10)
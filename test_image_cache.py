@@ -0,0 +1,70 @@
+import threading
+
+import numpy as np
+import pytest
+
+from image_cache import ImageCache
+
+IMAGE_BYTES = 100
+
+
+def image(value=0):
+    return np.full(IMAGE_BYTES, value, dtype=np.uint8)
+
+
+def test_evicts_least_recently_used_images_to_stay_in_budget():
+    cache = ImageCache(max_bytes=3 * IMAGE_BYTES)
+    for key in "abc":
+        cache.get(key, image)
+    cache.get("a", image)  # Hit, now b is the least recently used
+    cache.get("d", image)
+    assert [key for key in "abcd" if cache.contains(key)] == ["a", "c", "d"]
+    assert cache.stats() == {"entries": 3, "current_bytes": 3 * IMAGE_BYTES, "max_bytes": 3 * IMAGE_BYTES,
+                             "hits": 1, "misses": 4, "evictions": 1}
+
+    cache.set_max_bytes(IMAGE_BYTES)  # Shrinking the budget evicts as well
+    assert [key for key in "abcd" if cache.contains(key)] == ["d"] and cache.stats()["evictions"] == 3
+
+
+def test_images_larger_than_the_budget_are_returned_but_not_kept():
+    cache = ImageCache(max_bytes=IMAGE_BYTES - 1)
+    assert len(cache.get("large", image)) == IMAGE_BYTES
+    assert not cache.contains("large") and cache.stats()["current_bytes"] == 0
+
+
+def test_cached_images_are_read_only():
+    cache = ImageCache()
+    cached = cache.get("a", image)
+    with pytest.raises(ValueError):
+        cached[0] = 1
+    assert cache.get("a", image) is cached
+
+
+def test_concurrent_get_waits_for_the_loading_thread():
+    cache = ImageCache()
+    started, release = threading.Event(), threading.Event()
+    loads = []
+
+    def slow_loader():
+        loads.append(threading.get_ident())
+        started.set()
+        release.wait(5)
+        return image(7)
+
+    results = [None, None]
+
+    def get(i):
+        results[i] = cache.get("a", slow_loader)
+
+    first = threading.Thread(target=get, args=(0,))
+    first.start()
+    assert started.wait(5)
+    second = threading.Thread(target=get, args=(1,))
+    second.start()
+    second.join(0.1)
+    assert second.is_alive()  # Waiting for the first thread's decode
+    release.set()
+    first.join()
+    second.join()
+    assert len(loads) == 1 and results[0] is results[1]
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 1)
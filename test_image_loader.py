@@ -0,0 +1,43 @@
+import struct
+
+import cv2
+import numpy as np
+
+import image_loader
+
+
+def write_jpeg(path, height, width, orientation=None):
+    ok, buffer = cv2.imencode('.jpg', np.zeros((height, width, 3), np.uint8))
+    data = buffer.tobytes()
+    if orientation is not None:
+        # Minimal little-endian EXIF block with a single orientation entry
+        tiff = b'II*\x00' + struct.pack('<IH', 8, 1) + struct.pack('<HHIHH', 0x0112, 3, 1, orientation, 0) + \
+            struct.pack('<I', 0)
+        exif = b'Exif\x00\x00' + tiff
+        data = data[:2] + b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif + data[2:]
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def test_read_jpeg_header(tmp_path):
+    assert image_loader.read_jpeg_header(write_jpeg(tmp_path / 'plain.jpg', 300, 500)) == (300, 500, 1)
+    # Orientation 6 is displayed rotated by 90 degrees, so the displayed height is the stored width
+    assert image_loader.read_jpeg_header(write_jpeg(tmp_path / 'rotated.jpg', 300, 500, orientation=6)) == (500, 300, 6)
+
+    png_path = str(tmp_path / 'image.png')
+    cv2.imwrite(png_path, np.zeros((10, 10, 3), np.uint8))
+    assert image_loader.read_jpeg_header(png_path) is None
+
+
+def test_reduced_decode_never_upscales(tmp_path):
+    path = write_jpeg(tmp_path / 'plate.jpg', 2100, 2800)
+    assert image_loader.get_reduced_read_flag(path, 1024) == cv2.IMREAD_REDUCED_COLOR_2
+    assert image_loader.get_reduced_read_flag(path, 512) == cv2.IMREAD_REDUCED_COLOR_4
+    assert image_loader.get_reduced_read_flag(path, 2048) == cv2.IMREAD_COLOR
+    assert image_loader.get_reduced_read_flag(path, None) == cv2.IMREAD_COLOR
+    assert image_loader.decode_image(path, 1024).shape == (1024, 1024, 3)
+
+    rotated_path = write_jpeg(tmp_path / 'rotated.jpg', 1200, 2400, orientation=6)
+    assert image_loader.get_reduced_read_flag(rotated_path, 1024) == cv2.IMREAD_REDUCED_COLOR_2
+    assert image_loader.decode_image(rotated_path, 1024).shape == (1024, 512, 3)
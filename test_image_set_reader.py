@@ -0,0 +1,34 @@
+import os
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import cv2
+import numpy as np
+from PySide6.QtWidgets import QApplication, QMessageBox
+
+import image_set_reader
+from benchmarks import make_synthetic_plate
+from image_set_reader import ImageSetBlobDetector
+from keypoint_store import KeypointStore
+from utils import BACKEND_YOLO, BACKEND_YOLO_TILED, DEFAULT_TARGET_IMAGE_SIZE
+
+
+def test_backend_switch_resets_every_plate(monkeypatch, tmp_path):
+    app = QApplication.instance() or QApplication([])
+    monkeypatch.setattr(image_set_reader.QMessageBox, "question", lambda *args: QMessageBox.StandardButton.Yes)
+    for sample in range(1, 5):
+        cv2.imwrite(str(tmp_path / f"3_{sample}_3rd_dilution.png"), make_synthetic_plate(256, 256, 10, seed=sample)[0])
+    widget = ImageSetBlobDetector()
+    widget.load_images_from_folder(str(tmp_path))
+    assert len(widget.records) == 4
+
+    for backend, target_size in ((BACKEND_YOLO_TILED, None), (BACKEND_YOLO, DEFAULT_TARGET_IMAGE_SIZE)):
+        for record in widget.records:  # Counted in the coordinates of the current preprocessing
+            record.set_keypoints(KeypointStore.from_detections(np.array([[10, 10, 4, 0.9]], dtype=np.float32)))
+        widget.set_detection_backend(backend)
+        assert widget.blob_counter.backend == backend
+        assert [record.target_size for record in widget.records] == [target_size] * 4
+        assert [len(record.keypoints) for record in widget.records] == [0] * 4
+        assert all(record.blob_counter is widget.blob_counter for record in widget.records)
+    widget.close()
+    app.processEvents()
@@ -0,0 +1,35 @@
+import json
+import time
+
+from instrumentation import StageProfiler, NULL_STAGE
+
+
+def test_disabled_profiler_records_nothing():
+    profiler = StageProfiler(enabled=False)
+    assert profiler.stage("imread", image="a.jpg") is NULL_STAGE
+    with profiler.stage("imread", image="a.jpg"):
+        pass
+    assert profiler.events() == []
+    assert profiler.summary() == "Profile: no stages recorded."
+
+
+def test_stage_stats_and_chrome_trace(tmp_path):
+    profiler = StageProfiler(enabled=True)
+    for image in ("a.jpg", "b.jpg"):
+        with profiler.stage("imread", image=image):
+            time.sleep(0.002)
+    with profiler.stage("model_predict", batch=2):
+        time.sleep(0.004)
+
+    stats = profiler.stage_stats()
+    assert list(stats) == ["imread", "model_predict"]
+    assert stats["imread"]["calls"] == 2 and stats["imread"]["images"] == 2
+    assert stats["imread"]["per_image_s"] >= 0.002
+    assert stats["model_predict"]["per_image_s"] is None and stats["model_predict"]["total_s"] >= 0.004
+    assert "model_predict" in profiler.summary()
+
+    trace = json.loads(open(profiler.export_chrome_trace(str(tmp_path / "trace.json"))).read())
+    stages = [event for event in trace["traceEvents"] if event["ph"] == "X"]
+    assert [event["name"] for event in stages] == ["imread", "imread", "model_predict"]
+    assert stages[0]["args"] == {"image": "a.jpg"} and stages[2]["args"] == {"batch": 2}
+    assert all(event["dur"] > 0 for event in stages)
@@ -0,0 +1,35 @@
+import numpy as np
+
+from keypoint_archive import KeypointArchive, save_keypoint_archive
+from keypoint_store import KeypointStore, SOURCE_DETECTED, SOURCE_MANUAL
+from utils import Timepoint
+
+
+def test_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    samples = []
+    for day, sample_number, count in ((3, 1, 4), (3, 2, 0), (5, -1, 3)):
+        store = KeypointStore.from_detections(rng.uniform(1, 1000, (count, 4)))
+        samples.append((Timepoint(day, sample_number, "x10", count, f"Day {day}/{sample_number}.jpg"), store))
+    samples[0][1].remove(1)
+    samples[2][1].add(1.0, 2.0, 3.0)
+
+    archive_path = str(tmp_path / "archive")
+    assert save_keypoint_archive(samples, archive_path, preprocessing={"target_size": 1024}) == archive_path
+    archive = KeypointArchive(archive_path)
+    assert len(archive) == 3
+    assert archive.preprocessing == {"target_size": 1024}
+    assert isinstance(archive.keypoints, np.memmap)
+    for (timepoint, store), (read_timepoint, keypoints) in zip(samples, archive):
+        assert read_timepoint == timepoint
+        np.testing.assert_array_equal(keypoints, store.to_array())
+
+    assert archive.find(5, -1) == 2
+    assert archive.find(4, 1) is None
+    store = archive.to_store(2)
+    assert store.columns()["source"].tolist() == [SOURCE_DETECTED] * 3 + [SOURCE_MANUAL]
+
+    # Overwriting replaces the previous archive
+    save_keypoint_archive(samples[:1], archive_path)
+    assert len(KeypointArchive(archive_path, mmap=False)) == 1
+    assert save_keypoint_archive([], archive_path) is None
@@ -0,0 +1,93 @@
+import os
+import xml.dom.minidom
+import xml.etree.ElementTree as ET
+
+import cv2
+import numpy as np
+import pytest
+
+from keypoint_export import save_keypoints_as_xml, CountedImageWriter, get_imwrite_params
+from keypoint_store import KeypointStore
+from utils import Timepoint
+
+
+def reference_xml(samples):
+    # The ElementTree + minidom pretty-print the streaming writer replaces
+    root = ET.Element("Keypoints")
+    day_element = None
+    for timepoint, keypoints in samples:
+        if day_element is None or day_element.get("number") != str(timepoint.day):
+            day_element = ET.SubElement(root, "Day")
+            day_element.set("number", str(timepoint.day))
+        sample_element = ET.SubElement(day_element, "Sample")
+        if timepoint.sample_number == -1:
+            sample_element.set("filename", timepoint.filename)
+        else:
+            sample_element.set("number", str(timepoint.sample_number))
+        for x, y, size, _ in keypoints.to_array().tolist():
+            kp_element = ET.SubElement(sample_element, "Keypoint")
+            ET.SubElement(kp_element, "X").text = str(x)
+            ET.SubElement(kp_element, "Y").text = str(y)
+            ET.SubElement(kp_element, "Size").text = str(size)
+    return xml.dom.minidom.parseString(ET.tostring(root, encoding='utf-8')).toprettyxml(indent="  ")
+
+
+def make_samples():
+    rng = np.random.default_rng(0)
+    samples = []
+    for day, sample_number, count in ((3, 1, 5), (3, 2, 0), (5, 1, 3), (5, -1, 2)):
+        store = KeypointStore.from_detections(rng.uniform(1, 1000, (count, 4)))
+        if count:
+            store.remove(0)  # Removed keypoints are not exported
+        samples.append((Timepoint(day, sample_number, "x10", len(store), 'plates/"odd" & <name>.jpg'), store))
+    return samples
+
+
+def test_streaming_xml_matches_pretty_printed_tree(tmp_path):
+    samples = make_samples()
+    xml_path = save_keypoints_as_xml(samples, str(tmp_path))
+    assert xml_path == os.path.join(str(tmp_path), "Day 5", "keypoints.xml")
+    with open(xml_path, encoding="utf-8") as f:
+        assert f.read() == reference_xml(samples)
+    assert [name for name in os.listdir(tmp_path)] == ["Day 5"]  # No temporary file left behind
+
+
+def test_streaming_xml_without_indentation(tmp_path):
+    samples = make_samples()
+    with open(save_keypoints_as_xml(samples, str(tmp_path), indent=None), encoding="utf-8") as f:
+        compact = f.read()
+    assert "\n" not in compact
+    root = ET.fromstring(compact.encode())
+    assert [len(sample) for day in root for sample in day] == [4, 0, 2, 1]
+    assert root[1][1].get("filename") == 'plates/"odd" & <name>.jpg'
+
+
+def test_no_samples(tmp_path):
+    assert save_keypoints_as_xml([], str(tmp_path)) is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_counted_image_writer(tmp_path):
+    class Record:
+        def __init__(self, sample_number):
+            self.timepoint = Timepoint(day=3, sample_number=sample_number, dilution="3rd", num_keypoints=1,
+                                       filename=f"{sample_number}_3rd.jpg")
+
+        def get_timepoint(self):
+            return self.timepoint
+
+        def get_display_image(self):
+            return np.full((32, 32, 3), self.timepoint.sample_number, dtype=np.uint8)
+
+    records = [Record(i) for i in range(1, 21)]
+    progress = []
+    with CountedImageWriter(str(tmp_path), "jpg", quality=80, max_workers=3) as writer:
+        written, errors = writer.write_all(records, progress=lambda done, total: progress.append((done, total)))
+    assert not errors
+    assert progress[-1] == (20, 20) and len(progress) == 20
+    assert sorted(written) == sorted(str(tmp_path / "Day 3" / f"Sample_{i}.jpg") for i in range(1, 21))
+    assert cv2.imread(written[0]).shape == (32, 32, 3)
+
+    with pytest.raises(ValueError):
+        get_imwrite_params("png", 10)
+    assert get_imwrite_params("png", 9) == [cv2.IMWRITE_PNG_COMPRESSION, 9]
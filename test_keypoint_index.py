@@ -0,0 +1,53 @@
+import math
+import random
+
+import numpy as np
+
+from keypoint_index import KeypointIndex
+from keypoint_store import KeypointStore
+
+
+def random_store(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return KeypointStore.from_detections(np.column_stack((rng.uniform(0, 1024, count), rng.uniform(0, 1024, count),
+                                                          rng.uniform(5, 60, count), np.ones(count))))
+
+
+def test_queries_match_linear_scan():
+    store = random_store(2000)
+    index = KeypointIndex.from_store(store, cell_size=32)
+    points = {i: (store.point(i), store.radius(i)) for i in store.ids().tolist()}
+    rng = random.Random(1)
+    for _ in range(200):
+        x, y = rng.uniform(-50, 1100), rng.uniform(-50, 1100)
+
+        def distance(i):
+            return math.dist(points[i][0], (x, y))
+
+        hits = [i for i in points if distance(i) <= points[i][1]]
+        assert index.find_containing(x, y) == (min(hits, key=distance) if hits else None)
+        assert index.nearest(x, y) == min(points, key=distance)
+
+        x1, y1 = x + rng.uniform(-200, 200), y + rng.uniform(-200, 200)
+        expected = {i for i, ((kp_x, kp_y), _) in points.items()
+                    if min(x, x1) <= kp_x <= max(x, x1) and min(y, y1) <= kp_y <= max(y, y1)}
+        assert set(index.query_rect(x, y, x1, y1)) == expected
+        assert set(index.query_radius(x, y, 40)) == {i for i in points if distance(i) <= 40}
+
+
+def test_insert_remove():
+    index = KeypointIndex()
+    assert index.nearest(0, 0) is None
+    index.insert("first", 10, 10, 20)
+    index.insert("second", 300, 300, 20)
+    index.insert("first", 10, 10, 20)  # Inserting twice is a no-op
+    assert len(index) == 2
+    assert index.find_containing(15, 12) == "first"
+    assert index.nearest(250, 250) == "second"
+    assert index.nearest(250, 250, max_distance=10) is None
+
+    assert index.remove("first")
+    assert not index.remove("first")
+    assert "first" not in index
+    assert index.find_containing(15, 12) is None
+    assert index.nearest(0, 0) == "second"
@@ -0,0 +1,69 @@
+from collections import namedtuple
+
+import numpy as np
+
+from keypoint_store import KeypointStore, SOURCE_DETECTED, SOURCE_MANUAL
+
+MockKeypoint = namedtuple('MockKeypoint', ['pt', 'size', 'response'])
+
+
+def test_from_detections_and_export():
+    detections = np.array([[10, 20, 30, 0.9], [40, 50, 60, 0.8], [70, 80, 90, 0.7]], dtype=np.float32)
+    store = KeypointStore.from_detections(detections)
+    assert len(store) == 3
+    np.testing.assert_array_equal(store.to_array(), detections)
+    assert store.columns()["source"].tolist() == [SOURCE_DETECTED] * 3
+    assert store.point(1) == (40.0, 50.0)
+    assert store.radius(1) == 30.0
+
+    empty = KeypointStore.from_detections(np.zeros((0, 4), dtype=np.float32))
+    assert len(empty) == 0
+    assert empty.to_array().shape == (0, 4)
+
+
+def test_add_remove_restore_keep_ids():
+    store = KeypointStore(capacity=1)
+    ids = [store.add(i, i, 10) for i in range(100)]  # Grows past the initial capacity
+    assert ids == list(range(100))
+    assert store.columns()["source"].tolist() == [SOURCE_MANUAL] * 100
+
+    assert store.remove(5)
+    assert not store.remove(5)
+    assert 5 not in store
+    assert len(store) == 99
+    assert 5 not in store.ids().tolist()
+
+    new_id = store.add(1000, 1000, 10)
+    assert new_id == 100  # Removed ids are not reused, so undo history stays valid
+    assert store.restore(5)
+    assert not store.restore(5)
+    assert store.point(5) == (5.0, 5.0)
+    assert len(store) == 101
+
+    removed = store.remove_many([1, 2, 2, 5])
+    assert sorted(removed.tolist()) == [1, 2, 5]
+    assert len(store) == 98
+    assert sorted(store.restore_many([1, 2, 3]).tolist()) == [1, 2]
+    assert len(store) == 100
+
+
+def test_from_keypoints():
+    store = KeypointStore.from_keypoints([MockKeypoint((1.5, 2.5), 8, 0.5), MockKeypoint((3, 4), 6, 1.0)])
+    np.testing.assert_array_equal(store.to_array(), np.array([[1.5, 2.5, 8, 0.5], [3, 4, 6, 1]], dtype=np.float32))
+
+
+def test_select_in_polygon():
+    grid = np.arange(10, dtype=np.float32) * 10 + 5
+    x, y = np.meshgrid(grid, grid)
+    store = KeypointStore.from_detections(np.column_stack((x.ravel(), y.ravel(), np.full(100, 4), np.ones(100))))
+    rectangle = [(0, 0), (30, 0), (30, 20), (0, 20)]
+    assert len(store.select_in_polygon(rectangle)) == 6
+    # Lasso: a triangle just below the diagonal, so only points with x > y are inside
+    triangle = [(1, 0), (101, 0), (101, 100)]
+    selected = store.select_in_polygon(triangle)
+    assert all(store.x[i] > store.y[i] for i in selected) and len(selected) == 45
+
+    store.remove_many(store.select_in_polygon(rectangle))
+    assert len(store.select_in_polygon(rectangle)) == 0
+    assert len(store.select_in_polygon(rectangle, removed=True)) == 6
+    assert len(store.select_in_polygon(rectangle, removed=True, source=SOURCE_MANUAL)) == 0
@@ -0,0 +1,46 @@
+from blob_counter import ModelRegistry, YOLOBlobCounter
+
+
+def make_registry():
+    loads = []
+
+    def loader(model_path):
+        loads.append(model_path)
+        return object()
+
+    return ModelRegistry(loader=loader), loads
+
+
+def test_counters_share_one_model_until_released():
+    registry, loads = make_registry()
+    first, second = registry.acquire("a.pt"), registry.acquire("a.pt")
+    assert first is second and first.ref_count == 2 and loads == ["a.pt"]
+
+    registry.release(first)
+    assert first.ref_count == 1
+    assert registry.evict_unused() == 0  # Still held by one counter
+    registry.release(second)
+    assert second.ref_count == 0
+
+
+def test_evict_unused_only_drops_idle_models():
+    registry, loads = make_registry()
+    held, idle = registry.acquire("held.pt"), registry.acquire("idle.pt")
+    registry.release(idle)
+    assert registry.evict_unused(max_idle_seconds=3600) == 0  # Idle, but not for long enough
+    assert registry.evict_unused() == 1
+    assert registry.loaded_models() == ["held.pt"]
+
+    registry.acquire("idle.pt")  # Loaded again after eviction
+    assert loads == ["held.pt", "idle.pt", "idle.pt"]
+    assert held.ref_count == 1
+
+
+def test_closing_a_counter_releases_its_model():
+    registry, loads = make_registry()
+    counter = YOLOBlobCounter(model_path="model.pt", registry=registry, use_detection_cache=False)
+    assert loads == []  # Weights are only loaded on first use
+    entry = counter.registered_model
+    assert entry.ref_count == 1
+    counter.close()
+    assert entry.ref_count == 0 and registry.evict_unused() == 1
@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import pytest
+
+from blob_counter import letterbox, yolo_output_to_detections
+
+
+def test_decodes_letterboxed_boxes_with_per_class_nms():
+    image_shape = (900, 1300)
+    _, scale, (left, top) = letterbox(np.zeros(image_shape + (3,), dtype=np.uint8), (640, 640))
+    assert (left, top) == (0, 98)
+
+    def to_input(x, y, size):
+        return x * scale + left, y * scale + top, size * scale, size * scale
+
+    boxes = [(to_input(100, 200, 40), (0.9, 0.0)),
+             (to_input(102, 201, 40), (0.8, 0.0)),  # Overlaps the first box of the same class
+             (to_input(101, 200, 40), (0.0, 0.7)),  # Same place, other class
+             (to_input(800, 600, 30), (0.2, 0.1))]  # Below the confidence threshold
+    prediction = np.array([box + scores for box, scores in boxes], dtype=np.float32).T
+    detections = yolo_output_to_detections(prediction, scale, (left, top), image_shape)
+    np.testing.assert_allclose(detections, [[100, 200, 40, 0.9], [101, 200, 40, 0.7]], atol=1e-3)
+
+
+def test_onnx_counter_exports_once(tmp_path):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    from benchmarks import make_stand_in_model, make_synthetic_plate
+    from blob_counter import ModelRegistry, OnnxBlobCounter, load_onnx_model
+
+    model_path = make_stand_in_model(str(tmp_path / "stand_in.pt"))
+    blob_counter = OnnxBlobCounter(model_path=model_path, registry=ModelRegistry(loader=load_onnx_model),
+                                   use_detection_cache=False)
+    images = [make_synthetic_plate(512, 512, 20, seed=i)[0] for i in range(2)]
+    try:
+        assert len(blob_counter.count_blobs_batch(images, batch_size=2)) == 2
+        onnx_path = str(tmp_path / "stand_in.onnx")
+        exported_at = os.path.getmtime(onnx_path)
+        assert blob_counter.weights_path() == onnx_path
+        assert os.path.getmtime(onnx_path) == exported_at
+    finally:
+        blob_counter.close()
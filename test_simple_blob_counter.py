@@ -0,0 +1,32 @@
+import cv2
+import numpy as np
+import pytest
+
+from blob_counter import SimpleBlobCounter, create_blob_counter
+from utils import BACKEND_SIMPLE_BLOB
+
+CENTERS = [(60, 60), (200, 80), (120, 220), (300, 300)]
+
+
+def circles_image(radius=12):
+    image = np.full((400, 400, 3), 40, dtype=np.uint8)
+    for center in CENTERS:
+        cv2.circle(image, center, radius, (230, 230, 230), -1)
+    return image
+
+
+def test_counts_circles_and_follows_settings():
+    counter = create_blob_counter(BACKEND_SIMPLE_BLOB)
+    assert isinstance(counter, SimpleBlobCounter)
+    store = counter.count_blobs(circles_image())
+    assert len(store) == len(CENTERS)
+    found = sorted(tuple(np.round(store.point(i)).astype(int)) for i in store.ids().tolist())
+    assert found == sorted(CENTERS)
+
+    counter.set_settings(min_area=2000)  # Larger than every circle
+    assert len(counter.count_blobs(circles_image())) == 0
+
+
+def test_rejects_unknown_settings():
+    with pytest.raises(ValueError):
+        SimpleBlobCounter().set_settings(min_radius=3)
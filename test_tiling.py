@@ -0,0 +1,25 @@
+import numpy as np
+
+from blob_counter import generate_tiles, merge_tile_detections
+
+
+def test_tiles_cover_the_image_and_end_at_its_edges():
+    height, width, tile_size, overlap = 2500, 3000, 1024, 128
+    tiles = generate_tiles(height, width, tile_size, overlap)
+    covered = np.zeros((height, width), dtype=bool)
+    for x0, y0, x1, y1 in tiles:
+        assert (x1 - x0, y1 - y0) == (tile_size, tile_size)
+        covered[y0:y1, x0:x1] = True
+    assert covered.all()
+    assert max(x1 for _, _, x1, _ in tiles) == width and max(y1 for _, _, _, y1 in tiles) == height
+    assert generate_tiles(500, 600, tile_size, overlap) == [(0, 0, 600, 500)]  # Smaller than one tile
+
+
+def test_merge_removes_seam_duplicates_and_keeps_touching_colonies():
+    detections = np.array([[1000, 500, 40, 0.9],  # Full colony seen by tile 0
+                           [990, 500, 20, 0.6],  # Same colony cut off at the edge of tile 1, IoU only 0.25
+                           [300, 300, 40, 0.8],  # Two touching colonies kept apart by the model in tile 0
+                           [330, 300, 40, 0.7]], dtype=np.float32)
+    merged = merge_tile_detections(detections, np.array([0, 1, 0, 0]), merge_overlap=0.5)
+    assert sorted(map(tuple, merged[:, :2].tolist())) == [(300, 300), (330, 300), (1000, 500)]
+    assert len(merge_tile_detections(np.zeros((0, 4), dtype=np.float32), np.zeros(0))) == 0
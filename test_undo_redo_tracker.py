@@ -62,3 +62,40 @@ def test_undo_redo_tracker_max_stack_size():
     # Check the redo stack size
     assert len(tracker.redo_stack) == 0
 
+
+def test_undo_redo_tracker_transaction():
+    tracker = undo_redo_tracker.UndoRedoTracker(max_stack_size=5)
+    actions = [undo_redo_tracker.Action(undo_redo_tracker.ActionType.REMOVE, i) for i in range(100)]
+    with tracker.transaction():
+        for action in actions[:50]:
+            tracker.perform_action(action)
+        with tracker.transaction():  # Nested transactions join the outer one
+            for action in actions[50:]:
+                tracker.perform_action(action)
+    # A single compound action no matter how many keypoints were edited
+    assert len(tracker.undo_stack) == 1
+    compound = tracker.undo()
+    assert isinstance(compound, undo_redo_tracker.CompoundAction)
+    assert list(compound.actions) == actions
+    assert tracker.redo() == compound
+
+    # A transaction with one action records it as is, an empty one records nothing
+    with tracker.transaction():
+        tracker.perform_action(actions[0])
+    with tracker.transaction():
+        pass
+    assert len(tracker.undo_stack) == 2
+    assert tracker.undo() == actions[0]
+
+
+def test_undo_redo_tracker_merges_consecutive_replacements():
+    tracker = undo_redo_tracker.UndoRedoTracker(max_stack_size=5)
+    stores = [[MockKeypoint((i, i))] for i in range(4)]
+    tracker.perform_action(undo_redo_tracker.ReplaceAction(stores[0], stores[1]))
+    tracker.perform_action(undo_redo_tracker.ReplaceAction(stores[1], stores[2]))  # Recounted again without edits
+    assert list(tracker.undo_stack) == [undo_redo_tracker.ReplaceAction(stores[0], stores[2])]
+
+    # An edit in between keeps the next replacement a separate step
+    tracker.perform_action(undo_redo_tracker.Action(undo_redo_tracker.ActionType.ADD, 0))
+    tracker.perform_action(undo_redo_tracker.ReplaceAction(stores[2], stores[3]))
+    assert len(tracker.undo_stack) == 3
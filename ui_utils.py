@@ -24,7 +24,7 @@ class UIUtils:
         hbox = QHBoxLayout()
         label = QLabel(name)
         label.setObjectName("sliderTitleLabel")
-        display_value = int(float(initial_value * 100)) if is_percentage else int(initial_value)
+        display_value = round(initial_value * 100) if is_percentage else int(initial_value)
         input_field = QLineEdit(str(display_value))
         input_field.setFixedWidth(35)
 
@@ -36,8 +36,10 @@ class UIUtils:
         slider_hbox = QHBoxLayout()
         min_label = QLabel(str(int(min_value * 100)) if is_percentage else str(int(min_value)))
         slider = QSlider(Qt.Horizontal)
-        slider.setRange(min_value * 100 if is_percentage else min_value, max_value * 100 if is_percentage else max_value)
-        slider.setValue(initial_value * 100 if is_percentage else initial_value)
+        # QSlider only takes ints, percentages are stored as 0-100
+        slider.setRange(round(min_value * 100) if is_percentage else int(min_value),
+                        round(max_value * 100) if is_percentage else int(max_value))
+        slider.setValue(display_value)
         slider.setToolTip(tooltip)
         slider.setFixedHeight(15)
         max_label = QLabel(str(int(max_value * 100)) if is_percentage else str(int(max_value)))
@@ -1,26 +1,75 @@
 import enum
 import logging
-from collections import namedtuple
+from collections import namedtuple, deque
+from contextlib import contextmanager
 
 from utils import DEFAULT_MAX_UNDO_REDO_STACK_SIZE
 
-Action = namedtuple('Action', ['action_type', 'keypoint'])
+Action = namedtuple('Action', ['action_type', 'keypoint'])  # keypoint is the KeypointStore id of the keypoint
+CompoundAction = namedtuple('CompoundAction', ['actions'])  # Actions undone and redone together, in order
+ReplaceAction = namedtuple('ReplaceAction', ['old', 'new'])  # The whole KeypointStore was swapped, e.g. by a recount
+
+
+def describe_action(action):
+    if isinstance(action, CompoundAction):
+        return f"CompoundAction[{len(action.actions)} actions]"
+    if isinstance(action, ReplaceAction):
+        return f"ReplaceAction[{len(action.old)} -> {len(action.new)} keypoints]"
+    return f"Action[ActionType={action.action_type}, Keypoint={action.keypoint}]"
+
 
 class UndoRedoTracker:
     def __init__(self, max_stack_size=DEFAULT_MAX_UNDO_REDO_STACK_SIZE):
-        self.undo_stack = []
-        self.redo_stack = []
+        # Bounded deques drop the oldest entry in O(1) once the history is full
+        self.undo_stack = deque(maxlen=max_stack_size)
+        self.redo_stack = deque(maxlen=max_stack_size)
         self.max_stack_size = max_stack_size
+        self._transaction_depth = 0
+        self._transaction_actions = []
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group every action performed inside the block into one CompoundAction, so it is undone and redone as a single
+        step. Transactions can be nested, only the outermost one records anything.
+        """
+        self._transaction_depth += 1
+        try:
+            yield
+        finally:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                actions, self._transaction_actions = self._transaction_actions, []
+                if len(actions) == 1:
+                    self._push(actions[0])
+                elif actions:
+                    self._push(CompoundAction(tuple(actions)))
 
-    def perform_action(self, action: Action):
+    def perform_action(self, action):
         """Perform an action and add it to the undo stack."""
         if action is None:
             return # No action to perform
-        if len(self.undo_stack) + 1 > self.max_stack_size:
-            self.undo_stack.pop(0)  # Remove the oldest action if the stack exceeds the maximum size
+        if self._transaction_depth:
+            self._transaction_actions.append(action)
+            return
+        self._push(action)
+
+    def _push(self, action):
         self.redo_stack.clear()  # Clear the redo stack as new action invalidates the redo history
+        if isinstance(action, ReplaceAction) and self.undo_stack and isinstance(self.undo_stack[-1], ReplaceAction) \
+                and self.undo_stack[-1].new is action.old:
+            # Recounts without edits in between, e.g. while a detection slider is dragged, are undone in one step
+            action = ReplaceAction(self.undo_stack.pop().old, action.new)
         self.undo_stack.append(action)
-        logging.debug(f"Action performed: Action[ActionType={action.action_type}, Keypoint=(x={action.keypoint.pt[0]}, y={action.keypoint.pt[1]})]")
+        logging.debug(f"Action performed: {describe_action(action)}")
+
+    def last_action(self):
+        """The action the next undo would undo, None if there is nothing to undo."""
+        return self.undo_stack[-1] if self.undo_stack else None
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
 
     def undo(self):
         """Undo the last action."""
@@ -28,7 +77,7 @@ class UndoRedoTracker:
             logging.debug("No undo stack")
             return  # No action to undo
         action = self.__undo_redo_helper(self.undo_stack, self.redo_stack)
-        logging.debug(f"Undoing action: Action[ActionType={action.action_type}, Keypoint=(x={action.keypoint.pt[0]}, y={action.keypoint.pt[1]})]")
+        logging.debug(f"Undoing action: {describe_action(action)}")
         return action
 
     def redo(self):
@@ -37,13 +86,11 @@ class UndoRedoTracker:
             logging.debug("No redo stack")
             return  # No action to redo
         action = self.__undo_redo_helper(self.redo_stack, self.undo_stack)
-        logging.debug(f"Redoing action: Action[ActionType={action.action_type}, Keypoint=(x={action.keypoint.pt[0]}, y={action.keypoint.pt[1]})]")
+        logging.debug(f"Redoing action: {describe_action(action)}")
         return action
 
-    def __undo_redo_helper(self, pop_stack: list[Action], push_stack: list[Action]) -> Action:
+    def __undo_redo_helper(self, pop_stack: deque, push_stack: deque):
         action = pop_stack.pop()
-        if len(push_stack) + 1 > self.max_stack_size:
-            push_stack.pop(0)  # Remove the oldest action if the stack exceeds the maximum size
         push_stack.append(action)
         return action
 
@@ -1,3 +1,4 @@
+import os
 from collections import namedtuple
 
 # Constants
@@ -23,6 +24,56 @@ DEFAULT_DILUTION = "3rd"
 USE_DILUTION = True
 USE_DAY = True
 IMAGE_LIST_WIDGET_WIDTH = 300
+DEFAULT_TARGET_IMAGE_SIZE = 1024  # Plates are resized to this height and center-cropped to a square
+DEFAULT_OUTPUT_FOLDER = "counted_images"
+DEFAULT_EXPORT_IMAGE_FORMAT = "png"  # Format of exported counted images: png, jpg or webp
+DEFAULT_EXPORT_THREADS = min(4, os.cpu_count() or 1)  # Threads rendering and encoding counted images
+KEYPOINT_ARCHIVE_FOLDER = "keypoints_archive"  # Memory-mappable keypoint export, inside the output folder
+DEFAULT_IMAGE_CACHE_BUDGET_MB = 512  # Memory budget for decoded plate images shared by the whole app
+DEFAULT_PREFETCH_THREADS = min(4, os.cpu_count() or 1)  # Threads decoding plate images ahead of use
+DEFAULT_PREFETCH_DISTANCE = 3  # Plates prefetched on each side of the selected one
+DEFAULT_DETECTION_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".blob_counter", "detection_cache.sqlite3")
+DEFAULT_DETECTION_CACHE_MAX_MB = 256  # Size limit for persisted detection results
+DEFAULT_MODEL_PATH = "yolo11x.pt"  # Path to YOLO model weights
+DEFAULT_TILE_SIZE = 1024  # Tile edge length in pixels for tiled full-resolution detection
+DEFAULT_TILE_OVERLAP = 128  # Overlap between neighbouring tiles, should exceed the largest colony diameter
+DEFAULT_TILE_MERGE_OVERLAP = 0.5  # Detections from different tiles covering more than this of the smaller one merge
+BACKEND_YOLO = "yolo"  # Detection backends an image set can be counted with
+BACKEND_YOLO_TILED = "yolo_tiled"
+BACKEND_SIMPLE_BLOB = "simple_blob"
+BACKEND_ONNX = "onnx"
+BACKEND_ONNX_INT8 = "onnx_int8"
+BACKEND_CASCADE = "cascade"
+DETECTION_BACKENDS = (BACKEND_YOLO, BACKEND_YOLO_TILED, BACKEND_ONNX, BACKEND_ONNX_INT8, BACKEND_CASCADE,
+                      BACKEND_SIMPLE_BLOB)
+DEFAULT_DETECTION_BACKEND = BACKEND_YOLO
+DEFAULT_THRESHOLD_STEP = 10  # SimpleBlobDetector thresholds the plate at min, min + step, ... below max threshold
+DEFAULT_MIN_REPEATABILITY = 2  # Threshold levels a blob must appear in to be counted
+DEFAULT_COMPONENT_CACHE_SIZE = 4  # Plates whose per-threshold component statistics are kept for re-filtering
+DEFAULT_ONNX_THREADS = os.cpu_count() or 1  # ONNX Runtime threads per forward pass, inference is serialized per model
+DEFAULT_DETECTION_CONFIDENCE = 0.25  # Same defaults as ultralytics predict, so both YOLO paths count alike
+DEFAULT_NMS_IOU_THRESHOLD = 0.7
+DEFAULT_MAX_DETECTIONS = 300
+DEFAULT_CASCADE_SMALL_MODEL_PATH = "yolo11n.pt"  # Cheap first-pass model of the cascade backend
+ESCALATE_PLATE = "plate"  # The cascade re-counts a whole uncertain plate with the large model
+ESCALATE_REGION = "region"  # The cascade re-counts only the uncertain regions of a plate with the large model
+DEFAULT_CASCADE_ESCALATION = ESCALATE_PLATE
+DEFAULT_CASCADE_UNCERTAIN_CONFIDENCE = 0.5  # Small-model detections below this confidence count as uncertain
+DEFAULT_CASCADE_MAX_UNCERTAIN_FRACTION = 0.2  # Escalate when more of the detections than this are uncertain
+DEFAULT_CASCADE_MAX_DENSITY = 150.0  # Escalate above this many detections per megapixel, crowded plates merge blobs
+DEFAULT_CASCADE_REGION_SIZE = 512  # Edge length of the regions escalated on their own in region mode
+DEFAULT_CASCADE_REGION_MARGIN = 64  # Context around an escalated region, should exceed the largest colony diameter
+PROFILE_ENV_VAR = "BLOB_COUNTER_PROFILE"  # Set to 1 to time every pipeline stage and log a summary after counting
+TRACE_ENV_VAR = "BLOB_COUNTER_TRACE"  # Path to write a Chrome trace of the pipeline stages to, implies profiling
+DEFAULT_INFERENCE_BATCH_SIZE = 8  # Number of images per YOLO forward pass when counting an image set
+DEFAULT_MAX_COUNTING_THREADS = 2  # Batches counted concurrently; inference itself is serialized per shared model
+DEFAULT_SERVICE_HOST = "127.0.0.1"  # The counting service only listens locally unless told otherwise
+DEFAULT_SERVICE_PORT = 8765
+DEFAULT_SERVICE_BATCH_WINDOW_MS = 10  # Requests arriving this soon after the first one of a batch join it
+DEFAULT_SERVICE_MAX_QUEUE = 64  # Images waiting for inference before new requests are turned away with 503
+DEFAULT_SERVICE_REQUEST_TIMEOUT = 120  # Seconds a request waits for its count before giving up with 504
+DEFAULT_SERVICE_MAX_UPLOAD_MB = 64  # Larger uploads are rejected with 413
+DEFAULT_SERVICE_LATENCY_WINDOW = 10000  # Latest requests the latency percentiles of the metrics are computed over
 
 # Slider names
 SLIDER_NAME_MIN_AREA = 'Min Area'
@@ -49,6 +100,7 @@ DEFAULT_MIN_DIST_BETWEEN_BLOBS = 10
 DEFAULT_MIN_THRESHOLD = 100
 DEFAULT_MAX_THRESHOLD = 160
 DEFAULT_MAX_UNDO_REDO_STACK_SIZE = 50
+DEFAULT_KEYPOINT_INDEX_CELL_SIZE = 64  # Grid cell size in pixels of the keypoint hit-testing index
 DEFAULT_KEYPOINT_SIZE_ADJUSTMENT_STEP = 1 # Step size for increasing/decreasing manually added keypoint size
 
 # Tooltips